@@ -0,0 +1,81 @@
+# Copyright (c) 2023 Zeeland
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# Copyright Owner: Zeeland
+# GitHub Link: https://github.com/Undertone0809/
+# Project Link: https://github.com/Undertone0809/cushy-storage
+# Contact Email: zeeland@foxmail.com
+
+
+"""
+Measure the time to import cushy_storage in a fresh interpreter.
+
+Usage:
+    python benchmarks/import_time.py --runs 20
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def _self_import_us(env: dict) -> int:
+    """Run `python -X importtime` and get the cumulative time of cushy_storage."""
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import cushy_storage"],
+        env=env,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    for line in result.stderr.splitlines():
+        # import time: self [us] | cumulative | imported package
+        parts = line.split("|")
+        if len(parts) == 3 and parts[2].strip() == "cushy_storage":
+            return int(parts[1])
+    raise RuntimeError("can not found cushy_storage in import time report")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--runs", type=int, default=10)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as home:
+        env = dict(os.environ, HOME=home, USERPROFILE=home, PYTHONPATH=_ROOT)
+        times = sorted(_self_import_us(env) for _ in range(args.runs))
+        side_effects = os.listdir(home)
+
+    print(
+        json.dumps(
+            {
+                "name": "import_cushy_storage",
+                "runs": args.runs,
+                "median_us": statistics.median(times),
+                "min_us": times[0],
+                "max_us": times[-1],
+                "created_files": side_effects,
+            }
+        )
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,403 @@
+# Copyright (c) 2023 Zeeland
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# Copyright Owner: Zeeland
+# GitHub Link: https://github.com/Undertone0809/
+# Project Link: https://github.com/Undertone0809/cushy-storage
+# Contact Email: zeeland@foxmail.com
+
+
+"""
+Benchmark suite of cushy-storage. Results are printed as JSON lines and can be
+saved and compared with a baseline to find regressions.
+
+Usage:
+    # run all benchmarks and save the results
+    python benchmarks/run.py --output baseline.json
+
+    # run again after a change and compare with the baseline
+    python benchmarks/run.py --baseline baseline.json
+
+    # only run some benchmarks, with larger ORM models
+    python benchmarks/run.py --filter orm --rows 10000 100000 1000000
+"""
+
+import argparse
+import itertools
+import json
+import os
+import platform
+import shutil
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from typing import Callable, Dict, Iterator, List, Optional
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from cushy_storage import BaseDict, BaseORMModel, CushyDict, CushyOrmCache  # noqa
+from cushy_storage import disk_cache  # noqa
+
+_VALUE_SIZES = [100, 10 * 1024, 1024 * 1024]
+_COMPRESSORS = [None, "zlib", "lzma"]
+_SERIALIZERS = ["json", "pickle"]
+
+
+class Benchmark:
+    """A benchmark case, `setup` returns the function to measure"""
+
+    def __init__(self, name: str, params: dict, setup: Callable[[str], Callable]):
+        self.name = name
+        self.params = params
+        self.setup = setup
+
+    @property
+    def id(self) -> str:
+        params = ",".join(f"{k}={v}" for k, v in self.params.items())
+        return f"{self.name}[{params}]"
+
+
+def _measure(fn: Callable[[], int], repeat: int) -> dict:
+    """Run fn `repeat` times, fn returns the number of operations it has done"""
+    durations = []
+    ops = 0
+    for _ in range(repeat):
+        start = time.perf_counter()
+        ops = fn()
+        durations.append(time.perf_counter() - start)
+    best = min(durations)
+    return {
+        "ops": ops,
+        "repeat": repeat,
+        "best_s": best,
+        "median_s": statistics.median(durations),
+        "ops_per_s": ops / best if best else 0.0,
+    }
+
+
+class _User(BaseORMModel):
+    def __init__(self, name: str, age: int):
+        super().__init__()
+        self.name = name
+        self.age = age
+
+
+def _value(size: int) -> bytes:
+    # half random, half repeated data, so compression has some work to do
+    return os.urandom(size // 2) + b"a" * (size - size // 2)
+
+
+def _base_dict_cases(ops: int) -> Iterator[Benchmark]:
+    for size in _VALUE_SIZES:
+        for compress in _COMPRESSORS:
+            n = max(1, min(ops, 16 * 1024 * 1024 // size))
+            params = {"size": size, "compress": compress, "ops": n}
+
+            def setup_set(path, size=size, compress=compress, n=n):
+                cache = BaseDict(path, compress=compress)
+                value = _value(size)
+
+                def run():
+                    for i in range(n):
+                        cache[f"key{i}"] = value
+                    return n
+
+                return run
+
+            def setup_get(path, size=size, compress=compress, n=n):
+                cache = BaseDict(path, compress=compress)
+                value = _value(size)
+                for i in range(n):
+                    cache[f"key{i}"] = value
+
+                def run():
+                    for i in range(n):
+                        cache[f"key{i}"]
+                    return n
+
+                return run
+
+            yield Benchmark("base_dict_set", params, setup_set)
+            yield Benchmark("base_dict_get", params, setup_get)
+
+
+def _cushy_dict_cases(ops: int) -> Iterator[Benchmark]:
+    for serialize in _SERIALIZERS:
+        for compress in _COMPRESSORS:
+            params = {"serialize": serialize, "compress": compress, "ops": ops}
+            value = {"name": "user", "age": 18, "tags": list(range(20))}
+
+            def setup_set(path, serialize=serialize, compress=compress, value=value):
+                cache = CushyDict(path, compress=compress, serialize=serialize)
+
+                def run():
+                    for i in range(ops):
+                        cache[f"key{i}"] = value
+                    return ops
+
+                return run
+
+            def setup_get(path, serialize=serialize, compress=compress, value=value):
+                cache = CushyDict(path, compress=compress, serialize=serialize)
+                for i in range(ops):
+                    cache[f"key{i}"] = value
+
+                def run():
+                    for i in range(ops):
+                        cache[f"key{i}"]
+                    return ops
+
+                return run
+
+            yield Benchmark("cushy_dict_set", params, setup_set)
+            yield Benchmark("cushy_dict_get", params, setup_get)
+
+
+def _contention_cases(ops: int) -> Iterator[Benchmark]:
+    for threads in [1, 4, 16]:
+        for keys in [1, 256]:
+            params = {"threads": threads, "keys": keys, "ops": ops}
+
+            def setup(path, threads=threads, keys=keys):
+                cache = CushyDict(path)
+                for i in range(keys):
+                    cache[f"key{i}"] = i
+
+                def worker(tid):
+                    for i in range(ops // threads):
+                        k = f"key{(tid + i) % keys}"
+                        if i % 2:
+                            cache[k] = i
+                        else:
+                            cache[k]
+
+                def run():
+                    workers = [
+                        threading.Thread(target=worker, args=(t,))
+                        for t in range(threads)
+                    ]
+                    for w in workers:
+                        w.start()
+                    for w in workers:
+                        w.join()
+                    return ops // threads * threads
+
+                return run
+
+            yield Benchmark("cushy_dict_contention", params, setup)
+
+
+def _scan_cases(keys_list: List[int]) -> Iterator[Benchmark]:
+    for keys in keys_list:
+        params = {"keys": keys}
+
+        def prepare(path, keys=keys) -> BaseDict:
+            cache = BaseDict(path)
+            for i in range(keys):
+                cache[f"key{i}"] = b"v"
+            return cache
+
+        def setup_len(path):
+            cache = prepare(path)
+            return lambda: len(cache) and 1
+
+        def setup_iter(path):
+            cache = prepare(path)
+            return lambda: sum(1 for _ in cache)
+
+        yield Benchmark("base_dict_len", params, setup_len)
+        yield Benchmark("base_dict_iter", params, setup_iter)
+
+
+def _orm_cases(rows_list: List[int]) -> Iterator[Benchmark]:
+    for rows in rows_list:
+        params = {"rows": rows}
+
+        def prepare(path, rows=rows) -> CushyOrmCache:
+            cache = CushyOrmCache(path)
+            cache.add([_User(f"user{i}", i % 100) for i in range(rows)])
+            return cache
+
+        def setup_add(path, rows=rows):
+            runs = itertools.count()
+
+            def run():
+                # a new cache for each run
+                cache = CushyOrmCache(f"{path}-{next(runs)}")
+                cache.add([_User(f"user{i}", i % 100) for i in range(rows)])
+                return rows
+
+            return run
+
+        def setup_add_one(path):
+            cache = prepare(path)
+            return lambda: cache.add(_User("new user", 1)) and 1
+
+        def setup_filter(path):
+            cache = prepare(path)
+            return lambda: len(cache.query(_User).filter(age=18).all()) and 1
+
+        def setup_first(path):
+            cache = prepare(path)
+            return lambda: cache.query(_User).first() and 1
+
+        def setup_delete(path):
+            cache = prepare(path)
+
+            def run():
+                cache.delete(cache.query(_User).first())
+                return 1
+
+            return run
+
+        yield Benchmark("orm_add_bulk", params, setup_add)
+        yield Benchmark("orm_add_one", params, setup_add_one)
+        yield Benchmark("orm_filter", params, setup_filter)
+        yield Benchmark("orm_first", params, setup_first)
+        yield Benchmark("orm_delete", params, setup_delete)
+
+
+def _disk_cache_cases(ops: int) -> Iterator[Benchmark]:
+    params = {"ops": ops}
+
+    def setup_hit(path):
+        @disk_cache(path)
+        def square(x):
+            return x * x
+
+        for i in range(ops):
+            square(i)
+
+        def run():
+            for i in range(ops):
+                square(i)
+            return ops
+
+        return run
+
+    def setup_miss(path):
+        @disk_cache(path)
+        def square(x):
+            return x * x
+
+        counter = iter(range(sys.maxsize))
+
+        def run():
+            for _ in range(ops):
+                square(next(counter))
+            return ops
+
+        return run
+
+    yield Benchmark("disk_cache_hit", params, setup_hit)
+    yield Benchmark("disk_cache_miss", params, setup_miss)
+
+
+def get_benchmarks(ops: int, keys: List[int], rows: List[int]) -> List[Benchmark]:
+    return [
+        *_base_dict_cases(ops),
+        *_cushy_dict_cases(ops),
+        *_contention_cases(ops),
+        *_scan_cases(keys),
+        *_orm_cases(rows),
+        *_disk_cache_cases(ops),
+    ]
+
+
+def run_benchmark(benchmark: Benchmark, repeat: int) -> dict:
+    path = tempfile.mkdtemp(prefix="cushy-bench-")
+    try:
+        fn = benchmark.setup(os.path.join(path, "cache"))
+        result = _measure(fn, repeat)
+    finally:
+        shutil.rmtree(path, ignore_errors=True)
+    return {"id": benchmark.id, "name": benchmark.name, **benchmark.params, **result}
+
+
+def compare(results: List[dict], baseline: Dict[str, dict], threshold: float) -> int:
+    """Print the change of each benchmark, return the number of regressions"""
+    regressions = 0
+    for result in results:
+        base = baseline.get(result["id"])
+        if base is None or not base["ops_per_s"]:
+            continue
+        change = result["ops_per_s"] / base["ops_per_s"] - 1
+        regressed = change < -threshold
+        regressions += regressed
+        print(
+            json.dumps(
+                {
+                    "id": result["id"],
+                    "baseline_ops_per_s": base["ops_per_s"],
+                    "ops_per_s": result["ops_per_s"],
+                    "change": round(change, 4),
+                    "regression": regressed,
+                }
+            ),
+            file=sys.stderr,
+        )
+    return regressions
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--filter", default="", help="run benchmarks whose id match")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--ops", type=int, default=1000)
+    parser.add_argument("--keys", type=int, nargs="+", default=[10_000, 100_000])
+    parser.add_argument("--rows", type=int, nargs="+", default=[10_000, 100_000])
+    parser.add_argument("--output", help="save results to the json file")
+    parser.add_argument("--baseline", help="compare results with the json file")
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.1,
+        help="a slowdown larger than this fraction is a regression",
+    )
+    args = parser.parse_args(argv)
+
+    results = []
+    for benchmark in get_benchmarks(args.ops, args.keys, args.rows):
+        if args.filter not in benchmark.id:
+            continue
+        result = run_benchmark(benchmark, args.repeat)
+        results.append(result)
+        print(json.dumps(result), flush=True)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(
+                {
+                    "python": platform.python_version(),
+                    "platform": platform.platform(),
+                    "cpu_count": os.cpu_count(),
+                    "results": results,
+                },
+                f,
+                indent=2,
+            )
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = {r["id"]: r for r in json.load(f)["results"]}
+        return 1 if compare(results, baseline, args.threshold) else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -18,7 +18,27 @@
 # Contact Email: zeeland@foxmail.com
 
 
-from cushy_storage._core import BaseDict, CushyDict, disk_cache
+from cushy_storage._core import BaseDict, CushyDict, disk_cache, sync
+from cushy_storage._integrity import ChecksumError
 from cushy_storage.orm import BaseORMModel, CushyOrmCache
 
-__all__ = ["disk_cache", "CushyDict", "BaseDict", "BaseORMModel", "CushyOrmCache"]
+__all__ = [
+    "disk_cache",
+    "CushyDict",
+    "BaseDict",
+    "BaseORMModel",
+    "CushyOrmCache",
+    "ChecksumError",
+    "sync",
+    "CacheServer",
+    "CacheClient",
+]
+
+
+def __getattr__(name: str):
+    # the server imports multiprocessing, so it is loaded on first use
+    if name in ("CacheServer", "CacheClient"):
+        from cushy_storage import server
+
+        return getattr(server, name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -0,0 +1,464 @@
+# Copyright (c) 2023 Zeeland
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# Copyright Owner: Zeeland
+# GitHub Link: https://github.com/Undertone0809/
+# Project Link: https://github.com/Undertone0809/cushy-storage
+# Contact Email: zeeland@foxmail.com
+
+
+"""
+Command line tools of cushy-storage.
+
+    python -m cushy_storage verify ./cache
+    python -m cushy_storage repair ./cache --serialize pickle
+    python -m cushy_storage serve ./cache --socket /tmp/cushy.sock
+    python -m cushy_storage stats ./cache --json
+    python -m cushy_storage top ./cache -n 20
+    python -m cushy_storage compact ./cache --recompress
+    python -m cushy_storage evict ./cache --max-size 10G --max-age 7d
+    python -m cushy_storage migrate-layout ./cache hash
+    python -m cushy_storage bench ./cache --reads 10000 --writes 1000
+"""
+
+import argparse
+import heapq
+import json
+import os
+import random
+import sys
+import time
+from collections import Counter
+from typing import Iterable, List, Optional
+
+from cushy_storage import BaseDict, CushyDict, CushyOrmCache
+from cushy_storage._layout import LAYOUTS
+from cushy_storage.stats import Histogram
+
+# Environment variable of the secret of the server
+_AUTHKEY_ENV = "CUSHY_STORAGE_AUTHKEY"
+
+# Print the progress of a scan to stderr every this many keys
+_PROGRESS_EVERY = 100000
+
+# Namespace written by the write benchmark
+_BENCH_NAMESPACE = "__bench__"
+
+_SIZE_UNITS = {"": 1, "K": 1024, "M": 1024**2, "G": 1024**3, "T": 1024**4}
+_AGE_UNITS = {"s": 1, "m": 60, "h": 3600, "d": 86400}
+
+
+def _read_config(args) -> dict:
+    """Read options recorded in the cache of args"""
+    try:
+        with open(f"{args.path}/.cushy/config.json", encoding="utf8") as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+
+def _open(args, serialize: str = "json", **options) -> BaseDict:
+    """
+    Open the cache of args. Compression and serialization are read from the cache
+    if they are not given, and serialize is used if the cache has not recorded it.
+    """
+    config = _read_config(args)
+    compress = args.compress or config.get("compress")
+    serialize = args.serialize or config.get("serialize") or serialize
+    if serialize == "none":
+        return BaseDict(args.path, compress, **options)
+    return CushyDict(args.path, compress, serialize, **options)
+
+
+def _parse_size(text: str) -> int:
+    """Parse sizes like 512, 64K, 10G"""
+    text = text.strip().upper().rstrip("B")
+    unit = text[-1:] if text[-1:] in _SIZE_UNITS else ""
+    try:
+        return int(float(text[: len(text) - len(unit)]) * _SIZE_UNITS[unit])
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid size: {text}")
+
+
+def _parse_age(text: str) -> float:
+    """Parse durations like 30, 45s, 12h, 7d"""
+    text = text.strip().lower()
+    unit = text[-1:] if text[-1:] in _AGE_UNITS else "s"
+    number = text[:-1] if text[-1:] in _AGE_UNITS else text
+    try:
+        return float(number) * _AGE_UNITS[unit]
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid duration: {text}")
+
+
+def _format_size(size: float) -> str:
+    for unit in ("B", "KB", "MB", "GB"):
+        if size < 1024:
+            return f"{size:.0f} {unit}" if unit == "B" else f"{size:.1f} {unit}"
+        size /= 1024
+    return f"{size:.1f} TB"
+
+
+def _progress(entries: Iterable, quiet: bool) -> Iterable:
+    """Pass entries through, printing the number scanned to stderr"""
+    n = 0
+    for n, e in enumerate(entries, 1):
+        if not quiet and n % _PROGRESS_EVERY == 0:
+            print(f"scanned {n} keys...", file=sys.stderr, flush=True)
+        yield e
+
+
+def _reservoir(sample: list, item, seen: int, size: int):
+    """Keep a uniform random sample of size items, item is the seen-th item"""
+    if len(sample) < size:
+        sample.append(item)
+    else:
+        i = random.randrange(seen)
+        if i < size:
+            sample[i] = item
+
+
+def _print_report(report: dict):
+    for k, error in report["corrupted"]:
+        print(f"corrupted  {k}  {error}")
+    mb = report["bytes"] / 1024 / 1024
+    print(
+        f"checked {report['checked']} values, {mb:.1f} MB in "
+        f"{report['seconds']:.2f}s ({report['throughput'] / 1024 / 1024:.1f} MB/s), "
+        f"{len(report['corrupted'])} corrupted"
+    )
+    if "quarantined" in report:
+        print(
+            f"quarantined {report['quarantined']} values, removed "
+            f"{report['removed_tmp']} temporary files, rebuilt "
+            f"{len(report['rebuilt'])} indexes"
+        )
+
+
+def _verify(args) -> int:
+    # values are only deserialized if the serialization is known
+    report = _open(args, "none").verify()
+    _print_report(report)
+    return 1 if report["corrupted"] else 0
+
+
+def _repair(args) -> int:
+    config = _read_config(args)
+    if config.get("kind") == "orm":
+        # page manifests are rebuilt by the ORM cache
+        cache = CushyOrmCache(args.path, args.compress or config.get("compress"))
+    else:
+        cache = _open(args, "none")
+    _print_report(cache.repair())
+    return 0
+
+
+def _serve(args) -> int:
+    from cushy_storage.server import CacheServer
+
+    authkey = os.environ.get(_AUTHKEY_ENV)
+    address = args.socket if args.socket else (args.host, args.port)
+    cache = _open(args, memory_items=args.memory_items, stats=True)
+    server = CacheServer(cache, address, authkey and authkey.encode("utf8"))
+    print(f"serving {args.path} at {server.address}", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+    return 0
+
+
+def _stats(args) -> int:
+    # values are read as bytes to measure the compression ratio
+    args.serialize = "none"
+    cache = _open(args)
+
+    count = total = 0
+    sizes = Counter()
+    shards = Counter()
+    sample: List = []
+    for e in _progress(cache.entries(), args.json):
+        count += 1
+        total += e.size
+        # bucket i holds sizes in (2 ** (i - 1), 2 ** i]
+        sizes[max(0, (e.size - 1).bit_length())] += 1
+        shards[e.shard] += 1
+        _reservoir(sample, e, count, args.sample)
+
+    stored = raw = 0
+    for e in sample:
+        try:
+            raw += len(cache[e.key])
+        except KeyError:
+            continue
+        stored += e.size
+
+    stats = {
+        "keys": count,
+        "bytes": total,
+        "sizes": {str(1 << i): sizes[i] for i in sorted(sizes)},
+        "compression_ratio": raw / stored if stored else None,
+        "shards": len(shards),
+        "keys_per_shard": {
+            "min": min(shards.values(), default=0),
+            "mean": count / len(shards) if shards else 0.0,
+            "max": max(shards.values(), default=0),
+        },
+    }
+    if args.json:
+        print(json.dumps(stats, indent=2))
+        return 0
+
+    print(f"keys: {count}, size: {_format_size(total)}")
+    print("value sizes:")
+    for bound, n in stats["sizes"].items():
+        print(f"  <= {_format_size(int(bound)):>9}  {n}")
+    if stats["compression_ratio"] is not None:
+        print(
+            f"compression ratio: {stats['compression_ratio']:.2f} "
+            f"(sampled {len(sample)} values)"
+        )
+    balance = stats["keys_per_shard"]
+    print(
+        f"shards: {len(shards)}, keys per shard: min {balance['min']}, "
+        f"mean {balance['mean']:.1f}, max {balance['max']}"
+    )
+    return 0
+
+
+def _top(args) -> int:
+    entries = _progress(_open(args).entries(), False)
+    for e in heapq.nlargest(args.n, entries, lambda e: e.size):
+        print(f"{e.size:>12}  {e.key}")
+    return 0
+
+
+def _compact(args) -> int:
+    report = _open(args).compact(args.recompress)
+    print(
+        f"removed {report['removed_tmp']} temporary files, "
+        f"{report['removed_unused']} unused values, "
+        f"{report['removed_shards']} empty shards, recompressed "
+        f"{report['recompressed']} values, saved {_format_size(report['saved_bytes'])}"
+    )
+    return 0
+
+
+def _evict(args) -> int:
+    if args.max_size is None and args.max_age is None:
+        print("nothing to do, give --max-size or --max-age", file=sys.stderr)
+        return 2
+    print(f"evicted {_open(args).evict(args.max_size, args.max_age)} values")
+    return 0
+
+
+def _migrate_layout(args) -> int:
+    moved = _open(args).migrate_layout(args.layout)
+    print(f"moved {moved} values to the {args.layout} layout")
+    return 0
+
+
+def _print_latency(name: str, histogram: Histogram, seconds: float, size: int):
+    s = histogram.snapshot()
+    seconds = max(seconds, 1e-9)
+    print(
+        f"{name}: {s['count']} ops in {seconds:.2f}s "
+        f"({s['count'] / seconds:.0f} ops/s, {_format_size(size / seconds)}/s), "
+        f"p50 {s['p50'] * 1e6:.0f}us, p90 {s['p90'] * 1e6:.0f}us, "
+        f"p99 {s['p99'] * 1e6:.0f}us, max {s['max'] * 1e6:.0f}us"
+    )
+
+
+def _bench(args) -> int:
+    cache = _open(args)
+    sample: List = []
+    for n, e in enumerate(_progress(cache.entries(), False), 1):
+        _reservoir(sample, e, n, args.reads)
+    random.shuffle(sample)
+
+    reads = Histogram()
+    size = 0
+    failed = 0
+    start = time.perf_counter()
+    for e in sample:
+        t = time.perf_counter()
+        try:
+            cache[e.key]
+        except KeyError:
+            continue
+        except Exception as error:
+            # such as values of another serialization
+            if not failed:
+                print(f"failed to read {e.key}: {error!r}", file=sys.stderr)
+            failed += 1
+            continue
+        reads.record(time.perf_counter() - t)
+        size += e.size
+    if reads.count:
+        _print_latency("read", reads, time.perf_counter() - start, size)
+    elif not failed:
+        print("read: no keys in the cache")
+    if failed:
+        print(
+            f"read: {failed} values failed to read, check --serialize and --compress",
+            file=sys.stderr,
+        )
+        return 1
+
+    if args.writes:
+        # write into a namespace of its own, which is emptied at last
+        bench = cache.namespace(_BENCH_NAMESPACE)
+        value = os.urandom(max(1, args.value_size // 2)).hex()
+        if not isinstance(cache, CushyDict):
+            value = value.encode()
+        writes = Histogram()
+        start = time.perf_counter()
+        try:
+            for i in range(args.writes):
+                t = time.perf_counter()
+                bench[f"bench-{i}"] = value
+                writes.record(time.perf_counter() - t)
+            seconds = time.perf_counter() - start
+            _print_latency("write", writes, seconds, len(value) * args.writes)
+        finally:
+            cache.drop_namespace(_BENCH_NAMESPACE)
+    return 0
+
+
+def _add_cache_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument("path", help="path of the cache")
+    parser.add_argument(
+        "--compress",
+        choices=["zlib", "lzma"],
+        help="compression of the cache, read from the cache by default",
+    )
+    parser.add_argument(
+        "--serialize",
+        choices=["json", "pickle", "none"],
+        help="serialization of the cache, 'none' for BaseDict, read from the cache "
+        "by default",
+    )
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(prog="python -m cushy_storage")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    verify = commands.add_parser("verify", help="check all values of a cache")
+    _add_cache_arguments(verify)
+    verify.set_defaults(func=_verify)
+
+    repair = commands.add_parser(
+        "repair", help="quarantine corrupted values and rebuild indexes"
+    )
+    _add_cache_arguments(repair)
+    repair.set_defaults(func=_repair)
+
+    serve = commands.add_parser(
+        "serve",
+        help="serve a cache to local processes, TCP needs the secret in "
+        f"${_AUTHKEY_ENV}",
+    )
+    _add_cache_arguments(serve)
+    serve.add_argument("--socket", help="path of the unix domain socket to listen")
+    serve.add_argument("--host", default="127.0.0.1", help="TCP host to listen")
+    serve.add_argument("--port", type=int, default=7379, help="TCP port to listen")
+    serve.add_argument(
+        "--memory-items",
+        type=int,
+        default=100000,
+        help="number of hot values kept in memory (default: 100000)",
+    )
+    serve.set_defaults(func=_serve)
+
+    stats = commands.add_parser(
+        "stats", help="count keys, size distribution, compression and shard balance"
+    )
+    _add_cache_arguments(stats)
+    stats.add_argument(
+        "--sample",
+        type=int,
+        default=1000,
+        help="number of values read to measure the compression ratio (default: 1000)",
+    )
+    stats.add_argument("--json", action="store_true", help="print stats as JSON")
+    stats.set_defaults(func=_stats)
+
+    top = commands.add_parser("top", help="list the biggest values")
+    _add_cache_arguments(top)
+    top.add_argument("-n", type=int, default=20, help="number of values (default: 20)")
+    top.set_defaults(func=_top)
+
+    compact = commands.add_parser(
+        "compact", help="remove temporary files, unused values and empty shards"
+    )
+    _add_cache_arguments(compact)
+    compact.add_argument(
+        "--recompress",
+        action="store_true",
+        help="compress all values again with the current compression",
+    )
+    compact.set_defaults(func=_compact)
+
+    evict = commands.add_parser(
+        "evict", help="remove old values, then least recently used values"
+    )
+    _add_cache_arguments(evict)
+    evict.add_argument(
+        "--max-size", type=_parse_size, help="max size of all values, like 10G"
+    )
+    evict.add_argument(
+        "--max-age", type=_parse_age, help="max age of values, like 7d or 12h"
+    )
+    evict.set_defaults(func=_evict)
+
+    migrate = commands.add_parser(
+        "migrate-layout", help="move all values to another directory layout"
+    )
+    _add_cache_arguments(migrate)
+    migrate.add_argument("layout", choices=sorted(LAYOUTS), help="the new layout")
+    migrate.set_defaults(func=_migrate_layout)
+
+    bench = commands.add_parser("bench", help="measure read and write latency")
+    _add_cache_arguments(bench)
+    bench.add_argument(
+        "--reads", type=int, default=1000, help="number of keys to read (default: 1000)"
+    )
+    bench.add_argument(
+        "--writes",
+        type=int,
+        default=0,
+        help=f"number of values to write into the {_BENCH_NAMESPACE} namespace, "
+        "which is emptied at last (default: 0)",
+    )
+    bench.add_argument(
+        "--value-size",
+        type=_parse_size,
+        default=1024,
+        help="size of written values (default: 1K)",
+    )
+    bench.set_defaults(func=_bench)
+
+    args = parser.parse_args(argv)
+    # only a server may start with a new cache, other commands work on existing ones
+    if args.command != "serve" and not os.path.isdir(args.path):
+        print(f"cache not found: {args.path}", file=sys.stderr)
+        return 2
+    return args.func(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,133 @@
+# Copyright (c) 2023 Zeeland
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# Copyright Owner: Zeeland
+# GitHub Link: https://github.com/Undertone0809/
+# Project Link: https://github.com/Undertone0809/cushy-storage
+# Contact Email: zeeland@foxmail.com
+
+
+import json
+import os
+import re
+import threading
+import time
+from collections import Counter
+from pathlib import Path
+from typing import Dict, List, Optional
+
+# Max number of hot keys kept in the access log
+MAX_HOT_KEYS = 10000
+
+# Weight of the saved counts when merging with new counts, old accesses fade out
+_DECAY = 0.5
+
+# Seconds between saves of the counts in memory, so a crash loses little
+_SAVE_INTERVAL = 60.0
+
+_NUMBERED_KEY = re.compile(r"^(.*?)(\d+)$")
+
+
+def neighbor_keys(k: str, n: int) -> List[str]:
+    """
+    Get the next n keys of a key ending with a number, such as `page9` -> `page10`,
+    zero padded numbers keep their width, such as `part-009` -> `part-010`.
+    """
+    match = _NUMBERED_KEY.match(k)
+    if match is None or n <= 0:
+        return []
+    prefix, digits = match.groups()
+    number = int(digits)
+    width = len(digits) if digits.startswith("0") else 0
+    return [f"{prefix}{str(number + i).zfill(width)}" for i in range(1, n + 1)]
+
+
+class AccessLog:
+    """
+    Compact log of hot keys. Accesses are counted in memory and merged into the
+    log file on `save()`, which also runs every save_interval seconds of recording.
+    Only the hottest keys are kept, both in memory and in the file, and the counts
+    in the file decay once for each process saving it.
+
+    Args:
+        file: the log file
+        max_keys: max number of keys kept in the file
+        save_interval: seconds between saves while recording
+    """
+
+    def __init__(
+        self,
+        file: Path,
+        max_keys: int = MAX_HOT_KEYS,
+        save_interval: float = _SAVE_INTERVAL,
+    ):
+        self.file = file
+        self.max_keys = max_keys
+        self.save_interval = save_interval
+        self.counts: Counter = Counter()
+        self._lock = threading.Lock()
+        self._decay = _DECAY
+        self._last_save = time.monotonic()
+
+    def record(self, k: str):
+        self.counts[k] += 1
+        if len(self.counts) > 2 * self.max_keys:
+            self._prune()
+        if time.monotonic() - self._last_save >= self.save_interval:
+            self.save()
+
+    def _prune(self):
+        """Keep only the hottest keys in memory"""
+        if not self._lock.acquire(blocking=False):
+            return
+        try:
+            self.counts = Counter(dict(self.counts.most_common(self.max_keys)))
+        finally:
+            self._lock.release()
+
+    def load(self) -> Dict[str, float]:
+        try:
+            with open(self.file, "r", encoding="utf8") as f:
+                return dict(json.load(f)["keys"])
+        except (FileNotFoundError, ValueError, KeyError):
+            return {}
+
+    def _merged(self, counts: Counter, decay: float) -> Dict[str, float]:
+        merged = Counter({k: c * decay for k, c in self.load().items()})
+        merged.update(counts)
+        return dict(merged.most_common(self.max_keys))
+
+    def hot_keys(self, limit: Optional[int] = None) -> List[str]:
+        """Keys ordered by access count, the hottest first"""
+        merged = self._merged(self.counts, 1.0)
+        return sorted(merged, key=merged.__getitem__, reverse=True)[:limit]
+
+    def save(self):
+        """Merge the counts in memory into the log file"""
+        with self._lock:
+            self._last_save = time.monotonic()
+            counts, self.counts = self.counts, Counter()
+            if not counts:
+                return
+            merged = self._merged(counts, self._decay)
+            # later saves of this process only add new counts
+            self._decay = 1.0
+            self._write(merged)
+
+    def _write(self, merged: Dict[str, float]):
+        self.file.parent.mkdir(parents=True, exist_ok=True)
+        tmp = self.file.with_name(f"{self.file.name}.{os.getpid()}.tmp")
+        with open(tmp, "w", encoding="utf8") as f:
+            json.dump({"keys": list(merged.items())}, f, ensure_ascii=False)
+        os.replace(tmp, self.file)
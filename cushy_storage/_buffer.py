@@ -0,0 +1,217 @@
+# Copyright (c) 2023 Zeeland
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# Copyright Owner: Zeeland
+# GitHub Link: https://github.com/Undertone0809/
+# Project Link: https://github.com/Undertone0809/cushy-storage
+# Contact Email: zeeland@foxmail.com
+
+
+import atexit
+import functools
+import threading
+import weakref
+from typing import Any, Callable, ContextManager, Dict, Optional
+
+from cushy_storage.utils.logger import logger
+
+# Marks a key deleted in the buffer
+DELETED = object()
+
+# Returned by `WriteBuffer.get` if the key is not in the buffer
+MISSING = object()
+
+
+def _flush_loop(
+    ref: "weakref.ref[WriteBuffer]", wakeup: threading.Event, interval: float
+):
+    """Flush pending values until the buffer is closed or freed"""
+    while True:
+        wakeup.wait(interval)
+        wakeup.clear()
+        buffer = ref()
+        if buffer is None or buffer._closed:
+            return
+        try:
+            buffer.flush()
+        except Exception:
+            logger.exception("[cushy-storage] Failed to flush pending writes")
+        del buffer
+
+
+def _flush_at_exit(ref: "weakref.ref[WriteBuffer]"):
+    buffer = ref()
+    if buffer is not None:
+        buffer.flush()
+
+
+class WriteBuffer:
+    """
+    Buffer of pending writes for write-behind caches. Writes to the same key are
+    coalesced, only the last value is written. A background thread flushes the
+    buffer every flush_interval seconds, or as soon as max_pending keys are pending.
+    Each value is written while holding the lock of its key, and is served from the
+    buffer until it is written. The thread and the exit hook only hold a weak
+    reference, the thread stops once a buffer which is not closed is freed.
+
+    Args:
+        write: function to write a value to the cache
+        delete: function to delete a key from the cache
+        key_lock: function to get the lock of a key
+        flush_interval: max seconds a write waits before flushing
+        max_pending: number of pending keys which triggers a flush
+    """
+
+    def __init__(
+        self,
+        write: Callable[[str, Any], None],
+        delete: Callable[[str], None],
+        key_lock: Callable[[str], ContextManager],
+        flush_interval: float,
+        max_pending: int,
+    ):
+        self._write = write
+        self._delete = delete
+        self._key_lock = key_lock
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._pending: Dict[str, Any] = {}
+        # values being flushed, they are still served until written
+        self._flushing: Dict[str, Any] = {}
+        self._wakeup = threading.Event()
+        self._thread = None
+        self._at_exit = None
+        self._closed = False
+
+    def __len__(self) -> int:
+        return len(self._pending) + len(self._flushing)
+
+    def _start(self):
+        """Start the flusher thread on first write"""
+        with self._lock:
+            if self._thread is not None or self._closed:
+                return
+            wakeup = self._wakeup
+            ref = weakref.ref(self, lambda _: wakeup.set())
+            self._thread = threading.Thread(
+                target=_flush_loop,
+                args=(ref, wakeup, self.flush_interval),
+                name="cushy-storage-flusher",
+                daemon=True,
+            )
+            self._thread.start()
+            self._at_exit = functools.partial(_flush_at_exit, ref)
+            atexit.register(self._at_exit)
+
+    def put(self, k: str, v: Any):
+        if self._thread is None:
+            self._start()
+        with self._lock:
+            self._pending[k] = v
+            full = len(self._pending) >= self.max_pending
+        if full:
+            self._wakeup.set()
+
+    def delete(self, k: str):
+        self.put(k, DELETED)
+
+    def get(self, k: str) -> Any:
+        """Get the pending value of a key, DELETED or MISSING"""
+        with self._lock:
+            v = self._pending.get(k, MISSING)
+            if v is MISSING:
+                v = self._flushing.get(k, MISSING)
+        return v
+
+    def contains(self, k: str) -> bool:
+        return self.get(k) is not MISSING
+
+    def clear(self):
+        """Discard all pending values"""
+        with self._lock:
+            self._pending.clear()
+            self._flushing.clear()
+
+    def _commit(self, k: str, v: Any):
+        if v is not DELETED:
+            self._write(k, v)
+            return
+        try:
+            self._delete(k)
+        except KeyError:
+            pass
+
+    def flush(self):
+        """
+        Write all pending values to the cache. A value which fails to be written
+        does not stop the others, it is kept to be written by the next flush and the
+        first error is raised at last.
+        """
+        with self._flush_lock:
+            with self._lock:
+                if not self._pending:
+                    return
+                self._flushing, self._pending = self._pending, {}
+            failed: Dict[str, Any] = {}
+            error: Optional[Exception] = None
+            try:
+                for k in list(self._flushing):
+                    with self._key_lock(k):
+                        v = self._flushing.get(k, MISSING)
+                        # skip values already written by flush_key or cleared
+                        if v is MISSING:
+                            continue
+                        try:
+                            self._commit(k, v)
+                        except Exception as e:
+                            failed[k] = v
+                            error = error or e
+                        with self._lock:
+                            self._flushing.pop(k, None)
+            except BaseException:
+                # keep unwritten values unless they are overwritten meanwhile
+                with self._lock:
+                    self._pending = {**failed, **self._flushing, **self._pending}
+                    self._flushing = {}
+                raise
+            if error is not None:
+                with self._lock:
+                    self._pending = {**failed, **self._pending}
+                raise error
+
+    def flush_key(self, k: str):
+        """
+        Write the pending value of a key. It does not wait for a running flush, so
+        it can be called while holding the lock of the key.
+        """
+        with self._key_lock(k):
+            v = self.get(k)
+            if v is MISSING:
+                return
+            self._commit(k, v)
+            with self._lock:
+                if self._pending.get(k, MISSING) is v:
+                    del self._pending[k]
+                self._flushing.pop(k, None)
+
+    def close(self):
+        """Flush pending values and stop the flusher thread"""
+        self._closed = True
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join()
+            atexit.unregister(self._at_exit)
+        self.flush()
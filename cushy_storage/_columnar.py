@@ -0,0 +1,244 @@
+# Copyright (c) 2023 Zeeland
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# Copyright Owner: Zeeland
+# GitHub Link: https://github.com/Undertone0809/
+# Project Link: https://github.com/Undertone0809/cushy-storage
+# Contact Email: zeeland@foxmail.com
+
+
+import uuid
+from array import array
+from typing import Any, Dict, List, Optional, Sequence, Set
+
+# numpy is optional, filters fall back to searching the packed column bytes
+_numpy = None
+_numpy_loaded = False
+
+# fields every ORM object carries, stored once per block instead of per row
+_NAME = "__name__"
+_UNIQUE_ID = "__unique_id__"
+
+# width of a uuid stored as bytes
+_UUID_SIZE = 16
+
+
+def _get_numpy():
+    global _numpy, _numpy_loaded
+    if not _numpy_loaded:
+        try:
+            import numpy
+        except ImportError:
+            numpy = None
+        _numpy, _numpy_loaded = numpy, True
+    return _numpy
+
+
+def _find_all(buf: bytes, needle: bytes) -> List[int]:
+    """Find the indexes of aligned items equal to needle in a packed buffer"""
+    width = len(needle)
+    result = []
+    i = buf.find(needle)
+    while i != -1:
+        if i % width == 0:
+            result.append(i // width)
+            i = buf.find(needle, i + width)
+        else:
+            i = buf.find(needle, (i // width + 1) * width)
+    return result
+
+
+def _find_equal(column: array, value) -> List[int]:
+    np = _get_numpy()
+    if np is not None:
+        items = np.frombuffer(column, dtype=column.typecode)
+        return np.flatnonzero(items == value).tolist()
+    return _find_all(column.tobytes(), array(column.typecode, [value]).tobytes())
+
+
+def _smallest_typecode(typecodes: str, low: int, high: int) -> Optional[str]:
+    """The narrowest array typecode able to store integers from low to high"""
+    for typecode in typecodes:
+        bits = array(typecode).itemsize * 8
+        if typecode.islower():
+            if -(2 ** (bits - 1)) <= low and high < 2 ** (bits - 1):
+                return typecode
+        elif 0 <= low and high < 2**bits:
+            return typecode
+    return None
+
+
+def _encode_column(values: List[Any]):
+    """Pack values into the narrowest typed array if they share a simple type"""
+    types = {type(v) for v in values}
+    if types == {bool}:
+        return "bool", array("B", values)
+    if types == {int}:
+        typecode = _smallest_typecode("bhiq", min(values), max(values))
+        if typecode is not None:
+            return "int", array(typecode, values)
+    if types == {float}:
+        return "float", array("d", values)
+    if types == {str}:
+        # strings are dictionary encoded, each distinct value is stored once
+        codes: Dict[str, int] = {}
+        indexes = [codes.setdefault(v, len(codes)) for v in values]
+        typecode = _smallest_typecode("BHIL", 0, len(codes))
+        return "str", (list(codes), array(typecode, indexes))
+    return "obj", list(values)
+
+
+def _encode_ids(ids: List[str]):
+    """Store uuids as 16 bytes each, or as they are if any is not a canonical uuid"""
+    try:
+        packed = [uuid.UUID(i) for i in ids]
+    except (ValueError, TypeError, AttributeError):
+        return ids
+    if any(str(u) != i for u, i in zip(packed, ids)):
+        return ids
+    return b"".join(u.bytes for u in packed)
+
+
+def _as_number(column: array, value) -> Optional[Any]:
+    """Convert a filter value to the type of a column, None if it can never match"""
+    if not isinstance(value, (bool, int, float)) or value != value:
+        return None
+    if column.typecode == "d":
+        return float(value)
+    if isinstance(value, float) and not value.is_integer():
+        return None
+    value = int(value)
+    if _smallest_typecode(column.typecode, value, value) is None:
+        return None
+    return value
+
+
+class ColumnBlock:
+    """
+    Objects of one class stored column by column. Field names and the class name are
+    stored once, uuids take 16 bytes, numbers are packed into typed arrays and
+    strings are dictionary encoded. Equality filters are evaluated on the packed
+    columns, with numpy if it is installed, without building the rows.
+    """
+
+    def __init__(self, name: str, fields: List[str], ids, columns: List, size: int):
+        self.name = name
+        self.fields = fields
+        self.ids = ids
+        self.columns = columns
+        self.size = size
+
+    @classmethod
+    def from_rows(cls, rows: List[dict]) -> Optional["ColumnBlock"]:
+        """Build a block from the __dict__ of objects, None if they have different
+        fields."""
+        if not rows:
+            return None
+        keys = list(rows[0])
+        if keys[:2] != [_NAME, _UNIQUE_ID] or any(list(row) != keys for row in rows):
+            return None
+        name = rows[0][_NAME]
+        if any(row[_NAME] != name for row in rows):
+            return None
+
+        fields = keys[2:]
+        columns = [_encode_column([row[f] for row in rows]) for f in fields]
+        ids = _encode_ids([row[_UNIQUE_ID] for row in rows])
+        return cls(name, fields, ids, columns, len(rows))
+
+    def __len__(self) -> int:
+        return self.size
+
+    def _unique_id(self, index: int) -> str:
+        if isinstance(self.ids, bytes):
+            start = index * _UUID_SIZE
+            return str(uuid.UUID(bytes=self.ids[start : start + _UUID_SIZE]))
+        return self.ids[index]
+
+    def column(self, field: str, indexes: Optional[List[int]] = None) -> Sequence:
+        """
+        Values of a field, of all rows or the rows at indexes. Packed numeric
+        columns of all rows are returned without copying.
+        """
+        if indexes is None:
+            indexes = range(self.size)
+        if field == _NAME:
+            return [self.name] * len(indexes)
+        if field == _UNIQUE_ID:
+            return [self._unique_id(i) for i in indexes]
+        try:
+            kind, data = self.columns[self.fields.index(field)]
+        except ValueError:
+            raise KeyError(field) from None
+        if kind == "bool":
+            return [bool(data[i]) for i in indexes]
+        if kind == "str":
+            strings, codes = data
+            return [strings[codes[i]] for i in indexes]
+        if isinstance(indexes, range):
+            return data
+        return [data[i] for i in indexes]
+
+    def row(self, index: int) -> dict:
+        row = {_NAME: self.name, _UNIQUE_ID: self._unique_id(index)}
+        for field, (kind, data) in zip(self.fields, self.columns):
+            if kind == "bool":
+                row[field] = bool(data[index])
+            elif kind == "str":
+                row[field] = data[0][data[1][index]]
+            else:
+                row[field] = data[index]
+        return row
+
+    def rows(self) -> List[dict]:
+        return [self.row(i) for i in range(self.size)]
+
+    def _select_one(self, field: str, value) -> Set[int]:
+        if field == _NAME:
+            return set(range(self.size)) if value == self.name else set()
+        if field == _UNIQUE_ID:
+            if not isinstance(self.ids, bytes):
+                return {i for i, v in enumerate(self.ids) if v == value}
+            try:
+                needle = uuid.UUID(value).bytes
+            except (ValueError, TypeError, AttributeError):
+                return set()
+            return set(_find_all(self.ids, needle))
+
+        # raise KeyError for a missing field, as filtering the rows does
+        try:
+            kind, data = self.columns[self.fields.index(field)]
+        except ValueError:
+            raise KeyError(field) from None
+        if kind in ("bool", "int", "float"):
+            number = _as_number(data, value)
+            return set() if number is None else set(_find_equal(data, number))
+        if kind == "str":
+            strings, indexes = data
+            if not isinstance(value, str) or value not in strings:
+                return set()
+            return set(_find_equal(indexes, strings.index(value)))
+        return {i for i, v in enumerate(data) if v == value}
+
+    def select(self, filters: Dict[str, Any]) -> List[int]:
+        """Indexes of the rows equal to all filters"""
+        if not filters:
+            return list(range(self.size))
+        result: Optional[Set[int]] = None
+        for field, value in filters.items():
+            matched = self._select_one(field, value)
+            result = matched if result is None else result & matched
+            if not result:
+                return []
+        return sorted(result)
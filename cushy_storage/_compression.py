@@ -0,0 +1,164 @@
+# Copyright (c) 2023 Zeeland
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# Copyright Owner: Zeeland
+# GitHub Link: https://github.com/Undertone0809/
+# Project Link: https://github.com/Undertone0809/cushy-storage
+# Contact Email: zeeland@foxmail.com
+
+import os
+import threading
+import zlib
+from collections import Counter
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional
+
+# zlib can only reference the last 32KB of history, a bigger dictionary is useless
+ZDICT_MAX_SIZE = 32 * 1024
+
+# FDICT flag of the zlib stream header (RFC 1950)
+_FDICT = 0x20
+
+
+def train_zdict(
+    samples: Iterable[bytes], dict_size: int = ZDICT_MAX_SIZE, segment_size: int = 8
+) -> bytes:
+    """
+    Build a zlib preset dictionary from sample values. Substrings that appear in
+    many different samples are collected, and the most valuable ones are placed at
+    the end of the dictionary, where zlib can reference them with the shortest
+    distances.
+
+    Args:
+        samples: sample values, usually taken from the existing cache
+        dict_size: max size of the dictionary, no more than 32KB
+        segment_size: min length of a substring worth storing in the dictionary
+
+    Returns: the dictionary, which may be empty if samples share nothing
+    """
+    dict_size = min(dict_size, ZDICT_MAX_SIZE)
+    samples: List[bytes] = [s for s in samples if len(s) >= segment_size]
+
+    # count in how many samples each k-gram appears
+    doc_freq = Counter()
+    for sample in samples:
+        doc_freq.update(
+            {
+                sample[i : i + segment_size]
+                for i in range(len(sample) - segment_size + 1)
+            }
+        )
+    threshold = max(2, len(samples) // 10)
+
+    # merge adjacent common k-grams into maximal common segments
+    segments = Counter()
+    for sample in samples:
+        start = None
+        for i in range(len(sample) - segment_size + 1):
+            common = doc_freq[sample[i : i + segment_size]] >= threshold
+            if common and start is None:
+                start = i
+            elif not common and start is not None:
+                segments[sample[start : i + segment_size - 1]] += 1
+                start = None
+        if start is not None:
+            segments[sample[start:]] += 1
+
+    chosen: List[bytes] = []
+    size = 0
+    ranked = sorted(segments.items(), key=lambda x: x[1] * len(x[0]), reverse=True)
+    for segment, _ in ranked:
+        if size >= dict_size:
+            break
+        if any(segment in c for c in chosen):
+            continue
+        chosen.append(segment)
+        size += len(segment)
+
+    # most valuable segments go last, and get truncated last
+    return b"".join(reversed(chosen))[-dict_size:]
+
+
+def get_dict_id(zdict: bytes) -> int:
+    """The dictionary id recorded by zlib in every stream using the dictionary."""
+    return zlib.adler32(zdict)
+
+
+class ZlibDictCompressor:
+    """
+    zlib compressor with trained preset dictionaries. Dictionaries are stored in
+    `path` as `<dict id>.zdict` files, and `current` points to the one used for new
+    values. zlib records the id of the dictionary in each compressed stream, so old
+    values remain readable after a new dictionary is trained, and values written
+    without a dictionary are still plain zlib streams.
+
+    Args:
+        path: the directory to store dictionaries
+    """
+
+    def __init__(self, path: Path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._dicts: Dict[int, bytes] = {}
+        self._current: Optional[bytes] = None
+
+        current = self.path / "current"
+        if current.is_file():
+            self._current = self._load(int(current.read_text().strip()))
+
+    @property
+    def dict_id(self) -> Optional[int]:
+        """id of the dictionary used to compress new values"""
+        return None if self._current is None else get_dict_id(self._current)
+
+    def _load(self, dict_id: int) -> bytes:
+        if dict_id not in self._dicts:
+            with self._lock:
+                file = self.path / f"{dict_id}.zdict"
+                if not file.is_file():
+                    raise ValueError(f"can not found zlib dictionary: {dict_id}")
+                self._dicts[dict_id] = file.read_bytes()
+        return self._dicts[dict_id]
+
+    def add_dict(self, zdict: bytes) -> int:
+        """Save a new dictionary and use it for all later compression."""
+        dict_id = get_dict_id(zdict)
+        self.path.mkdir(parents=True, exist_ok=True)
+        file = self.path / f"{dict_id}.zdict"
+        if not file.is_file():
+            tmp = self.path / f"{dict_id}.zdict.{os.getpid()}.tmp"
+            tmp.write_bytes(zdict)
+            os.replace(tmp, file)
+
+        tmp = self.path / f"current.{os.getpid()}.tmp"
+        tmp.write_text(str(dict_id))
+        os.replace(tmp, self.path / "current")
+
+        with self._lock:
+            self._dicts[dict_id] = zdict
+            self._current = zdict
+        return dict_id
+
+    def compress(self, data: bytes) -> bytes:
+        zdict = self._current
+        if zdict is None:
+            return zlib.compress(data)
+        c = zlib.compressobj(zdict=zdict)
+        return c.compress(data) + c.flush()
+
+    def decompress(self, data: bytes) -> bytes:
+        if len(data) < 6 or not data[1] & _FDICT:
+            return zlib.decompress(data)
+        d = zlib.decompressobj(zdict=self._load(int.from_bytes(data[2:6], "big")))
+        return d.decompress(data) + d.flush()
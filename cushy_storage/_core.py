@@ -17,21 +17,79 @@
 # Project Link: https://github.com/Undertone0809/cushy-storage
 # Contact Email: zeeland@foxmail.com
 
+import atexit
+import contextlib
 import hashlib
+import io
+import itertools
 import json
 import lzma
+import mmap
 import os
 import pickle
+import shutil
 import threading
+import time
+import uuid
+import weakref
 import zlib
 from pathlib import Path
-from typing import Any, Callable, List, MutableMapping, Tuple, Union
+from typing import (
+    Any,
+    BinaryIO,
+    Callable,
+    Dict,
+    ItemsView,
+    Iterable,
+    Iterator,
+    List,
+    MutableMapping,
+    Optional,
+    Tuple,
+    Union,
+    ValuesView,
+)
 
+from cushy_storage._access import AccessLog, neighbor_keys
+from cushy_storage._buffer import DELETED, MISSING, WriteBuffer
+from cushy_storage._compression import ZDICT_MAX_SIZE, ZlibDictCompressor, train_zdict
+from cushy_storage._frame import (
+    MAGIC,
+    FrameReader,
+    FrameWriter,
+    decode_frame,
+    encode_frame,
+    is_frame,
+    read_frame_range,
+)
+from cushy_storage._integrity import (
+    FOOTER_SIZE,
+    ChecksumError,
+    LimitedReader,
+    add_checksum,
+    append_checksum,
+    footer_size,
+    strip_checksum,
+)
+from cushy_storage._journal import (
+    Journal,
+    JournalCompacted,
+    Record,
+    fold_changes,
+    read_delta,
+    write_delta,
+)
+from cushy_storage._layout import LAYOUTS
+from cushy_storage._memory import MemoryTier
+from cushy_storage._snapshot import Snapshot
+from cushy_storage._tiers import LOW_WATERMARK, DiskTier, TierEntry
 from cushy_storage.base import BASE_TYPE, EnhancedList
+from cushy_storage.stats import CacheStats
 from cushy_storage.utils import get_default_cache_path
-from cushy_storage.utils.logger import logger
+from cushy_storage.utils.executor import parallel_map, read_ahead, submit
+from cushy_storage.utils.logger import log_manager, logger
 
-__all__ = ["BaseDict", "CushyDict", "disk_cache"]
+__all__ = ["BaseDict", "CushyDict", "disk_cache", "sync"]
 
 # Compression algorithms and their corresponding functions
 _COMPRESS = {
@@ -59,8 +117,122 @@ _SERIALIZATION = {
     ),
 }
 
-# Locks for each hash value (hexadecimal representation of 0-255)
-_LOCKS = {hex(i)[2:].zfill(2): threading.Lock() for i in range(256)}
+# Values larger than this are split into independently compressed chunks
+_DEFAULT_CHUNK_SIZE = 4 * 1024 * 1024
+
+# Directory under the cache path to store cache metadata, it is not a key shard
+_META_DIR = ".cushy"
+
+# Directories under the metadata directory to store namespaces and the files
+# waiting to be removed in background
+_NAMESPACES_DIR = "namespaces"
+_TRASH_DIR = "trash"
+
+# Layout of new caches, see `cushy_storage._layout`
+_DEFAULT_LAYOUT = "prefix"
+
+# Directory under the metadata directory to stage values when migrating layout
+_MIGRATING_DIR = "migrating"
+
+# Directory under the metadata directory to store snapshots
+_SNAPSHOTS_DIR = "snapshots"
+
+# Directory under the metadata directory to store values by content hash
+_OBJECTS_DIR = "objects"
+
+# Directory under the metadata directory to move corrupted values to
+_QUARANTINE_DIR = "quarantine"
+
+# File under the metadata directory to store options of the cache
+_CONFIG_FILE = "config.json"
+
+# Files under the metadata directory to record changes, and the sequence numbers
+# of the caches copied to this cache
+_JOURNAL_FILE = "journal"
+_SYNC_FILE = "sync.json"
+
+# Number of values in a batch when exporting and importing changes, and number of
+# batches read ahead in parallel
+_DELTA_BATCH = 256
+_READ_AHEAD_BATCHES = 4
+
+# Temporary files older than this are left by crashed writers
+_STALE_TMP_SECONDS = 3600
+
+# Locks for each hash value (hexadecimal representation of 0-255). They are
+# reentrant, so a read-modify-write can hold the lock while getting and setting.
+_LOCKS = {hex(i)[2:].zfill(2): threading.RLock() for i in range(256)}
+
+# Cross-process locks of each lock file, shared by all caches in the process
+_FILE_LOCKS: Dict[str, "_FileLock"] = {}
+_FILE_LOCKS_LOCK = threading.Lock()
+
+# Seconds between two checks of tier capacities
+_REBALANCE_INTERVAL = 10.0
+
+# Seconds between two checks of the change journal, each check is one stat
+_WATCH_INTERVAL = 0.1
+
+# Default value of optional arguments, None can be a valid value
+_MISSING = object()
+
+# Default time and size budget of the write-behind buffer
+_DEFAULT_FLUSH_INTERVAL = 1.0
+_DEFAULT_MAX_PENDING = 1000
+
+
+def _save_access_log(ref: "weakref.ref[BaseDict]"):
+    cache = ref()
+    if cache is not None:
+        cache.save_access_log()
+
+
+def _rebalance_loop(ref: "weakref.ref[BaseDict]", stop: threading.Event):
+    """Demote cold values of a tiered cache until the cache is closed or freed"""
+    while not stop.wait(_REBALANCE_INTERVAL):
+        cache = ref()
+        if cache is None:
+            return
+        try:
+            cache.rebalance()
+        except Exception:
+            logger.exception("[cushy-storage] Failed to rebalance tiers")
+        del cache
+
+
+def _watch_loop(ref: "weakref.ref[BaseDict]", stop: threading.Event):
+    """Apply changes of other writers until the cache is closed or freed"""
+    while not stop.wait(_WATCH_INTERVAL):
+        cache = ref()
+        if cache is None:
+            return
+        try:
+            cache.refresh()
+        except Exception:
+            logger.exception("[cushy-storage] Failed to read the change journal")
+        del cache
+
+
+def _link_shard(job: Tuple[Path, Path]):
+    """Hard link all files of a key shard into a snapshot"""
+    src, dst = job
+    try:
+        entries = list(os.scandir(src))
+    except FileNotFoundError:
+        return
+    dst.mkdir()
+    for entry in entries:
+        try:
+            os.link(entry.path, dst / entry.name)
+        except FileNotFoundError:
+            # removed by a process not sharing the locks
+            pass
+
+
+def _empty_trash(trash: Path):
+    """Remove everything in the trash, including what is left by other processes"""
+    for name in os.listdir(trash):
+        shutil.rmtree(trash / name, ignore_errors=True)
 
 
 def _method_convert_helper(
@@ -77,9 +249,117 @@ def _method_convert_helper(
 
 
 class BaseDict(MutableMapping[str, bytes]):
+    """
+    BaseDict stores bytes values in files under the cache path, each key is a file.
+
+    Args:
+        path (str): The path where the cache files will be stored.
+        compress (Union[str, Tuple[Callable, Callable], None]): The compression method
+            to use. Can be a string ("zlib" or "lzma"), a tuple of two functions
+            (compress, decompress), or None. Defaults to None.
+        chunk_size (Optional[int]): Compressed values larger than chunk_size are
+            split into chunks which are compressed and decompressed in parallel.
+            None means never split values. Defaults to 4MB.
+        use_mmap (bool): Return read-only memoryview over memory-mapped files
+            instead of bytes when getting values of an uncompressed cache. The file
+            is shared with other processes through the page cache without copy.
+            Defaults to False.
+        stats (bool): Collect counters and latency histograms in `self.stats`.
+            Defaults to False.
+        process_lock (bool): Also lock keys across processes with lock files, so
+            atomic operations are safe when several processes share the cache.
+            Defaults to False.
+        write_behind (bool): Queue writes in memory and write them in a background
+            thread, repeated writes to a key are coalesced. Reads are served from
+            the pending writes. Call `flush()` or `close()` to write them at once.
+            Defaults to False.
+        flush_interval (float): Max seconds a write is pending in write-behind
+            mode. Defaults to 1.
+        max_pending (int): Number of pending keys which triggers a flush in
+            write-behind mode. Defaults to 1000.
+        memory_items (int): Keep up to memory_items recently used values in an
+            in-memory LRU tier. 0 means no memory tier. Defaults to 0.
+        access_log (bool): Record hot keys in a compact access log, which is used
+            by `warm()` to prefetch them after a restart. Defaults to False.
+        prefetch_neighbors (int): After reading a key ending with a number, such
+            as `page9`, prefetch the next prefetch_neighbors keys (`page10`, ...)
+            in background. Defaults to 0.
+        dedup (bool): Store each distinct value once under its content hash, keys
+            with the same value are hard links to it. Values no longer used by any
+            key are removed by `gc()`. Defaults to False.
+        checksum (bool): Store a crc32 checksum with each value and verify it on
+            read, `ChecksumError` is raised for corrupted or truncated values. It is
+            recorded in the cache, so the cache always uses checksum once enabled,
+            and existing values are given checksum when it is enabled. Defaults to
+            False.
+        capacity (Optional[int]): Max bytes of values stored under path, the least
+            recently used values are demoted to `tiers` in background when it is
+            exceeded. None means unlimited. Defaults to None.
+        tiers (Optional[List[Tuple[str, Optional[int]]]]): Slower directories below
+            path, ordered from fast to slow, each with its capacity in bytes. Values
+            read from a slower tier are promoted to path, and values over the
+            capacity of the slowest tier are evicted. Defaults to None.
+        journal (bool): Record changed keys in an append-only journal, so
+            `export_delta()` and `sync()` copy only the keys changed since the last
+            copy. The journal keeps about the last 32MB to 64MB of changes, a copy
+            from an older position copies all keys. It is recorded in the cache
+            like checksum. Defaults to False.
+        watch (bool): Tail the change journal in background, and drop values
+            changed by other processes or cache objects from the memory tier. Use
+            `subscribe()` to be notified of the changes. It enables journal.
+            Defaults to False.
+        layout (Optional[str]): How keys are stored in shard directories, "prefix"
+            uses the first two characters of a key as its shard, "hash" spreads
+            keys over 256 shards by their hash, which stays balanced when keys
+            share a prefix. It is recorded in the cache, None means the recorded
+            layout or "prefix". Use `migrate_layout()` to change the layout of an
+            existing cache. Defaults to None.
+    """
+
     def __init__(
-        self, path: str, compress: Union[str, Tuple[Callable, Callable], None] = None
+        self,
+        path: str,
+        compress: Union[str, Tuple[Callable, Callable], None] = None,
+        chunk_size: Optional[int] = _DEFAULT_CHUNK_SIZE,
+        use_mmap: bool = False,
+        stats: bool = False,
+        process_lock: bool = False,
+        write_behind: bool = False,
+        flush_interval: float = _DEFAULT_FLUSH_INTERVAL,
+        max_pending: int = _DEFAULT_MAX_PENDING,
+        memory_items: int = 0,
+        access_log: bool = False,
+        prefetch_neighbors: int = 0,
+        dedup: bool = False,
+        checksum: bool = False,
+        capacity: Optional[int] = None,
+        tiers: Optional[List[Tuple[str, Optional[int]]]] = None,
+        journal: bool = False,
+        watch: bool = False,
+        layout: Optional[str] = None,
     ):
+        log_manager.install_exception_hook()
+        # options to open namespaces of the cache
+        self._init_options = dict(
+            compress=compress,
+            chunk_size=chunk_size,
+            use_mmap=use_mmap,
+            stats=stats,
+            process_lock=process_lock,
+            write_behind=write_behind,
+            flush_interval=flush_interval,
+            max_pending=max_pending,
+            memory_items=memory_items,
+            access_log=access_log,
+            prefetch_neighbors=prefetch_neighbors,
+            dedup=dedup,
+            checksum=checksum,
+            capacity=capacity,
+            tiers=tiers,
+            journal=journal,
+            watch=watch,
+            layout=layout,
+        )
         self.path = Path(path)
         if self.path.is_file():
             raise Exception(
@@ -87,10 +367,91 @@ class BaseDict(MutableMapping[str, bytes]):
             )  # Raise an exception if the path already exists as a file
         self.path.mkdir(parents=True, exist_ok=True)
         self.dirs = set()
-        self.compress, self.decompress = _method_convert_helper(compress, _COMPRESS)
+        self._zlib: Optional[ZlibDictCompressor] = None
+        if compress == "zlib":
+            self._zlib = ZlibDictCompressor(self.path / _META_DIR / "zdict")
+            self.compress, self.decompress = self._zlib.compress, self._zlib.decompress
+        else:
+            self.compress, self.decompress = _method_convert_helper(compress, _COMPRESS)
+        self._compressed = compress is not None
+        self.chunk_size = chunk_size
+        self.use_mmap = use_mmap and not self._compressed
+        self._tmp_dir = self.path / _META_DIR / "tmp"
+        self.stats: Optional[CacheStats] = CacheStats() if stats else None
+        self._lock_dir: Optional[Path] = None
+        if process_lock:
+            self._lock_dir = self.path / _META_DIR / "locks"
+            self._lock_dir.mkdir(parents=True, exist_ok=True)
+        self._write_buffer: Optional[WriteBuffer] = None
+        if write_behind:
+            self._write_buffer = WriteBuffer(
+                self._set_buffered,
+                self._delete,
+                self._stripe,
+                flush_interval,
+                max_pending,
+            )
+        # memory-mapped values are already shared through the page cache
+        self._memory: Optional[MemoryTier] = None
+        if memory_items and not self.use_mmap:
+            self._memory = MemoryTier(memory_items)
+        self._access_file = self.path / _META_DIR / "access_log"
+        self._access: Optional[AccessLog] = None
+        if access_log:
+            self._access = AccessLog(self._access_file)
+            atexit.register(_save_access_log, weakref.ref(self))
+        self.prefetch_neighbors = prefetch_neighbors
+        self._objects: Optional[Path] = None
+        if dedup:
+            self._objects = self.path / _META_DIR / _OBJECTS_DIR
+        config = self._read_config()
+        self.checksum = checksum or config.get("checksum", False)
+        self._journal: Optional[Journal] = None
+        if journal or watch or config.get("journal", False):
+            self._journal = Journal(self.path / _META_DIR / _JOURNAL_FILE)
+        recorded = config.get("layout")
+        if layout is not None and layout != (recorded or _DEFAULT_LAYOUT):
+            if recorded is not None or self._shards():
+                raise ValueError(
+                    f"the cache uses the {recorded or _DEFAULT_LAYOUT} layout, use "
+                    f"migrate_layout() to change it"
+                )
+        self._layout = LAYOUTS[layout or recorded or _DEFAULT_LAYOUT]
+        self._primary = DiskTier(self.path, capacity, self._layout)
+        self._tiers = [DiskTier(Path(p), c, self._layout) for p, c in tiers or ()]
+        if self.checksum and not config.get("checksum", False):
+            # values must have checksum once it is recorded, so values written
+            # before are given checksum before recording it
+            self._add_checksums()
+        self._update_config(compress, self.checksum, self._journal is not None, layout)
+        self._subscribers: List[Callable[[str, str], None]] = []
+        self._watch_lock = threading.Lock()
+        self._watch_seq = 0
+        self._watcher: Optional[threading.Event] = None
+        if watch:
+            self._watch_seq = self._journal.seq()
+            self._watcher = threading.Event()
+            threading.Thread(
+                target=_watch_loop,
+                args=(weakref.ref(self), self._watcher),
+                name="cushy-storage-watch",
+                daemon=True,
+            ).start()
+        # last access time of values read since the cache is opened, older values
+        # are ranked by their modified time when choosing values to demote
+        self._last_access: Dict[str, float] = {}
+        self._rebalancer: Optional[threading.Event] = None
+        if capacity is not None or any(t.capacity is not None for t in self._tiers):
+            self._rebalancer = threading.Event()
+            threading.Thread(
+                target=_rebalance_loop,
+                args=(weakref.ref(self), self._rebalancer),
+                name="cushy-storage-tiers",
+                daemon=True,
+            ).start()
 
         logger.info(
-            f"[cushy-storage] Initialized cache, path: {path}, compress: {compress}"
+            "[cushy-storage] Initialized cache, path: %s, compress: %s", path, compress
         )
 
     def __contains__(self, k: str):
@@ -109,52 +470,1912 @@ class BaseDict(MutableMapping[str, bytes]):
             else:
                 print("[my_key] not in my cache")
         """
-        return (self.path / k[:2] / (k[2:] + "_")).is_file()
+        buffer = self._write_buffer
+        if buffer is not None:
+            v = buffer.get(k)
+            if v is not MISSING:
+                return v is not DELETED
+        if self._file(k).is_file():
+            return True
+        return any(tier.file(k).is_file() for tier in self._tiers)
 
     def __getitem__(self, k: str):
         """
         Retrieve the cached item using its key and decompress it
         """
-        if k not in self:
-            raise KeyError(k)
-        rk = hashlib.md5(k.encode("utf8")).hexdigest()[:2]
-        with _LOCKS[rk]:
-            with open(self.path / k[:2] / (k[2:] + "_"), "rb") as f:
+        if self._access is not None:
+            self._access.record(k)
+        buffer = self._write_buffer
+        if buffer is not None:
+            v = buffer.get(k)
+            if v is not MISSING:
+                if self.stats is not None:
+                    self.stats.incr("misses" if v is DELETED else "hits")
+                if v is DELETED:
+                    raise KeyError(k)
+                return self._from_buffer(v)
+        return self._get(k)
+
+    def _get(self, k: str):
+        """Get the value of a key from the memory tier or its file"""
+        v = self._load(k)
+        if self.prefetch_neighbors:
+            self._prefetch_neighbors(k)
+        return v
+
+    def _load(self, k: str):
+        """Get the value of a key from the memory tier, or read it into the tier"""
+        memory = self._memory
+        if memory is None:
+            return self._read(k)
+        v = memory.get(k)
+        if v is not None:
+            if self.stats is not None:
+                self.stats.incr("hits")
+                self.stats.incr("memory_hits")
+            return v
+        # hold the lock of the key, so an older value never replaces a newer one
+        with self._stripe(k):
+            v = self._read(k)
+            memory.put(k, v)
+        return v
+
+    def _read(self, k: str):
+        """Read the value of a key from its file"""
+        if self.use_mmap:
+            return self.view(k)
+        stats = self.stats
+        if stats is None:
+            # open the file directly, checking its existence first is another stat
+            with self._stripe(k):
+                try:
+                    f = self._open(k)
+                except FileNotFoundError:
+                    raise KeyError(k) from None
+                with f:
+                    t = f.read()
+            return self._decode(t)
+
+        start = time.perf_counter()
+        with self._stripe(k):
+            t0 = time.perf_counter()
+            try:
+                f = self._open(k)
+            except FileNotFoundError:
+                stats.incr("misses")
+                raise KeyError(k) from None
+            with f:
                 t = f.read()
-        return self.decompress(t)
+            stats.record("io_read", time.perf_counter() - t0)
+        t0 = time.perf_counter()
+        v = self._decode(t)
+        end = time.perf_counter()
+        stats.record("decompress", end - t0)
+        stats.record("get", end - start)
+        stats.incr("hits")
+        stats.incr("bytes_read", len(t))
+        stats.incr("raw_bytes_read", len(v))
+        return v
 
     def __setitem__(self, k: str, v: bytes):
         """
         Compress the value and store it in the cache using its key
         """
-        if k[:2] not in self.dirs:
-            (self.path / k[:2]).mkdir(exist_ok=True)
-            self.dirs.add(k[:2])
-        t = self.compress(v)
-        rk = hashlib.md5(k.encode("utf8")).hexdigest()[:2]
-        with _LOCKS[rk]:
-            with open(self.path / k[:2] / (k[2:] + "_"), "wb") as f:
-                f.write(t)
+        if self._write_buffer is not None:
+            self._write_buffer.put(k, self._to_buffer(v))
+            return
+        self._set(k, v)
+
+    def _to_buffer(self, v):
+        """Convert a value to what the write buffer keeps, so a value which can not
+        be stored fails in `__setitem__` instead of the flush"""
+        return v
+
+    def _from_buffer(self, v):
+        """Get the value from what the write buffer keeps"""
+        return v
+
+    def _set_buffered(self, k: str, v):
+        """Write a value kept by the write buffer"""
+        self._set(k, v)
+
+    def _set(self, k: str, v: bytes):
+        """Write the value of a key to its file"""
+        stats = self.stats
+        if stats is None:
+            if self._objects is not None:
+                self._commit(k, self._link_object(v)[0])
+                return
+            tmp = self._tmp_file()
+            with open(tmp, "wb") as f:
+                f.write(self._encode(v))
+            self._commit(k, tmp)
+            return
+
+        start = time.perf_counter()
+        if self._objects is not None:
+            tmp, written = self._link_object(v)
+            self._commit(k, tmp)
+            stats.record("set", time.perf_counter() - start)
+            stats.incr("sets")
+            if written:
+                stats.incr("bytes_written", written)
+                stats.incr("raw_bytes_written", len(v))
+            else:
+                stats.incr("dedup_hits")
+            return
+
+        t = self._encode(v)
+        t0 = time.perf_counter()
+        stats.record("compress", t0 - start)
+        tmp = self._tmp_file()
+        with open(tmp, "wb") as f:
+            f.write(t)
+        self._commit(k, tmp)
+        end = time.perf_counter()
+        stats.record("io_write", end - t0)
+        stats.record("set", end - start)
+        stats.incr("sets")
+        stats.incr("bytes_written", len(t))
+        stats.incr("raw_bytes_written", len(v))
+
+    def _check_value(self, v: bytes):
+        """Check a decoded value, raise an exception if it is invalid"""
+
+    def _verify_shard(self, a: str) -> Tuple[int, int, List[Tuple[str, str]]]:
+        checked, size, corrupted = 0, 0, []
+        for entry in os.scandir(self.path / a):
+            if not entry.is_file():
+                continue
+            k = self._layout.key(a, entry.name)
+            try:
+                with open(entry.path, "rb") as f:
+                    t = f.read()
+            except FileNotFoundError:
+                continue
+            checked += 1
+            size += len(t)
+            try:
+                self._check_value(self._decode(t))
+            except Exception as e:
+                corrupted.append((k, f"{type(e).__name__}: {e}"))
+        return checked, size, corrupted
+
+    def verify(self) -> Dict[str, Any]:
+        """
+        Check all values of the cache in parallel across key shards. A value is
+        corrupted if its checksum does not match, or it can not be decompressed or
+        deserialized.
+
+        Returns: a report with the number of checked values and bytes, the corrupted
+            keys with their errors, the seconds spent and the throughput in bytes
+            per second
+
+        Examples:
+            from cushy_storage import CushyDict
+
+            cache = CushyDict("./cache", compress="zlib", checksum=True)
+            report = cache.verify()
+            for k, error in report["corrupted"]:
+                print(k, error)
+        """
+        self._sync()
+        start = time.perf_counter()
+        checked, size, corrupted = 0, 0, []
+        for n, b, bad in parallel_map(self._verify_shard, self._shards()):
+            checked += n
+            size += b
+            corrupted += bad
+        seconds = time.perf_counter() - start
+        return {
+            "checked": checked,
+            "bytes": size,
+            "corrupted": sorted(corrupted),
+            "seconds": seconds,
+            "throughput": size / seconds if seconds > 0 else 0.0,
+        }
+
+    def repair(self) -> Dict[str, Any]:
+        """
+        Verify the cache, move corrupted values to `.cushy/quarantine`, remove
+        temporary files left by crashed writers and rebuild indexes stored in the
+        cache.
+
+        Run it when no other process is writing to the cache.
+
+        Returns: the report of `verify()`, with the number of quarantined values,
+            removed temporary files and names of rebuilt indexes
+        """
+        report = self.verify()
+        quarantine = (
+            self.path / _META_DIR / _QUARANTINE_DIR / time.strftime("%Y%m%d-%H%M%S")
+        )
+        for k, error in report["corrupted"]:
+            dest = self._layout.file(quarantine, k)
+            dest.parent.mkdir(parents=True, exist_ok=True)
+            with self._stripe(k):
+                try:
+                    os.replace(self._file(k), dest)
+                except FileNotFoundError:
+                    continue
+                if self._memory is not None:
+                    self._memory.discard(k)
+                if self._journal is not None:
+                    self._journal.record("del", k)
+            logger.warning("[cushy-storage] Quarantined %s: %s", k, error)
+        report["quarantined"] = len(report["corrupted"])
+
+        report["removed_tmp"] = self._remove_stale_tmp()
+        report["rebuilt"] = self._rebuild_index()
+        return report
+
+    def _add_checksums(self) -> int:
+        """Append the checksum footer to all values written without checksum"""
+        roots = []
+        for tier in [self._primary, *self._tiers]:
+            roots.append(tier.path)
+            try:
+                names = os.listdir(tier.path / _META_DIR / _SNAPSHOTS_DIR)
+            except FileNotFoundError:
+                names = []
+            roots += [tier.path / _META_DIR / _SNAPSHOTS_DIR / n for n in names]
+        files = [
+            DiskTier(root, None, self._layout).file(e.key)
+            for root in roots
+            for e in DiskTier(root, None, self._layout).iter_entries()
+        ]
+        if self._objects is not None:
+            for root, _, names in os.walk(self._objects):
+                files += [Path(root) / n for n in names]
+
+        # files of deduplicated values and snapshots are hard links to one inode
+        seen = set()
+        todo = []
+        for file in files:
+            st = file.stat()
+            if (st.st_dev, st.st_ino) not in seen:
+                seen.add((st.st_dev, st.st_ino))
+                todo.append(file)
+
+        def add(file: Path) -> bool:
+            with open(file, "rb") as f:
+                if footer_size(f, strict=False):
+                    return False
+            append_checksum(file)
+            return True
+
+        return sum(parallel_map(add, todo))
+
+    def _remove_stale_tmp(self) -> int:
+        """Remove temporary files left by crashed writers"""
+        removed = 0
+        if self._tmp_dir.is_dir():
+            now = time.time()
+            for entry in os.scandir(self._tmp_dir):
+                if now - entry.stat().st_mtime > _STALE_TMP_SECONDS:
+                    os.unlink(entry.path)
+                    removed += 1
+        return removed
+
+    def _rebuild_index(self) -> List[str]:
+        """Rebuild indexes stored in the cache after repair, return their names"""
+        return []
+
+    def _link_object(self, v: bytes) -> Tuple[Path, int]:
+        """
+        Get a temporary file linked to the stored value with the same content, the
+        value is stored first if it does not exist.
+
+        Returns: the temporary file and the number of bytes written
+        """
+        digest = hashlib.sha256(v).hexdigest()
+        obj = self._objects / digest[:2] / digest[2:]
+        tmp = self._tmp_file()
+        try:
+            os.link(obj, tmp)
+            return tmp, 0
+        except FileNotFoundError:
+            pass
+
+        t = self._encode(v)
+        with open(tmp, "wb") as f:
+            f.write(t)
+        obj.parent.mkdir(parents=True, exist_ok=True)
+        try:
+            os.link(tmp, obj)
+        except FileExistsError:
+            pass
+        return tmp, len(t)
+
+    def gc(self) -> int:
+        """
+        Remove stored values which are not used by any key in dedup mode. Each
+        value is a hard link shared by its keys, so a value is unused when it has
+        no other link.
+
+        Returns: the number of removed values
+        """
+        objects = self.path / _META_DIR / _OBJECTS_DIR
+        if not objects.is_dir():
+            return 0
+
+        def collect(shard: os.DirEntry) -> int:
+            removed = 0
+            for entry in os.scandir(shard.path):
+                if os.stat(entry.path).st_nlink <= 1:
+                    os.unlink(entry.path)
+                    removed += 1
+            return removed
+
+        removed = sum(parallel_map(collect, os.scandir(objects)))
+        logger.info("[cushy-storage] Removed %s unused values", removed)
+        return removed
+
+    def compact(self, recompress: bool = False) -> Dict[str, int]:
+        """
+        Reclaim disk space: remove temporary files left by crashed writers, the
+        trash, unused values of dedup mode and empty shard directories.
+
+        Args:
+            recompress: also compress values under path again with the current
+                compression, for example after `train_compression_dict()`, and keep
+                the new value if it is smaller
+
+        Returns: the number of removed temporary files, unused values and empty
+            shards, and the number of recompressed values and saved bytes
+        """
+        self._sync()
+        report = {"removed_tmp": self._remove_stale_tmp()}
+        trash = self.path / _META_DIR / _TRASH_DIR
+        if trash.is_dir():
+            _empty_trash(trash)
+        report["removed_unused"] = self.gc()
+        removed = 0
+        for tier in [self._primary, *self._tiers]:
+            for a in tier.shards():
+                try:
+                    # writers create the shard again if it is removed
+                    os.rmdir(tier.path / a)
+                except OSError:
+                    continue
+                removed += 1
+                self.dirs.discard(a)
+        report["removed_shards"] = removed
+        report["recompressed"], report["saved_bytes"] = 0, 0
+        if recompress and self._compressed:
+            for n, saved in parallel_map(self._recompress_shard, self._shards()):
+                report["recompressed"] += n
+                report["saved_bytes"] += saved
+        logger.info("[cushy-storage] Compacted %s: %s", self.path, report)
+        return report
+
+    def _recompress_shard(self, a: str) -> Tuple[int, int]:
+        count, saved = 0, 0
+        key = self._layout.key
+        for name in os.listdir(self.path / a):
+            k = key(a, name)
+            with self._stripe(k):
+                file = self._file(k)
+                try:
+                    # values shared by hard links in dedup mode are kept
+                    if os.stat(file).st_nlink > 1:
+                        continue
+                    with open(file, "rb") as f:
+                        t = f.read()
+                except FileNotFoundError:
+                    continue
+                new = self._encode(self._decode(t))
+                if len(new) >= len(t):
+                    continue
+                tmp = self._tmp_file()
+                with open(tmp, "wb") as f:
+                    f.write(new)
+                self._commit(k, tmp)
+            count += 1
+            saved += len(t) - len(new)
+        return count, saved
+
+    def evict(
+        self, max_bytes: Optional[int] = None, max_age: Optional[float] = None
+    ) -> int:
+        """
+        Remove values under path which are not modified for max_age seconds, then
+        the least recently used values until values under path take at most
+        max_bytes.
+
+        Args:
+            max_bytes: max bytes of values under path, None means unlimited
+            max_age: max seconds since a value is modified, None means unlimited
+
+        Returns: the number of removed keys
+        """
+        self._sync()
+        now = time.time()
+        removed = 0
+        kept = []
+        for e in self._primary.iter_entries():
+            if max_age is not None and now - e.mtime > max_age:
+                removed += self._discard(e.key)
+            elif max_bytes is not None:
+                kept.append(e)
+        if max_bytes is not None:
+            total = sum(e.size for e in kept)
+            kept.sort(key=lambda e: self._last_access.get(e.key, e.mtime))
+            for e in kept:
+                if total <= max_bytes:
+                    break
+                removed += self._discard(e.key)
+                total -= e.size
+        logger.info("[cushy-storage] Evicted %s keys from %s", removed, self.path)
+        return removed
+
+    def _discard(self, k: str) -> bool:
+        """Remove a key if it exists, return whether it is removed"""
+        try:
+            self._delete(k)
+            return True
+        except KeyError:
+            return False
+
+    def migrate_layout(self, layout: str) -> int:
+        """
+        Move all values to another layout, see the layout argument of the cache.
+        Values are moved into a staging directory and the layout is switched when
+        all values are moved, so an interrupted migration is finished by running it
+        again. Snapshots must be deleted first, and no other process may use the
+        cache while migrating.
+
+        Args:
+            layout: the new layout, "prefix" or "hash"
+
+        Returns: the number of moved values
+        """
+        new = LAYOUTS[layout]
+        if self.snapshots():
+            raise ValueError("delete snapshots before migrating the layout")
+        self._sync()
+        if self._memory is not None:
+            self._memory.clear()
+        old = self._layout
+        tiers = [self._primary, *self._tiers]
+        moved = 0
+        if old is not new:
+            for tier in tiers:
+                staging = tier.path / _META_DIR / _MIGRATING_DIR
+                for a in tier.shards():
+                    for name in os.listdir(tier.path / a):
+                        k = old.key(a, name)
+                        dest = new.file(staging, k)
+                        dest.parent.mkdir(parents=True, exist_ok=True)
+                        os.replace(tier.path / a / name, dest)
+                        moved += 1
+                    os.rmdir(tier.path / a)
+            # values are all staged, record the new layout before moving them back
+            self._update_config(None, self.checksum, layout=new.name)
+        for tier in tiers:
+            staging = tier.path / _META_DIR / _MIGRATING_DIR
+            if staging.is_dir():
+                for a in os.listdir(staging):
+                    os.replace(staging / a, tier.path / a)
+                os.rmdir(staging)
+            tier.layout = new
+        self._layout = new
+        self.dirs.clear()
+        logger.info("[cushy-storage] Moved %s values to the %s layout", moved, layout)
+        return moved
 
     def __delitem__(self, k: str):
         """
         Remove the cached item using its key
         """
-        os.remove(self.path / k[:2] / (k[2:] + "_"))
+        if self._write_buffer is not None:
+            with self._stripe(k):
+                if k not in self:
+                    raise KeyError(k)
+                self._write_buffer.delete(k)
+            return
+        self._delete(k)
+
+    def _delete(self, k: str):
+        """Remove the file of a key"""
+        with self._stripe(k):
+            if self._memory is not None:
+                self._memory.discard(k)
+            found = False
+            for tier in [self._primary, *self._tiers]:
+                try:
+                    os.remove(tier.file(k))
+                    found = True
+                except FileNotFoundError:
+                    pass
+            if not found:
+                raise KeyError(k)
+            self._last_access.pop(k, None)
+            if self._journal is not None:
+                self._journal.record("del", k)
+        if self.stats is not None:
+            self.stats.incr("deletes")
 
     def __len__(self):
         """
         Get the total number of items in the cache
         """
-        return sum([len(os.listdir(self.path / a)) for a in os.listdir(self.path)])
+        self._sync()
+        if self._tiers:
+            keys = set(self._primary.keys())
+            for tier in self._tiers:
+                keys.update(tier.keys())
+            return len(keys)
+        return sum([len(os.listdir(self.path / a)) for a in self._shards()])
 
     def __iter__(self):
         """
         Iterate over all keys in the cache
         """
-        for a in os.listdir(self.path):
+        self._sync()
+        key = self._layout.key
+        for a in self._shards():
             for b in os.listdir(self.path / a):
-                yield a + b[:-1]
+                yield key(a, b)
+        if self._tiers:
+            seen = set(self._primary.keys())
+            for tier in self._tiers:
+                for k in tier.keys():
+                    if k not in seen:
+                        seen.add(k)
+                        yield k
+
+    def items(self) -> ItemsView:
+        """
+        Get a view of all keys and values, keys deleted while iterating are skipped.
+        Use `snapshot()` for a consistent view of a cache changed while iterating.
+        """
+        return _ItemsView(self)
+
+    def values(self) -> ValuesView:
+        """Get a view of all values, keys deleted while iterating are skipped"""
+        return _ValuesView(self)
+
+    def entries(self) -> Iterator[TierEntry]:
+        """
+        Iterate over all keys with the stored size, modified time and shard
+        directory of their values, by scanning shard directories without reading
+        values. It is streamed, so it works on caches with millions of keys.
+        """
+        self._sync()
+        yield from self._primary.iter_entries()
+        if self._tiers:
+            seen = set(self._primary.keys())
+            for tier in self._tiers:
+                for e in tier.iter_entries():
+                    if e.key not in seen:
+                        seen.add(e.key)
+                        yield e
+
+    def flush(self):
+        """Write all pending writes of write-behind mode"""
+        if self._write_buffer is not None:
+            self._write_buffer.flush()
+
+    def close(self):
+        """Write all pending writes and stop write-behind mode, stop stats exporters,
+        and save the access log"""
+        if self._write_buffer is not None:
+            self._write_buffer.close()
+            self._write_buffer = None
+        if self._rebalancer is not None:
+            self._rebalancer.set()
+            self._rebalancer = None
+        if self._watcher is not None:
+            self._watcher.set()
+            self._watcher = None
+        if self.stats is not None:
+            self.stats.close()
+        self.save_access_log()
+
+    def clear(self):
+        """
+        Remove all keys. Each key shard directory is renamed away in one step and
+        removed in background, which is much faster than deleting keys one by one.
+        Namespaces are not removed.
+        """
+        if self._write_buffer is not None:
+            self._write_buffer.clear()
+        if self._memory is not None:
+            self._memory.clear()
+        for a in self._shards():
+            self._trash(self.path / a)
+        for tier in self._tiers:
+            for a in tier.shards():
+                self._trash(tier.path / a, tier.path)
+        self._last_access.clear()
+        self.dirs.clear()
+        if self._journal is not None:
+            self._journal.record("clear", "")
+
+    def delete_prefix(self, prefix: str):
+        """
+        Remove all keys starting with prefix. Only the key shard of the prefix is
+        scanned, and whole shards are removed at once if the prefix is shorter than
+        the shard name.
+
+        Args:
+            prefix: the prefix of keys
+
+        Examples:
+            from cushy_storage import CushyDict
+
+            cache = CushyDict("./cache")
+            cache.delete_prefix("session:42:")
+        """
+        if not prefix:
+            return self.clear()
+        self._sync()
+        if self._memory is not None:
+            for k in [k for k in self._memory.keys() if k.startswith(prefix)]:
+                self._memory.discard(k)
+
+        if self._layout.name != "prefix":
+            # keys with the prefix are in all shards
+            for k in [k for k in self if k.startswith(prefix)]:
+                try:
+                    self._delete(k)
+                except KeyError:
+                    pass
+            return
+
+        if len(prefix) < 2:
+            for tier in [self._primary, *self._tiers]:
+                for a in tier.shards():
+                    if a.startswith(prefix):
+                        self._trash(tier.path / a, tier.path)
+                        self.dirs.discard(a)
+            if self._journal is not None:
+                self._journal.record("prefix", prefix)
+            return
+
+        names = set()
+        for tier in [self._primary, *self._tiers]:
+            try:
+                names.update(os.listdir(tier.path / prefix[:2]))
+            except FileNotFoundError:
+                pass
+        rest = prefix[2:]
+        for name in names:
+            if name.startswith(rest):
+                try:
+                    self._delete(prefix[:2] + name[:-1])
+                except KeyError:
+                    pass
+
+    def _trash(self, path: Path, root: Optional[Path] = None):
+        """Rename a file or directory into the trash and remove it in background.
+        The trash is under root, which must be on the same file system as path."""
+        trash = (root or self.path) / _META_DIR / _TRASH_DIR
+        trash.mkdir(parents=True, exist_ok=True)
+        try:
+            os.replace(path, trash / uuid.uuid4().hex)
+        except FileNotFoundError:
+            return
+        submit(_empty_trash, trash)
+
+    def _namespace_dir(self, name: str) -> Path:
+        if not name or name in (".", "..") or "/" in name or "\\" in name:
+            raise ValueError(f"invalid namespace name: {name!r}")
+        return self.path / _META_DIR / _NAMESPACES_DIR / name
+
+    def namespace(self, name: str) -> "BaseDict":
+        """
+        Open a namespace of the cache, which is a separate cache with the same
+        options stored under this cache. Keys of a namespace are not keys of this
+        cache. A namespace is stored in a directory tagged with its generation, so
+        `drop_namespace()` only needs to switch to a new generation.
+
+        Args:
+            name: the name of the namespace
+
+        Examples:
+            from cushy_storage import CushyDict
+
+            cache = CushyDict("./cache")
+            tenant = cache.namespace("tenant42")
+            tenant["user"] = {"name": "jack"}
+            cache.drop_namespace("tenant42")
+        """
+        ns_dir = self._namespace_dir(name)
+        current = ns_dir / "current"
+        try:
+            generation = current.read_text().strip()
+        except FileNotFoundError:
+            ns_dir.mkdir(parents=True, exist_ok=True)
+            tmp = ns_dir / f"current.{uuid.uuid4().hex}.tmp"
+            tmp.write_text(uuid.uuid4().hex[:12])
+            # keep the generation created by others if it exists
+            try:
+                os.link(tmp, current)
+            except FileExistsError:
+                pass
+            tmp.unlink()
+            generation = current.read_text().strip()
+        options = self._init_options
+        if self._tiers:
+            sub_dir = ns_dir.relative_to(self.path) / generation
+            tiers = [(str(t.path / sub_dir), t.capacity) for t in self._tiers]
+            options = dict(options, tiers=tiers)
+        return type(self)(str(ns_dir / generation), **options)
+
+    def namespaces(self) -> List[str]:
+        """Get the names of all namespaces"""
+        try:
+            names = os.listdir(self.path / _META_DIR / _NAMESPACES_DIR)
+        except FileNotFoundError:
+            return []
+        root = self.path / _META_DIR / _NAMESPACES_DIR
+        return sorted(n for n in names if (root / n / "current").is_file())
+
+    def drop_namespace(self, name: str):
+        """
+        Remove a namespace and all its keys. The namespace is switched to a new empty
+        generation by renaming one file, and the old generation is removed in
+        background. Objects opened by `namespace()` before are not usable anymore.
+        """
+        ns_dir = self._namespace_dir(name)
+        current = ns_dir / "current"
+        try:
+            generation = current.read_text().strip()
+        except FileNotFoundError:
+            raise KeyError(name) from None
+        new_generation = uuid.uuid4().hex[:12]
+        tmp = ns_dir / f"current.{uuid.uuid4().hex}.tmp"
+        tmp.write_text(new_generation)
+        os.replace(tmp, current)
+        self._trash(ns_dir / generation)
+        # old generations written by objects opened before are garbage too
+        for entry in os.scandir(ns_dir):
+            if entry.is_dir() and entry.name != new_generation:
+                self._trash(Path(entry.path))
+        sub_dir = ns_dir.relative_to(self.path)
+        for tier in self._tiers:
+            try:
+                entries = list(os.scandir(tier.path / sub_dir))
+            except FileNotFoundError:
+                continue
+            for entry in entries:
+                if entry.is_dir() and entry.name != new_generation:
+                    self._trash(Path(entry.path), tier.path)
+
+    def save_access_log(self):
+        """Merge the hot keys recorded in memory into the access log"""
+        if self._access is not None:
+            self._access.save()
+
+    def prefetch(self, keys: Iterable[str]) -> int:
+        """
+        Prefetch values in parallel into the memory tier, or into the OS page cache
+        if there is no memory tier. Keys which do not exist are skipped.
+
+        Args:
+            keys: keys to prefetch
+
+        Returns: the number of prefetched keys
+        """
+        memory = self._memory
+
+        def fetch(k: str) -> bool:
+            try:
+                if memory is not None:
+                    if k not in memory:
+                        self._load(k)
+                    return True
+                with self._open(k) as f:
+                    if hasattr(os, "posix_fadvise"):
+                        os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_WILLNEED)
+                    else:
+                        while f.read(_DEFAULT_CHUNK_SIZE):
+                            pass
+                return True
+            except (KeyError, FileNotFoundError):
+                return False
+
+        return sum(parallel_map(fetch, keys))
+
+    def _prefetch_neighbors(self, k: str):
+        keys = neighbor_keys(k, self.prefetch_neighbors)
+        if self._memory is not None:
+            keys = [n for n in keys if n not in self._memory]
+        if keys:
+            submit(self.prefetch, keys)
+
+    def warm(self, limit: Optional[int] = None, neighbors: int = 0) -> int:
+        """
+        Prefetch the hot keys recorded in the access log, usually called at startup
+        to avoid paying cold-disk latency for the hot set.
+
+        Args:
+            limit: max number of hot keys to prefetch, all recorded keys by default
+            neighbors: also prefetch the next neighbors keys of each hot key ending
+                with a number, for scan patterns like `page1`, `page2`, ...
+
+        Returns: the number of prefetched keys
+
+        Examples:
+            from cushy_storage import CushyDict
+
+            cache = CushyDict("./cache", memory_items=10000, access_log=True)
+            cache.warm(limit=5000)
+        """
+        keys = AccessLog(self._access_file).hot_keys(limit)
+        if neighbors:
+            keys = list(
+                dict.fromkeys(
+                    n for k in keys for n in [k, *neighbor_keys(k, neighbors)]
+                )
+            )
+        count = self.prefetch(keys)
+        logger.info("[cushy-storage] Warmed up %s keys", count)
+        return count
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def _sync(self, k: Optional[str] = None):
+        """Flush pending writes before reading files directly"""
+        buffer = self._write_buffer
+        if buffer is None:
+            return
+        if k is None:
+            buffer.flush()
+        else:
+            buffer.flush_key(k)
+
+    def _sync_shared(self, k: str):
+        """
+        Flush the pending write of a key if the cache is shared by processes, which
+        only see values written to files. It is called while holding the lock of the
+        key, so atomic updates of other processes are not lost.
+        """
+        if self._lock_dir is not None:
+            self._sync(k)
+
+    def _file(self, k: str) -> Path:
+        """Get the file path of the key"""
+        return self._layout.file(self.path, k)
+
+    def _open(self, k: str) -> BinaryIO:
+        """Open the file of a key in the fastest tier which has it, the value is
+        promoted in background if it is found in a slower tier. FileNotFoundError is
+        raised if no tier has it."""
+        try:
+            f = open(self._file(k), "rb")
+        except FileNotFoundError:
+            for tier in self._tiers:
+                try:
+                    f = open(tier.file(k), "rb")
+                except FileNotFoundError:
+                    continue
+                submit(self._promote, k, tier)
+                return f
+            raise
+        if self._tiers or self._primary.capacity is not None:
+            self._last_access[k] = time.time()
+        return f
+
+    def _promote(self, k: str, tier: DiskTier):
+        """Move a value read from a slower tier to the cache path"""
+        with self._stripe(k):
+            src = tier.file(k)
+            if self._file(k).is_file():
+                # the value is set again since it is read, the old one is garbage
+                src.unlink(missing_ok=True)
+                return
+            try:
+                self._primary.move_in(k, src)
+            except FileNotFoundError:
+                return
+            self.dirs.add(self._layout.shard(k))
+            self._last_access[k] = time.time()
+        if self.stats is not None:
+            self.stats.incr("promotions")
+
+    def rebalance(self) -> Dict[str, int]:
+        """
+        Demote the least recently used values of each tier over its capacity to the
+        next slower tier, until the tier is below 90% of its capacity. Values over
+        the capacity of the slowest tier are evicted. It runs in background every
+        few seconds if any capacity is set.
+
+        Returns: the number of demoted and evicted values
+        """
+        self._sync()
+        tiers = [self._primary, *self._tiers]
+        result = {"demoted": 0, "evicted": 0}
+        for i, tier in enumerate(tiers):
+            entries = tier.scan()
+            if i == 0:
+                stored = {e.key for e in entries}
+                for k in [k for k in self._last_access if k not in stored]:
+                    self._last_access.pop(k, None)
+            total = sum(e.size for e in entries)
+            if tier.capacity is None or total <= tier.capacity:
+                continue
+            last_access = self._last_access if i == 0 else {}
+            entries.sort(key=lambda e: last_access.get(e.key, e.mtime))
+            target = tier.capacity * LOW_WATERMARK
+            lower = tiers[i + 1] if i + 1 < len(tiers) else None
+            for e in entries:
+                if total <= target:
+                    break
+                with self._stripe(e.key):
+                    try:
+                        if lower is None:
+                            os.remove(tier.file(e.key))
+                            if self._memory is not None:
+                                self._memory.discard(e.key)
+                            if self._journal is not None:
+                                self._journal.record("del", e.key)
+                        else:
+                            lower.move_in(e.key, tier.file(e.key))
+                    except FileNotFoundError:
+                        continue
+                    if i == 0:
+                        self._last_access.pop(e.key, None)
+                total -= e.size
+                result["evicted" if lower is None else "demoted"] += 1
+        if self.stats is not None:
+            self.stats.incr("demotions", result["demoted"])
+            self.stats.incr("evictions", result["evicted"])
+        if any(result.values()):
+            logger.info("[cushy-storage] Rebalanced tiers: %s", result)
+        return result
+
+    @staticmethod
+    def _lock_key(k: str) -> str:
+        """Get the key of the lock which protects the key"""
+        return hashlib.md5(k.encode("utf8")).hexdigest()[:2]
+
+    def _stripe(self, k: str):
+        """Get the lock which protects the key"""
+        return self._lock(self._lock_key(k))
+
+    def _lock(self, rk: str):
+        """Get the lock of a lock key"""
+        lock = _LOCKS[rk]
+        if self._lock_dir is not None:
+            lock = _FileLock.get(lock, self._lock_dir / rk)
+        if self.stats is None:
+            return lock
+        return _TimedLock(lock, self.stats, rk)
+
+    def _tmp_file(self) -> Path:
+        """Get a new temporary file, values are written to it before commit"""
+        if not self._tmp_dir.is_dir():
+            self._tmp_dir.mkdir(parents=True, exist_ok=True)
+        return self._tmp_dir / uuid.uuid4().hex
+
+    def _commit(self, k: str, tmp: Path):
+        """Atomically replace the value of the key with the temporary file"""
+        shard = self._layout.shard(k)
+        if shard not in self.dirs:
+            (self.path / shard).mkdir(exist_ok=True)
+            self.dirs.add(shard)
+        with self._stripe(k):
+            try:
+                os.replace(tmp, self._file(k))
+            except FileNotFoundError:
+                # the shard may be removed by clear() of another cache object
+                (self.path / shard).mkdir(exist_ok=True)
+                os.replace(tmp, self._file(k))
+            if self._memory is not None:
+                self._memory.discard(k)
+            if self._journal is not None:
+                self._journal.record("set", k)
+
+    def _read_config(self) -> Dict[str, Any]:
+        try:
+            with open(self.path / _META_DIR / _CONFIG_FILE, encoding="utf8") as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return {}
+
+    def _update_config(
+        self,
+        compress,
+        checksum: bool,
+        journal: bool = False,
+        layout: Optional[str] = None,
+        serialize: Optional[str] = None,
+        kind: Optional[str] = None,
+    ):
+        """Record options needed to read the cache without the code which wrote it"""
+        config = self._read_config()
+        new_config = dict(config)
+        if layout is not None:
+            new_config["layout"] = layout
+        if serialize is not None:
+            new_config["serialize"] = serialize
+        if kind is not None:
+            new_config["kind"] = kind
+        if isinstance(compress, str):
+            new_config["compress"] = compress
+        if checksum:
+            new_config["checksum"] = True
+        if journal:
+            new_config["journal"] = True
+        if new_config == config:
+            return
+        file = self.path / _META_DIR / _CONFIG_FILE
+        file.parent.mkdir(parents=True, exist_ok=True)
+        tmp = file.with_name(f"{_CONFIG_FILE}.{uuid.uuid4().hex}.tmp")
+        with open(tmp, "w", encoding="utf8") as f:
+            json.dump(new_config, f)
+        os.replace(tmp, file)
+
+    def _encode(self, v: bytes) -> bytes:
+        """Compress the value, large values are compressed in parallel chunks"""
+        if self._compressed and self.chunk_size and len(v) > self.chunk_size:
+            t = encode_frame(v, self.compress, self.chunk_size)
+        else:
+            t = self.compress(v)
+        return add_checksum(t) if self.checksum else t
+
+    def _from_stored(self, t: bytes):
+        """Get the value from its stored bytes"""
+        return self._decode(t)
+
+    def _decode(self, t: bytes) -> bytes:
+        """Decompress the value stored in the cache"""
+        if self.checksum:
+            t = strip_checksum(t)
+        if self._compressed and is_frame(t):
+            return decode_frame(t, self.decompress)
+        return self.decompress(t)
+
+    def read_range(self, k: str, offset: int, size: int) -> bytes:
+        """
+        Read part of a value. Only the chunks covering the range are read and
+        decompressed if the value is stored in chunks.
+
+        Args:
+            k: key
+            offset: the start position in the original value
+            size: the number of bytes to read
+
+        Examples:
+            from cushy_storage import BaseDict
+
+            cache = BaseDict("./cache", compress="zlib", chunk_size=1024 * 1024)
+            cache["big"] = bytes(100 * 1024 * 1024)
+            header = cache.read_range("big", 0, 128)
+        """
+        self._sync(k)
+        with self._stripe(k):
+            try:
+                f = self._open(k)
+            except FileNotFoundError:
+                raise KeyError(k) from None
+            with f:
+                if self._compressed and is_frame(f.read(len(MAGIC))):
+                    tail = footer_size(f) if self.checksum else 0
+                    return read_frame_range(f, offset, size, self.decompress, tail)
+                f.seek(0)
+                t = f.read()
+        return self._decode(t)[offset : offset + size]
+
+    def view(self, k: str) -> memoryview:
+        """
+        Get a read-only memoryview over the memory-mapped file of a value without
+        copying it. Only uncompressed values can be viewed. The view keeps the old
+        value if the key is overwritten, because values are replaced atomically.
+
+        Args:
+            k: key
+
+        Examples:
+            from cushy_storage import BaseDict
+
+            cache = BaseDict("./cache")
+            cache["blob"] = bytes(1024 * 1024)
+            view = cache.view("blob")
+            print(view[:16].tobytes())
+        """
+        self._sync(k)
+        if self._compressed:
+            raise ValueError("memory-mapped view is only supported without compress")
+        with self._stripe(k):
+            try:
+                f = self._open(k)
+            except FileNotFoundError:
+                if self.stats is not None:
+                    self.stats.incr("misses")
+                raise KeyError(k) from None
+        with f:
+            size = os.fstat(f.fileno()).st_size
+            if self.stats is not None:
+                self.stats.incr("hits")
+                self.stats.incr("bytes_read", size)
+                self.stats.incr("raw_bytes_read", size)
+            if size == 0 and not self.checksum:
+                return memoryview(b"")
+            if self.checksum and size < FOOTER_SIZE:
+                raise ChecksumError("checksum is missing, the value is truncated")
+            view = memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+            return strip_checksum(view) if self.checksum else view
+
+    def open_reader(self, k: str) -> BinaryIO:
+        """
+        Open a value as a readable binary file. Values stored in chunks are read and
+        decompressed chunk by chunk, so large values can be read at constant memory.
+
+        Args:
+            k: key
+
+        Examples:
+            import shutil
+            from cushy_storage import BaseDict
+
+            cache = BaseDict("./cache", compress="zlib")
+            with cache.open_reader("artifact") as reader:
+                with open("artifact.bin", "wb") as f:
+                    shutil.copyfileobj(reader, f)
+        """
+        self._sync(k)
+        with self._stripe(k):
+            try:
+                f = self._open(k)
+            except FileNotFoundError:
+                raise KeyError(k) from None
+        try:
+            tail = footer_size(f) if self.checksum else 0
+        except ChecksumError:
+            f.close()
+            raise
+        f.seek(0)
+        if not self._compressed:
+            if tail:
+                size = os.fstat(f.fileno()).st_size - tail
+                return io.BufferedReader(LimitedReader(f, size))
+            return f
+        if is_frame(f.read(len(MAGIC))):
+            return io.BufferedReader(FrameReader(f, self.decompress, tail=tail))
+        f.seek(0)
+        with f:
+            return io.BytesIO(self._decode(f.read()))
+
+    def open_writer(self, k: str) -> "_ValueWriter":
+        """
+        Open a writable binary file to store a value. Compressed values are written
+        in chunks, so large values can be written at constant memory. The value is
+        atomically committed when the writer is closed, it is discarded if an
+        exception is raised in the with statement.
+
+        Args:
+            k: key
+
+        Examples:
+            import shutil
+            from cushy_storage import BaseDict
+
+            cache = BaseDict("./cache", compress="zlib")
+            with open("artifact.bin", "rb") as f:
+                with cache.open_writer("artifact") as writer:
+                    shutil.copyfileobj(f, writer)
+        """
+        self._sync(k)
+        return _ValueWriter(self, k)
+
+    def set_from_iter(self, k: str, iterable: Iterable[bytes]):
+        """
+        Store a value from an iterable of bytes at constant memory.
+
+        Args:
+            k: key
+            iterable: the parts of the value
+        """
+        with self.open_writer(k) as writer:
+            for b in iterable:
+                writer.write(b)
+
+    def update_value(self, k: str, fn: Callable[[Any], Any], default=_MISSING) -> Any:
+        """
+        Atomically replace the value of a key with `fn(value)`. The lock of the key is
+        held for the whole operation, so concurrent updates are never lost. It is
+        named update_value because `update` is the method of MutableMapping to set
+        many keys.
+
+        Args:
+            k: key
+            fn: function to compute the new value from the current value
+            default: the current value if the key does not exist, KeyError is
+                raised if it is not specified
+
+        Returns: the new value
+        """
+        with self._stripe(k):
+            self._sync_shared(k)
+            try:
+                v = self[k]
+            except KeyError:
+                if default is _MISSING:
+                    raise
+                v = default
+            v = fn(v)
+            self[k] = v
+            self._sync_shared(k)
+            return v
+
+    def get_version(self, k: str) -> Optional[str]:
+        """
+        Get the version of the value of a key, which changes when the value is
+        changed. None if the key does not exist.
+        """
+        self._sync(k)
+        with self._stripe(k):
+            try:
+                with self._open(k) as f:
+                    return hashlib.md5(f.read()).hexdigest()
+            except FileNotFoundError:
+                return None
+
+    def get_with_version(self, k: str) -> Tuple[Any, str]:
+        """Atomically get the value of a key and its version"""
+        with self._stripe(k):
+            version = self.get_version(k)
+            if version is None:
+                raise KeyError(k)
+            return self[k], version
+
+    def compare_and_set(self, k: str, expected_version: Optional[str], v) -> bool:
+        """
+        Set the value of a key only if its version is still expected_version.
+
+        Args:
+            k: key
+            expected_version: the version got from `get_with_version` or
+                `get_version`, None means the key must not exist
+            v: the new value
+
+        Returns: whether the value is set
+
+        Examples:
+            from cushy_storage import CushyDict
+
+            cache = CushyDict("./cache")
+            while True:
+                state, version = cache.get_with_version("state")
+                state["step"] += 1
+                if cache.compare_and_set("state", version, state):
+                    break
+        """
+        with self._stripe(k):
+            if self.get_version(k) != expected_version:
+                return False
+            self[k] = v
+            self._sync_shared(k)
+            return True
+
+    def snapshot(self) -> Snapshot:
+        """
+        Take a read-only, point-in-time snapshot of the cache. Files of all values
+        are hard linked into `.cushy/snapshots`, which copies no data, and writes of
+        this process wait until it is done. Writes of other processes are included
+        or not as a whole if they use `process_lock=True`. The snapshot is kept
+        until `Snapshot.delete()` is called, or the with statement ends.
+
+        Examples:
+            from cushy_storage import CushyDict
+
+            cache = CushyDict("./cache")
+            with cache.snapshot() as snapshot:
+                total = sum(v["amount"] for v in snapshot.values())
+        """
+        self._sync()
+        name = time.strftime("%Y%m%d-%H%M%S-") + uuid.uuid4().hex[:8]
+        dirs = [t.path / _META_DIR / _SNAPSHOTS_DIR / name for t in self._tiers]
+        dirs.insert(0, self.path / _META_DIR / _SNAPSHOTS_DIR / name)
+        tiers = [self._primary, *self._tiers]
+        jobs = [
+            (tier.path / a, d / a)
+            for tier, d in zip(tiers, dirs)
+            for a in tier.shards()
+        ]
+        with contextlib.ExitStack() as stack:
+            for rk in sorted(_LOCKS):
+                stack.enter_context(self._lock(rk))
+            for d in dirs:
+                d.mkdir(parents=True)
+            parallel_map(_link_shard, jobs)
+        logger.info("[cushy-storage] Took snapshot %s of %s", name, self.path)
+        return Snapshot(self, dirs, self._layout)
+
+    def snapshots(self) -> List[str]:
+        """Get the names of all snapshots, from old to new"""
+        try:
+            return sorted(os.listdir(self.path / _META_DIR / _SNAPSHOTS_DIR))
+        except FileNotFoundError:
+            return []
+
+    def open_snapshot(self, name: str) -> Snapshot:
+        """Open a snapshot taken before by its name"""
+        if name not in self.snapshots():
+            raise KeyError(name)
+        dirs = [self.path / _META_DIR / _SNAPSHOTS_DIR / name]
+        dirs += [t.path / _META_DIR / _SNAPSHOTS_DIR / name for t in self._tiers]
+        return Snapshot(self, dirs, self._layout)
+
+    def subscribe(self, callback: Callable[[str, str], None]):
+        """
+        Call `callback(op, key)` for each change made by other processes or cache
+        objects, op is "set", "del", "clear" (key is empty) or "prefix" (key is the
+        removed prefix). Callbacks run in the background thread of `watch=True`, or
+        in the thread calling `refresh()`.
+
+        Examples:
+            from cushy_storage import CushyDict
+
+            local = {}
+            cache = CushyDict("./cache", watch=True)
+            cache.subscribe(lambda op, k: local.pop(k, None))
+        """
+        if self._journal is None:
+            raise ValueError("subscribe needs the change journal, set watch=True")
+        self._subscribers.append(callback)
+
+    def unsubscribe(self, callback: Callable[[str, str], None]):
+        self._subscribers.remove(callback)
+
+    def refresh(self) -> int:
+        """
+        Apply the changes made by other processes or cache objects since the last
+        refresh at once: drop them from the memory tier and notify subscribers. It
+        runs every 0.1 seconds with `watch=True`, call it to see changes earlier.
+
+        Returns: the number of applied changes
+        """
+        journal = self._journal
+        if journal is None:
+            return 0
+        with self._watch_lock:
+            if journal.seq() <= self._watch_seq:
+                return 0
+            try:
+                changes, self._watch_seq = journal.read(self._watch_seq)
+            except JournalCompacted:
+                # missed changes may have changed any key
+                self._watch_seq = journal.seq()
+                changes = [("clear", "", "")]
+        memory = self._memory
+        count = 0
+        for op, k, writer in changes:
+            if writer == journal.writer:
+                continue
+            count += 1
+            if memory is not None:
+                if op == "clear":
+                    memory.clear()
+                elif op == "prefix":
+                    for key in [key for key in memory.keys() if key.startswith(k)]:
+                        memory.discard(key)
+                else:
+                    # a read holding the lock may be putting the old value
+                    with self._stripe(k):
+                        memory.discard(k)
+            for callback in list(self._subscribers):
+                try:
+                    callback(op, k)
+                except Exception:
+                    logger.exception("[cushy-storage] Failed to notify a change")
+        return count
+
+    @property
+    def journal_id(self) -> Optional[str]:
+        """Id of the change journal, None if the journal is not enabled"""
+        return None if self._journal is None else self._journal.id
+
+    def synced_seq(self, journal_id: str) -> int:
+        """Get the sequence number of the changes of another cache, identified by its
+        journal id, which have been imported to this cache. 0 if none."""
+        try:
+            with open(self.path / _META_DIR / _SYNC_FILE, encoding="utf8") as f:
+                return json.load(f).get(journal_id, 0)
+        except (FileNotFoundError, ValueError):
+            return 0
+
+    def export_delta(self, file: str, since: int = 0) -> int:
+        """
+        Write the keys added, changed or deleted since a sequence number of the
+        change journal to a delta file, which can be imported by `import_delta()`
+        on another node. Each changed key is written once with its stored value,
+        values are read ahead in parallel and written sequentially. since=0 exports
+        all keys, and the delta clears the cache importing it.
+
+        Args:
+            file: the delta file to write
+            since: the sequence number returned by the last export, or
+                `synced_seq()` of the cache importing the delta. All keys are
+                exported if the changes since it are dropped from the journal.
+
+        Returns: the sequence number to export the next delta from
+
+        Examples:
+            from cushy_storage import CushyDict
+
+            cache = CushyDict("./cache", journal=True)
+            seq = cache.export_delta("full.delta")
+            cache["a"] = 1
+            seq = cache.export_delta("a.delta", since=seq)
+
+            replica = CushyDict("./replica")
+            replica.import_delta("full.delta")
+            replica.import_delta("a.delta")
+        """
+        header, records = self._delta(since)
+        tmp = Path(f"{file}.{uuid.uuid4().hex}.tmp")
+        try:
+            with open(tmp, "wb") as f:
+                write_delta(f, header, records)
+            os.replace(tmp, file)
+        finally:
+            tmp.unlink(missing_ok=True)
+        return header["seq"]
+
+    def import_delta(self, file: str) -> Dict[str, Any]:
+        """
+        Apply a delta file written by `export_delta()`. Stored values are copied as
+        they are, so the cache must use the same compress and checksum options as
+        the exporting cache. The sequence number of the delta is recorded, see
+        `synced_seq()`.
+
+        Returns: the journal id and sequence number of the delta, and the number of
+            set and deleted keys
+        """
+        with open(file, "rb") as f:
+            header, records = read_delta(f)
+            return self._apply_delta(header, records)
+
+    def export(self, stream: BinaryIO, parallel: bool = True) -> int:
+        """
+        Write all keys to a binary stream as one sequential archive. Values are
+        written as they are stored, without decompressing and compressing them
+        again, so moving a whole cache runs at the speed of sequential IO instead of
+        copying many small files.
+
+        Args:
+            stream: a writable binary stream, such as a file, a pipe or a socket
+            parallel: read values ahead in parallel, which is faster on SSDs and
+                network file systems
+
+        Returns: the number of exported keys
+
+        Examples:
+            from cushy_storage import CushyDict
+
+            cache = CushyDict("./cache", compress="zlib")
+            with open("cache.archive", "wb") as f:
+                cache.export(f)
+
+            restored = CushyDict("./restored", compress="zlib")
+            with open("cache.archive", "rb") as f:
+                restored.import_(f)
+        """
+        header, records = self._delta(0, clear=False, parallel=parallel)
+        count = 0
+
+        def counted() -> Iterator[Record]:
+            nonlocal count
+            for record in records:
+                count += record[0] == "set"
+                yield record
+
+        write_delta(stream, header, counted())
+        return count
+
+    def import_(self, stream: BinaryIO, parallel: bool = True) -> int:
+        """
+        Import all keys of an archive written by `export()`, existing keys are
+        overwritten and other keys are kept. The cache must use the same compress
+        and checksum options as the exporting cache. It is named import_ because
+        import is a keyword.
+
+        Args:
+            stream: a readable binary stream
+            parallel: write values in parallel batches
+
+        Returns: the number of imported keys
+        """
+        header, records = read_delta(stream)
+        return self._apply_delta(header, records, parallel)["set"]
+
+    def _delta(
+        self, since: int, clear: bool = True, parallel: bool = True
+    ) -> Tuple[Dict[str, Any], Iterator[Record]]:
+        """
+        Get the header and records of the changes since a sequence number, all keys
+        are exported if since is 0.
+
+        Args:
+            since: the sequence number of the journal
+            clear: clear the importing cache before importing all keys
+            parallel: read values ahead on the shared thread pool
+        """
+        journal = self._journal
+        if journal is None and since:
+            raise ValueError("export_delta needs the change journal, set journal=True")
+        self._sync()
+        full = journal is None or not journal.start <= since <= journal.seq()
+        if not full:
+            try:
+                changes, seq = journal.read(since)
+                cleared, prefixes, keys = fold_changes(changes)
+            except JournalCompacted:
+                full = True
+        if full:
+            # changes while exporting are exported again by the next delta
+            seq = 0 if journal is None else journal.seq()
+            cleared, prefixes, keys = clear, [], None
+        header = {
+            "journal": None if journal is None else journal.id,
+            "since": 0 if full else since,
+            "seq": seq,
+            "compress": self._read_config().get("compress"),
+            "checksum": self.checksum,
+        }
+
+        def records() -> Iterator[Record]:
+            zdict_dir = self.path / _META_DIR / "zdict"
+            if zdict_dir.is_dir():
+                for zdict in sorted(zdict_dir.glob("*.zdict")):
+                    yield "zdict", zdict.name, zdict.read_bytes()
+            if cleared:
+                yield "clear", "", None
+            for prefix in prefixes:
+                yield "prefix", prefix, None
+            todo = sorted(self) if keys is None else keys
+            if parallel:
+                # keep a window of batches read while earlier values are written
+                batches = [
+                    todo[i : i + _DELTA_BATCH]
+                    for i in range(0, len(todo), _DELTA_BATCH)
+                ]
+                values = itertools.chain.from_iterable(
+                    read_ahead(self._read_batch, batches, _READ_AHEAD_BATCHES)
+                )
+            else:
+                values = map(self._read_stored, todo)
+            for k, t in zip(todo, values):
+                if t is None:
+                    yield "del", k, None
+                else:
+                    yield "set", k, t
+
+        return header, records()
+
+    def _read_batch(self, keys: List[str]) -> List[Optional[bytes]]:
+        return [self._read_stored(k) for k in keys]
+
+    def _read_stored(self, k: str) -> Optional[bytes]:
+        """Read the stored value of a key without decoding it, None if not found"""
+        with self._stripe(k):
+            for tier in [self._primary, *self._tiers]:
+                try:
+                    with open(tier.file(k), "rb") as f:
+                        return f.read()
+                except FileNotFoundError:
+                    pass
+        return None
+
+    def _apply_delta(
+        self, header: Dict[str, Any], records: Iterable[Record], parallel: bool = True
+    ) -> Dict[str, Any]:
+        """Apply the records of changes, and record the sequence number. Values are
+        written in parallel batches if parallel."""
+        config = self._read_config()
+        compress = config.get("compress")
+        if compress is not None and compress != header["compress"]:
+            raise ValueError(
+                f"can not import values compressed by {header['compress']} to a "
+                f"cache compressed by {compress}"
+            )
+        if self.checksum and not header["checksum"]:
+            raise ValueError("can not import values without checksum")
+        if header["checksum"] and not self.checksum:
+            self.checksum = True
+            self._add_checksums()
+        self._update_config(
+            header["compress"], self.checksum, self._journal is not None
+        )
+
+        self._sync()
+        result = {"journal": header["journal"], "seq": header["seq"], "set": 0}
+        result["deleted"] = 0
+        pending: List[Tuple[str, bytes]] = []
+        pending_size = 0
+
+        def write(item: Tuple[str, bytes]):
+            tmp = self._tmp_file()
+            with open(tmp, "wb") as f:
+                f.write(item[1])
+            self._commit(item[0], tmp)
+
+        def write_pending():
+            nonlocal pending_size
+            if parallel:
+                parallel_map(write, pending)
+            else:
+                for item in pending:
+                    write(item)
+            result["set"] += len(pending)
+            pending.clear()
+            pending_size = 0
+
+        for op, k, data in records:
+            if op == "set":
+                # keys are unique in a delta, so a batch can be written in any order
+                pending.append((k, data))
+                pending_size += len(data)
+                if len(pending) >= _DELTA_BATCH or pending_size >= _DEFAULT_CHUNK_SIZE:
+                    write_pending()
+                continue
+            write_pending()
+            if op == "del":
+                try:
+                    self._delete(k)
+                    result["deleted"] += 1
+                except KeyError:
+                    pass
+            elif op == "clear":
+                self.clear()
+            elif op == "prefix":
+                self.delete_prefix(k)
+            elif op == "zdict":
+                zdict = self.path / _META_DIR / "zdict" / k
+                if not zdict.is_file():
+                    zdict.parent.mkdir(parents=True, exist_ok=True)
+                    tmp = self._tmp_file()
+                    tmp.write_bytes(data)
+                    os.replace(tmp, zdict)
+        write_pending()
+
+        if header["journal"] is not None:
+            self._record_synced(header["journal"], header["seq"])
+        logger.info("[cushy-storage] Imported delta: %s", result)
+        return result
+
+    def _record_synced(self, journal_id: str, seq: int):
+        """Record the sequence number of another cache imported to this cache"""
+        file = self.path / _META_DIR / _SYNC_FILE
+        with self._stripe(_SYNC_FILE):
+            try:
+                with open(file, encoding="utf8") as f:
+                    synced = json.load(f)
+            except (FileNotFoundError, ValueError):
+                synced = {}
+            synced[journal_id] = seq
+            tmp = self._tmp_file()
+            with open(tmp, "w", encoding="utf8") as f:
+                json.dump(synced, f)
+            os.replace(tmp, file)
+
+    def _shards(self) -> List[str]:
+        """Get all key shard directories, cache metadata is excluded"""
+        return [a for a in os.listdir(self.path) if a != _META_DIR]
+
+    def train_compression_dict(
+        self, sample_size: int = 1000, dict_size: int = ZDICT_MAX_SIZE
+    ) -> int:
+        """
+        Train a shared zlib dictionary from existing values and use it to compress
+        all later values. It can greatly improve the compression ratio of many small
+        values with similar structure, such as small json documents. The dictionary
+        is stored with the cache, values compressed before and after training are
+        both readable.
+
+        Args:
+            sample_size: the number of existing values used for training
+            dict_size: max size of the dictionary, no more than 32KB
+
+        Returns: the id of the new dictionary
+
+        Examples:
+            from cushy_storage import CushyDict
+
+            cache = CushyDict("./cache", compress="zlib")
+            for i in range(10000):
+                cache[f"user{i}"] = {"name": f"user{i}", "age": i, "role": "member"}
+            cache.train_compression_dict()
+        """
+        if self._zlib is None:
+            raise ValueError("compression dictionary is only supported by 'zlib'")
+
+        samples = []
+        for k in self:
+            if len(samples) >= sample_size:
+                break
+            samples.append(BaseDict._get(self, k))
+
+        zdict = train_zdict(samples, dict_size)
+        if not zdict:
+            raise ValueError("can not train compression dictionary from samples")
+        dict_id = self._zlib.add_dict(zdict)
+        logger.info("[cushy-storage] Trained compression dictionary: %s", dict_id)
+        return dict_id
+
+
+class _ItemsView(ItemsView):
+    def __iter__(self):
+        for k in self._mapping:
+            try:
+                yield k, self._mapping[k]
+            except KeyError:
+                continue
+
+
+class _ValuesView(ValuesView):
+    def __iter__(self):
+        for k in self._mapping:
+            try:
+                yield self._mapping[k]
+            except KeyError:
+                continue
+
+
+class _TimedLock:
+    """Lock which records the time waiting for it"""
+
+    __slots__ = ("_lock", "_stats", "_shard")
+
+    def __init__(self, lock, stats: CacheStats, shard: str):
+        self._lock = lock
+        self._stats = stats
+        self._shard = shard
+
+    def __enter__(self):
+        t0 = time.perf_counter()
+        self._lock.acquire()
+        self._stats.record_lock_wait(self._shard, time.perf_counter() - t0)
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self._lock.release()
+
+
+class _FileLock:
+    """
+    Lock of a key stripe shared across processes. The thread lock of the stripe is
+    acquired first, then the lock file is locked by the outermost acquire, so it is
+    reentrant like the thread lock.
+    """
+
+    def __init__(self, lock: threading.RLock, path: Path):
+        self._lock = lock
+        self._path = path
+        self._fd: Optional[int] = None
+        self._pid: Optional[int] = None
+        self._depth = 0
+
+    @staticmethod
+    def get(lock: threading.RLock, path: Path) -> "_FileLock":
+        key = str(path)
+        file_lock = _FILE_LOCKS.get(key)
+        if file_lock is None:
+            with _FILE_LOCKS_LOCK:
+                file_lock = _FILE_LOCKS.setdefault(key, _FileLock(lock, path))
+        return file_lock
+
+    def acquire(self):
+        self._lock.acquire()
+        if self._depth == 0:
+            try:
+                # a forked process shares the open file and its lock with its
+                # parent, so it needs its own
+                if self._pid != os.getpid():
+                    self._fd = os.open(self._path, os.O_RDWR | os.O_CREAT, 0o644)
+                    self._pid = os.getpid()
+                _lock_file(self._fd)
+            except BaseException:
+                self._lock.release()
+                raise
+        self._depth += 1
+
+    def release(self):
+        self._depth -= 1
+        if self._depth == 0:
+            _unlock_file(self._fd)
+        self._lock.release()
+
+    def __enter__(self):
+        self.acquire()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.release()
+
+
+if os.name == "nt":
+    import msvcrt
+
+    def _lock_file(fd: int):
+        os.lseek(fd, 0, os.SEEK_SET)
+        while True:
+            try:
+                msvcrt.locking(fd, msvcrt.LK_LOCK, 1)
+                return
+            except OSError:
+                # LK_LOCK gives up after 10 seconds, keep waiting like flock
+                continue
+
+    def _unlock_file(fd: int):
+        os.lseek(fd, 0, os.SEEK_SET)
+        msvcrt.locking(fd, msvcrt.LK_UNLCK, 1)
+
+else:
+    import fcntl
+
+    def _lock_file(fd: int):
+        fcntl.flock(fd, fcntl.LOCK_EX)
+
+    def _unlock_file(fd: int):
+        fcntl.flock(fd, fcntl.LOCK_UN)
+
+
+class _ValueWriter:
+    """Writable binary file returned by `BaseDict.open_writer`"""
+
+    def __init__(self, cache: BaseDict, k: str):
+        self._cache = cache
+        self._k = k
+        self._tmp = cache._tmp_file()
+        self._f = open(self._tmp, "wb")
+        self._frame: Optional[FrameWriter] = None
+        if cache._compressed:
+            chunk_size = cache.chunk_size or _DEFAULT_CHUNK_SIZE
+            self._frame = FrameWriter(self._f, cache.compress, chunk_size)
+        self.closed = False
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, b: bytes) -> int:
+        if self._frame is None:
+            return self._f.write(b)
+        return self._frame.write(b)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        """Commit the value"""
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            if self._frame is not None:
+                self._frame.finish()
+            self._f.close()
+            if self._cache.checksum:
+                append_checksum(self._tmp)
+            self._cache._commit(self._k, self._tmp)
+        except BaseException:
+            self._f.close()
+            self._tmp.unlink(missing_ok=True)
+            raise
+
+    def discard(self):
+        """Discard the value without commit"""
+        if self.closed:
+            return
+        self.closed = True
+        self._f.close()
+        self._tmp.unlink(missing_ok=True)
+
+    def __enter__(self) -> "_ValueWriter":
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.discard()
 
 
 class CushyDict(BaseDict):
@@ -165,37 +2386,148 @@ class CushyDict(BaseDict):
     it from the cache.
 
     Args:
-        path (str): The path where the cache files will be stored. Defaults to the
-            default cache path.
+        path (Optional[str]): The path where the cache files will be stored.
+            Defaults to the default cache path, which is created on first use.
         compress (Union[str, Tuple[Callable, Callable], None]): The compression method
             to use. Can be a string ("zlib" or "lzma"), a tuple of two functions
             (compress, decompress), or None. Defaults to None.
         serialize (Union[str, Tuple[Callable, Callable], None]): The serialization
             method to use. Can be a string ("pickle" or "json"), a tuple of two
-            functions (serialize, deserialize), or None. Defaults to "json".
+            functions (serialize, deserialize), or None. A string is recorded in the
+            cache, so command line tools read values with it. Defaults to "json".
+        chunk_size (Optional[int]): Compressed values larger than chunk_size are
+            split into chunks which are compressed and decompressed in parallel.
+            None means never split values. Defaults to 4MB.
+        use_mmap (bool): Deserialize values from memory-mapped files without
+            reading them into bytes, only works without compress. Defaults to False.
+        stats (bool): Collect counters and latency histograms in `self.stats`.
+            Defaults to False.
+        process_lock (bool): Also lock keys across processes with lock files, so
+            atomic operations are safe when several processes share the cache.
+            Defaults to False.
+        write_behind (bool): Queue writes in memory and write them in a background
+            thread, repeated writes to a key are coalesced. Pending values are
+            returned as they are, so they should not be changed after they are set.
+            Defaults to False.
+        flush_interval (float): Max seconds a write is pending in write-behind
+            mode. Defaults to 1.
+        max_pending (int): Number of pending keys which triggers a flush in
+            write-behind mode. Defaults to 1000.
+        memory_items (int): Keep up to memory_items recently used values in an
+            in-memory LRU tier. 0 means no memory tier. Defaults to 0.
+        access_log (bool): Record hot keys in a compact access log, which is used
+            by `warm()` to prefetch them after a restart. Defaults to False.
+        prefetch_neighbors (int): After reading a key ending with a number, such
+            as `page9`, prefetch the next prefetch_neighbors keys (`page10`, ...)
+            in background. Defaults to 0.
+        dedup (bool): Store each distinct value once under its content hash, keys
+            with the same value are hard links to it. Values no longer used by any
+            key are removed by `gc()`. Defaults to False.
+        checksum (bool): Store a crc32 checksum with each value and verify it on
+            read, `ChecksumError` is raised for corrupted or truncated values. It is
+            recorded in the cache, so the cache always uses checksum once enabled,
+            and existing values are given checksum when it is enabled. Defaults to
+            False.
+        capacity (Optional[int]): Max bytes of values stored under path, the least
+            recently used values are demoted to `tiers` in background when it is
+            exceeded. None means unlimited. Defaults to None.
+        tiers (Optional[List[Tuple[str, Optional[int]]]]): Slower directories below
+            path, ordered from fast to slow, each with its capacity in bytes. Values
+            read from a slower tier are promoted to path, and values over the
+            capacity of the slowest tier are evicted. Defaults to None.
+        journal (bool): Record changed keys in an append-only journal, so
+            `export_delta()` and `sync()` copy only the keys changed since the last
+            copy. The journal keeps about the last 32MB to 64MB of changes, a copy
+            from an older position copies all keys. It is recorded in the cache
+            like checksum. Defaults to False.
+        watch (bool): Tail the change journal in background, and drop values
+            changed by other processes or cache objects from the memory tier. Use
+            `subscribe()` to be notified of the changes. It enables journal.
+            Defaults to False.
+        layout (Optional[str]): How keys are stored in shard directories, "prefix"
+            uses the first two characters of a key as its shard, "hash" spreads
+            keys over 256 shards by their hash, which stays balanced when keys
+            share a prefix. It is recorded in the cache, None means the recorded
+            layout or "prefix". Use `migrate_layout()` to change the layout of an
+            existing cache. Defaults to None.
     """
 
     def __init__(
         self,
-        path: str = get_default_cache_path(),
+        path: Optional[str] = None,
         compress: Union[str, Tuple[Callable, Callable], None] = None,
         serialize: Union[str, Tuple[Callable, Callable], None] = "json",
+        chunk_size: Optional[int] = _DEFAULT_CHUNK_SIZE,
+        use_mmap: bool = False,
+        stats: bool = False,
+        process_lock: bool = False,
+        write_behind: bool = False,
+        flush_interval: float = _DEFAULT_FLUSH_INTERVAL,
+        max_pending: int = _DEFAULT_MAX_PENDING,
+        memory_items: int = 0,
+        access_log: bool = False,
+        prefetch_neighbors: int = 0,
+        dedup: bool = False,
+        checksum: bool = False,
+        capacity: Optional[int] = None,
+        tiers: Optional[List[Tuple[str, Optional[int]]]] = None,
+        journal: bool = False,
+        watch: bool = False,
+        layout: Optional[str] = None,
     ):
-        super().__init__(path, compress)
+        if path is None:
+            path = get_default_cache_path()
+        super().__init__(
+            path,
+            compress,
+            chunk_size=chunk_size,
+            use_mmap=use_mmap,
+            stats=stats,
+            process_lock=process_lock,
+            write_behind=write_behind,
+            flush_interval=flush_interval,
+            max_pending=max_pending,
+            memory_items=memory_items,
+            access_log=access_log,
+            prefetch_neighbors=prefetch_neighbors,
+            dedup=dedup,
+            checksum=checksum,
+            capacity=capacity,
+            tiers=tiers,
+            journal=journal,
+            watch=watch,
+            layout=layout,
+        )
+        self._init_options["serialize"] = serialize
         self.serialize, self.deserialize = _method_convert_helper(
             serialize, _SERIALIZATION
         )
+        if isinstance(serialize, str):
+            self._update_config(None, False, serialize=serialize)
 
     def __getitem__(self, k: str) -> Any:
-        logger.info(f"[CushyDict] Try to get item, key: {k}, path: {self.path}")
-        ret = self.deserialize(super().__getitem__(k))
+        logger.debug("[CushyDict] Try to get item, key: %s, path: %s", k, self.path)
+        return super().__getitem__(k)
+
+    def _get(self, k: str) -> Any:
+        return self._from_buffer(super()._get(k))
+
+    def _from_buffer(self, t) -> Any:
+        if isinstance(t, memoryview) and self.deserialize is json.loads:
+            t = t.tobytes()
+        if self.stats is None:
+            ret = self.deserialize(t)
+        else:
+            t0 = time.perf_counter()
+            ret = self.deserialize(t)
+            self.stats.record("deserialize", time.perf_counter() - t0)
 
         if isinstance(ret, list):
             ret: List = EnhancedList(ret)
         return ret
 
     def __setitem__(self, k: str, v: Any):
-        logger.info(f"[CushyDict] Try to set item, key: {k}, path: {self.path}")
+        logger.debug("[CushyDict] Try to set item, key: %s, path: %s", k, self.path)
         if (
             isinstance(v, list)
             and self.deserialize is json.loads
@@ -209,12 +2541,76 @@ class CushyDict(BaseDict):
                     f"use 'pickle' to serialize."
                 )
             )
-        return super().__setitem__(k, self.serialize(v))
+        super().__setitem__(k, v)
+
+    def _check_value(self, v: bytes):
+        self.deserialize(v)
+
+    def _from_stored(self, t: bytes) -> Any:
+        ret = self.deserialize(super()._from_stored(t))
+        if isinstance(ret, list):
+            ret: List = EnhancedList(ret)
+        return ret
+
+    def _to_buffer(self, v: Any) -> bytes:
+        if self.stats is None:
+            return self.serialize(v)
+        t0 = time.perf_counter()
+        t = self.serialize(v)
+        self.stats.record("serialize", time.perf_counter() - t0)
+        return t
+
+    def _set(self, k: str, v: Any):
+        return super()._set(k, self._to_buffer(v))
 
+    def _set_buffered(self, k: str, t: bytes):
+        # values are serialized when they are buffered
+        super()._set(k, t)
 
-def disk_cache(path: str = None, compress: str = None, serialize: str = "json"):
+    def incr(self, k: str, delta: int = 1, default: int = 0):
+        """
+        Atomically add delta to the number stored in a key, the key is set to
+        default + delta if it does not exist.
+
+        Returns: the new value
+
+        Examples:
+            from cushy_storage import CushyDict
+
+            cache = CushyDict("./cache")
+            cache.incr("page_views")
+        """
+        return self.update_value(k, lambda v: v + delta, default)
+
+    def decr(self, k: str, delta: int = 1, default: int = 0):
+        """Atomically subtract delta from the number stored in a key"""
+        return self.update_value(k, lambda v: v - delta, default)
+
+    def append_to(self, k: str, item: Any) -> List:
+        """
+        Atomically append an item to the list stored in a key, the key is set to
+        a new list if it does not exist. Unlike `cache[k].append(item)`, which only
+        changes the list in memory, the list in the cache is changed.
+
+        Returns: the new list
+        """
+        return self.update_value(k, lambda v: EnhancedList(v).append(item), [])
+
+
+def disk_cache(
+    path: str = None,
+    compress: str = None,
+    serialize: str = "json",
+    stats: bool = False,
+    dedup: bool = False,
+    cache: Optional[MutableMapping[str, Any]] = None,
+):
     """
-    Decorator that caches the output of a function to disk
+    Decorator that caches the output of a function to disk. The cache is available
+    as `cached_func.cache`, and its stats as `cached_func.cache.stats` if stats is
+    True. If dedup is True, equal outputs of different calls are stored once, and
+    the arguments of calls are not stored with outputs. Pass an opened cache, such
+    as a `CacheClient` of a shared cache server, to use it instead of path.
     """
     if serialize not in ["pickle", "json"]:
         ValueError("Your serializer must be 'pickle' or 'json'")
@@ -227,7 +2623,11 @@ def disk_cache(path: str = None, compress: str = None, serialize: str = "json"):
             # If no cache path is specified, create a default one based on the
             # function name and serialization algorithm.
             path = f"./_cushycache_{name}_{serialize}"
-        _map = CushyDict(path, serialize=serialize, compress=compress)
+        _map = cache
+        if _map is None:
+            _map = CushyDict(
+                path, serialize=serialize, compress=compress, stats=stats, dedup=dedup
+            )
 
         def cached_func(*args, **kwargs):
             # Serialize the function arguments and use their MD5 hash as the cache key
@@ -236,17 +2636,51 @@ def disk_cache(path: str = None, compress: str = None, serialize: str = "json"):
             ext = "pkl" if serialize == "pickle" else "json"
             filename = f"{md5}.{ext}"
 
-            if filename in _map:
-                # If the cached output exists, return it
+            try:
+                # If the cached output exists, return it, a miss is counted by the
+                # cache. One lookup is one round trip for a remote cache.
                 input_data, output_data = _map[filename]
                 return output_data
-            else:
+            except KeyError:
                 # Otherwise, call the original function and cache its output
                 output_data = func(*args, **kwargs)
-                cache_data = [input_data, output_data]
+                cache_data = [None if dedup else input_data, output_data]
                 _map[filename] = cache_data
                 return output_data
 
+        cached_func.cache = _map
         return cached_func
 
     return decorator
+
+
+def sync(src_path: str, dst_path: str) -> Dict[str, Any]:
+    """
+    Copy the keys changed since the last sync from one cache directory to another,
+    so syncing costs time in proportion to the changes instead of the size of the
+    cache. The source must have the change journal enabled by `journal=True`, so
+    that every writer records its changes. The first sync copies all keys. The
+    destination becomes a copy of the source, its other keys are removed.
+
+    Args:
+        src_path: the path of the source cache
+        dst_path: the path of the destination cache
+
+    Returns: the journal id and sequence number synced to, and the number of set
+        and deleted keys
+
+    Examples:
+        from cushy_storage import sync
+
+        # run periodically to keep a new node warm
+        sync("/mnt/snapshot/cache", "./cache")
+    """
+    src = BaseDict(src_path)
+    if src.journal_id is None:
+        raise ValueError(
+            f"sync needs the change journal of {src_path}, open it with journal=True"
+        )
+    dst = BaseDict(dst_path)
+    since = dst.synced_seq(src.journal_id)
+    header, records = src._delta(since)
+    return dst._apply_delta(header, records)
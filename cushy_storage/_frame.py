@@ -0,0 +1,284 @@
+# Copyright (c) 2023 Zeeland
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# Copyright Owner: Zeeland
+# GitHub Link: https://github.com/Undertone0809/
+# Project Link: https://github.com/Undertone0809/cushy-storage
+# Contact Email: zeeland@foxmail.com
+
+
+"""
+Chunked frame format for large values. The value is split into chunks of
+`chunk_size` bytes which are compressed independently, so chunks can be compressed
+and decompressed in parallel and any single chunk can be read without the others.
+
+    header  | MAGIC | version: u8 | chunk_size: u32 |
+    chunk   | length: u32 | compressed data |            (repeated)
+    index   | offset of each chunk: u64 |                 (repeated)
+    trailer | index offset: u64 | raw size: u64 | chunk count: u32 | END_MAGIC |
+
+All integers are little-endian. Compressed zlib/lzma data never starts with MAGIC,
+so frames and values compressed as a whole can live in the same cache.
+"""
+
+import io
+import struct
+from collections import deque
+from typing import BinaryIO, Callable, Deque, List, NamedTuple, Optional
+
+from cushy_storage.utils.executor import get_executor, parallel_map, submit
+
+MAGIC = b"\x89CSF"
+END_MAGIC = b"CSF\x89"
+VERSION = 1
+
+_HEADER = struct.Struct("<4sBI")
+_LENGTH = struct.Struct("<I")
+_OFFSET = struct.Struct("<Q")
+_TRAILER = struct.Struct("<QQI4s")
+
+
+class FrameInfo(NamedTuple):
+    chunk_size: int
+    raw_size: int
+    offsets: List[int]
+
+
+def is_frame(data: bytes) -> bool:
+    return data[:4] == MAGIC
+
+
+def encode_frame(
+    data: bytes, compress: Callable[[bytes], bytes], chunk_size: int
+) -> bytes:
+    """Split data into chunks and compress them on the shared thread pool."""
+    chunks = [data[i : i + chunk_size] for i in range(0, len(data), chunk_size)]
+    compressed = parallel_map(compress, chunks)
+
+    buf = bytearray(_HEADER.pack(MAGIC, VERSION, chunk_size))
+    offsets = []
+    for c in compressed:
+        offsets.append(len(buf))
+        buf += _LENGTH.pack(len(c))
+        buf += c
+    index_offset = len(buf)
+    for offset in offsets:
+        buf += _OFFSET.pack(offset)
+    buf += _TRAILER.pack(index_offset, len(data), len(offsets), END_MAGIC)
+    return bytes(buf)
+
+
+def _parse(header: bytes, index: bytes, trailer: bytes) -> FrameInfo:
+    magic, version, chunk_size = _HEADER.unpack(header)
+    _, raw_size, count, end = _TRAILER.unpack(trailer)
+    if magic != MAGIC or version != VERSION or end != END_MAGIC:
+        raise ValueError("invalid cushy-storage frame")
+    offsets = [_OFFSET.unpack_from(index, i * _OFFSET.size)[0] for i in range(count)]
+    return FrameInfo(chunk_size, raw_size, offsets)
+
+
+def _parse_bytes(data) -> FrameInfo:
+    trailer = data[len(data) - _TRAILER.size :]
+    index_offset, _, count, _ = _TRAILER.unpack(trailer)
+    index = data[index_offset : index_offset + count * _OFFSET.size]
+    return _parse(data[: _HEADER.size], index, trailer)
+
+
+def _chunk(data, offset: int) -> bytes:
+    (length,) = _LENGTH.unpack_from(data, offset)
+    start = offset + _LENGTH.size
+    return data[start : start + length]
+
+
+def decode_frame(data: bytes, decompress: Callable[[bytes], bytes]) -> bytes:
+    """Decompress all chunks of a frame on the shared thread pool."""
+    view = memoryview(data)
+    info = _parse_bytes(view)
+    chunks = [bytes(_chunk(view, offset)) for offset in info.offsets]
+    return b"".join(parallel_map(decompress, chunks))
+
+
+def read_frame_info(f: BinaryIO, tail: int = 0) -> FrameInfo:
+    """
+    Read the header and the chunk index of a frame file, `tail` is the size of data
+    stored after the frame.
+    """
+    f.seek(0)
+    header = f.read(_HEADER.size)
+    f.seek(-_TRAILER.size - tail, 2)
+    trailer = f.read(_TRAILER.size)
+    index_offset, _, count, _ = _TRAILER.unpack(trailer)
+    f.seek(index_offset)
+    return _parse(header, f.read(count * _OFFSET.size), trailer)
+
+
+def read_frame_range(
+    f: BinaryIO,
+    offset: int,
+    size: int,
+    decompress: Callable[[bytes], bytes],
+    tail: int = 0,
+) -> bytes:
+    """
+    Read `size` bytes starting at `offset` of the original value from a frame file.
+    Only the chunks covering the range are read and decompressed.
+    """
+    info = read_frame_info(f, tail)
+    end = min(offset + size, info.raw_size)
+    if offset >= end:
+        return b""
+
+    first, last = offset // info.chunk_size, (end - 1) // info.chunk_size
+    chunks = []
+    for i in range(first, last + 1):
+        f.seek(info.offsets[i])
+        (length,) = _LENGTH.unpack(f.read(_LENGTH.size))
+        chunks.append(f.read(length))
+    data = b"".join(parallel_map(decompress, chunks))
+
+    start = offset - first * info.chunk_size
+    return data[start : start + end - offset]
+
+
+class FrameWriter:
+    """
+    Write a frame to a file incrementally. Full chunks are compressed on the shared
+    thread pool while the caller keeps writing, at most `max_pending` chunks are
+    kept in memory.
+
+    Args:
+        f: the file to write the frame
+        compress: the function to compress a chunk
+        chunk_size: the size of uncompressed chunks
+        max_pending: max number of chunks being compressed, defaults to the number
+            of workers of the thread pool
+    """
+
+    def __init__(
+        self,
+        f: BinaryIO,
+        compress: Callable[[bytes], bytes],
+        chunk_size: int,
+        max_pending: Optional[int] = None,
+    ):
+        self._f = f
+        self._compress = compress
+        self._chunk_size = chunk_size
+        self._max_pending = max_pending or get_executor()._max_workers
+        self._pending: Deque = deque()
+        self._buf = bytearray()
+        self._offsets: List[int] = []
+        self._size = 0
+        self._f.write(_HEADER.pack(MAGIC, VERSION, chunk_size))
+
+    def write(self, b: bytes) -> int:
+        view = memoryview(b).cast("B")
+        n, pos = len(view), 0
+        self._size += n
+        if self._buf:
+            pos = self._chunk_size - len(self._buf)
+            self._buf += view[:pos]
+            if len(self._buf) < self._chunk_size:
+                return n
+            self._submit(bytes(self._buf))
+            self._buf = bytearray()
+        while n - pos >= self._chunk_size:
+            self._submit(bytes(view[pos : pos + self._chunk_size]))
+            pos += self._chunk_size
+        self._buf += view[pos:]
+        return n
+
+    def _submit(self, chunk: bytes):
+        self._pending.append(submit(self._compress, chunk))
+        while len(self._pending) >= self._max_pending:
+            self._write_chunk(self._pending.popleft().result())
+
+    def _write_chunk(self, c: bytes):
+        self._offsets.append(self._f.tell())
+        self._f.write(_LENGTH.pack(len(c)))
+        self._f.write(c)
+
+    def finish(self):
+        """Write the remaining data, the chunk index and the trailer."""
+        if self._buf:
+            self._submit(bytes(self._buf))
+            self._buf = bytearray()
+        while self._pending:
+            self._write_chunk(self._pending.popleft().result())
+
+        index_offset = self._f.tell()
+        self._f.write(b"".join(_OFFSET.pack(offset) for offset in self._offsets))
+        self._f.write(
+            _TRAILER.pack(index_offset, self._size, len(self._offsets), END_MAGIC)
+        )
+
+
+class FrameReader(io.RawIOBase):
+    """
+    Read the original value from a frame file incrementally. The next `prefetch`
+    chunks are decompressed on the shared thread pool ahead of the reader.
+
+    Args:
+        f: the frame file, it is closed with the reader
+        decompress: the function to decompress a chunk
+        prefetch: the number of chunks decompressed ahead of the reader
+        tail: the size of data stored after the frame
+    """
+
+    def __init__(
+        self,
+        f: BinaryIO,
+        decompress: Callable[[bytes], bytes],
+        prefetch: int = 4,
+        tail: int = 0,
+    ):
+        super().__init__()
+        self._f = f
+        self._decompress = decompress
+        self._prefetch = prefetch
+        self._offsets = read_frame_info(f, tail).offsets
+        self._next = 0
+        self._pending: Deque = deque()
+        self._chunk = memoryview(b"")
+        self._pos = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def _fill(self):
+        while self._next < len(self._offsets) and len(self._pending) < self._prefetch:
+            self._f.seek(self._offsets[self._next])
+            (length,) = _LENGTH.unpack(self._f.read(_LENGTH.size))
+            chunk = self._f.read(length)
+            self._pending.append(submit(self._decompress, chunk))
+            self._next += 1
+
+    def readinto(self, b) -> int:
+        while self._pos >= len(self._chunk):
+            self._fill()
+            if not self._pending:
+                return 0
+            self._chunk = memoryview(self._pending.popleft().result())
+            self._pos = 0
+
+        n = min(len(b), len(self._chunk) - self._pos)
+        b[:n] = self._chunk[self._pos : self._pos + n]
+        self._pos += n
+        return n
+
+    def close(self):
+        if not self.closed:
+            self._f.close()
+            self._pending.clear()
+        super().close()
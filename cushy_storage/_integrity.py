@@ -0,0 +1,118 @@
+# Copyright (c) 2023 Zeeland
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# Copyright Owner: Zeeland
+# GitHub Link: https://github.com/Undertone0809/
+# Project Link: https://github.com/Undertone0809/cushy-storage
+# Contact Email: zeeland@foxmail.com
+
+
+"""
+Checksums of stored values. A footer with the crc32 of the stored bytes is appended
+to each value:
+
+    | stored bytes | crc32: u32 | CHECKSUM_MAGIC |
+
+Once checksum is enabled for a cache, every value must have the footer, a value
+without it is truncated and `ChecksumError` is raised.
+"""
+
+import io
+import struct
+import zlib
+from pathlib import Path
+from typing import BinaryIO
+
+CHECKSUM_MAGIC = b"\x89CSC"
+
+_FOOTER = struct.Struct("<I4s")
+FOOTER_SIZE = _FOOTER.size
+
+# Size of blocks read when computing the checksum of a file
+_BLOCK_SIZE = 1024 * 1024
+
+
+class ChecksumError(ValueError):
+    """The stored value does not match its checksum, the file is corrupted"""
+
+
+def add_checksum(data: bytes) -> bytes:
+    return data + _FOOTER.pack(zlib.crc32(data), CHECKSUM_MAGIC)
+
+
+def has_checksum(data) -> bool:
+    return len(data) >= FOOTER_SIZE and data[-4:] == CHECKSUM_MAGIC
+
+
+def strip_checksum(data):
+    """Verify and remove the footer of a value"""
+    if not has_checksum(data):
+        raise ChecksumError("checksum is missing, the value is truncated")
+    body = data[:-FOOTER_SIZE]
+    crc, _ = _FOOTER.unpack(data[-FOOTER_SIZE:])
+    if zlib.crc32(body) != crc:
+        raise ChecksumError("checksum mismatch, the value is corrupted")
+    return body
+
+
+def footer_size(f: BinaryIO, strict: bool = True) -> int:
+    """
+    Get the size of the footer of an opened value file. `ChecksumError` is raised
+    if it has no footer, or 0 is returned if strict is False.
+    """
+    f.seek(0, 2)
+    if f.tell() >= FOOTER_SIZE:
+        f.seek(-4, 2)
+        if f.read(4) == CHECKSUM_MAGIC:
+            return FOOTER_SIZE
+    if strict:
+        raise ChecksumError("checksum is missing, the value is truncated")
+    return 0
+
+
+def append_checksum(path: Path):
+    """Append the footer to a value file written by a stream"""
+    crc = 0
+    with open(path, "r+b") as f:
+        while True:
+            block = f.read(_BLOCK_SIZE)
+            if not block:
+                break
+            crc = zlib.crc32(block, crc)
+        f.write(_FOOTER.pack(crc, CHECKSUM_MAGIC))
+
+
+class LimitedReader(io.RawIOBase):
+    """Read a file up to a size, the data after it is hidden"""
+
+    def __init__(self, f: BinaryIO, size: int):
+        super().__init__()
+        self._f = f
+        self._remaining = size
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, b) -> int:
+        n = min(len(b), self._remaining)
+        if n <= 0:
+            return 0
+        n = self._f.readinto(memoryview(b)[:n])
+        self._remaining -= n
+        return n
+
+    def close(self):
+        if not self.closed:
+            self._f.close()
+        super().close()
@@ -0,0 +1,288 @@
+# Copyright (c) 2023 Zeeland
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# Copyright Owner: Zeeland
+# GitHub Link: https://github.com/Undertone0809/
+# Project Link: https://github.com/Undertone0809/cushy-storage
+# Contact Email: zeeland@foxmail.com
+
+
+import json
+import os
+import struct
+import time
+import uuid
+from pathlib import Path
+from typing import Any, BinaryIO, Dict, Iterable, Iterator, List, Optional, Tuple
+
+# A change of the cache, (op, key or prefix, stored value)
+Record = Tuple[str, str, Optional[bytes]]
+
+DELTA_MAGIC = b"CSDELTA1"
+
+# The journal is compacted to half of this size when it grows over it
+MAX_JOURNAL_SIZE = 64 * 1024 * 1024
+
+# Seconds after which the compaction lock of a crashed process is removed
+_STALE_LOCK = 60.0
+
+# op names in the journal and their codes in delta files
+_OP_CODES = {"set": b"S", "del": b"D", "clear": b"C", "prefix": b"P", "zdict": b"Z"}
+_CODE_OPS = {v: k for k, v in _OP_CODES.items()}
+_END = b"E"
+
+
+class JournalCompacted(ValueError):
+    """The changes since a sequence number are dropped by compaction"""
+
+
+class Journal:
+    """
+    An append-only log of the changes of a cache, each line is a json list of the
+    operation, the key and the id of the writer, which is unique for each opened
+    journal. The byte offset after a change plus the base of the journal is its
+    sequence number, so reading the changes since a sequence number is a single
+    sequential read. The first line records the id and the base of the journal,
+    sequence numbers of different journals can not be compared.
+
+    When the journal grows over max_size, the oldest changes are dropped and the
+    base grows by the dropped bytes, so sequence numbers do not change. Reading
+    from a dropped sequence number raises `JournalCompacted`. Writers append to the
+    file being replaced again to the new file, so no change is lost.
+
+    Args:
+        file: the journal file
+        max_size: the size in bytes which triggers compaction
+    """
+
+    def __init__(self, file: Path, max_size: int = MAX_JOURNAL_SIZE):
+        self.file = file
+        self.max_size = max_size
+        if not file.is_file():
+            file.parent.mkdir(parents=True, exist_ok=True)
+            tmp = file.with_name(f"{file.name}.{uuid.uuid4().hex}.tmp")
+            tmp.write_text(json.dumps({"id": uuid.uuid4().hex}) + "\n")
+            # keep the journal created by others if it exists
+            try:
+                os.link(tmp, file)
+            except FileExistsError:
+                pass
+            tmp.unlink()
+        self._ino = -1
+        self._base = 0
+        self._start = 0
+        with open(file, "rb") as f:
+            self.id: str = self._read_header(f)["id"]
+        self.writer = uuid.uuid4().hex[:8]
+        self._fd: Optional[int] = os.open(file, os.O_WRONLY | os.O_APPEND)
+
+    def _read_header(self, f: BinaryIO) -> Dict[str, Any]:
+        """Read the header of an opened journal file and remember its base"""
+        line = f.readline()
+        header = json.loads(line)
+        self._ino = os.fstat(f.fileno()).st_ino
+        self._base = header.get("base", 0)
+        self._start = self._base + len(line)
+        return header
+
+    def _stat(self) -> os.stat_result:
+        """Stat the journal file, the header is read again if it is replaced"""
+        st = os.stat(self.file)
+        if st.st_ino != self._ino:
+            with open(self.file, "rb") as f:
+                self._read_header(f)
+            # replaced again before the header is read
+            if self._ino != st.st_ino:
+                return self._stat()
+        return st
+
+    @property
+    def start(self) -> int:
+        """The sequence number before the oldest kept change"""
+        self._stat()
+        return self._start
+
+    def record(self, op: str, k: str):
+        """Append a change, a single write is atomic among appending processes"""
+        change = [op, k, self.writer]
+        line = json.dumps(change, ensure_ascii=False, separators=(",", ":")) + "\n"
+        data = line.encode("utf8")
+        os.write(self._fd, data)
+        size = os.fstat(self._fd).st_size
+        if os.stat(self.file).st_ino != os.fstat(self._fd).st_ino:
+            # written to a file replaced by compaction, which may have copied the
+            # change already, a change written twice is applied twice harmlessly
+            os.close(self._fd)
+            self._fd = os.open(self.file, os.O_WRONLY | os.O_APPEND)
+            os.write(self._fd, data)
+        elif size > self.max_size:
+            self.compact()
+
+    def seq(self) -> int:
+        """The sequence number of the latest change"""
+        st = self._stat()
+        return self._base + st.st_size
+
+    def read(self, since: int) -> Tuple[List[Tuple[str, str, str]], int]:
+        """
+        Get the changes after since and the sequence number of the last one.
+        `JournalCompacted` is raised if changes after since are dropped.
+        """
+        with open(self.file, "rb") as f:
+            self._read_header(f)
+            if since < self._start:
+                raise JournalCompacted(
+                    f"changes since {since} are dropped by compaction"
+                )
+            f.seek(since - self._base)
+            data = f.read()
+        # a change being appended by another process is read next time
+        end = data.rfind(b"\n") + 1
+        changes = [tuple(json.loads(line)) for line in data[:end].splitlines()]
+        return changes, since + end
+
+    def compact(self, keep: Optional[int] = None) -> bool:
+        """
+        Drop the oldest changes, keeping about the last keep bytes, half of max_size
+        by default. Only one process compacts at a time, others skip it.
+
+        Returns: whether the journal is compacted
+        """
+        keep = self.max_size // 2 if keep is None else keep
+        lock = self.file.with_name(f"{self.file.name}.compact")
+        try:
+            os.close(os.open(lock, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644))
+        except FileExistsError:
+            try:
+                if time.time() - os.path.getmtime(lock) > _STALE_LOCK:
+                    os.unlink(lock)
+            except FileNotFoundError:
+                pass
+            return False
+        try:
+            with open(self.file, "rb") as f:
+                header = self._read_header(f)
+                head = f.tell()
+                size = os.fstat(f.fileno()).st_size
+                if size - head <= keep:
+                    return False
+                f.seek(size - keep - 1)
+                # start after the end of a line
+                f.readline()
+                cut = f.tell()
+                data = f.read()
+                end = cut + data.rfind(b"\n") + 1
+                data = data[: end - cut]
+
+                # the base keeps the sequence numbers of kept changes, and its
+                # length changes the length of the header, so it is fixed up twice
+                seq = self._base + cut
+                line = b""
+                for _ in range(3):
+                    header["base"] = seq - len(line)
+                    line = (json.dumps(header) + "\n").encode("utf8")
+                tmp = self.file.with_name(f"{self.file.name}.{uuid.uuid4().hex}.tmp")
+                with open(tmp, "wb") as out:
+                    out.write(line + data)
+                os.replace(tmp, self.file)
+
+                # copy changes appended to the old file before writers see the new
+                f.seek(end)
+                rest = f.read()
+            if rest:
+                fd = os.open(self.file, os.O_WRONLY | os.O_APPEND)
+                try:
+                    os.write(fd, rest)
+                finally:
+                    os.close(fd)
+            return True
+        finally:
+            os.unlink(lock)
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    def __del__(self):
+        self.close()
+
+
+def fold_changes(
+    changes: Iterable[Tuple[str, str, str]],
+) -> Tuple[bool, List[str], List[str]]:
+    """
+    Merge changes into whether the cache is cleared, the removed prefixes and the
+    changed keys. Later changes of a key replace earlier ones, so each key is
+    copied once however many times it changed.
+    """
+    cleared = False
+    prefixes: List[str] = []
+    keys: Dict[str, None] = {}
+    for op, arg, _ in changes:
+        if op == "clear":
+            cleared = True
+            prefixes.clear()
+            keys.clear()
+        elif op == "prefix":
+            prefixes.append(arg)
+            keys = {k: None for k in keys if not k.startswith(arg)}
+        else:
+            keys[arg] = None
+    return cleared, prefixes, sorted(keys)
+
+
+def write_delta(f: BinaryIO, header: Dict[str, Any], records: Iterable[Record]):
+    """Write a header and records to a delta file"""
+    h = json.dumps(header).encode("utf8")
+    f.write(DELTA_MAGIC + struct.pack("<I", len(h)) + h)
+    for op, k, data in records:
+        key = k.encode("utf8")
+        if data is None:
+            f.write(_OP_CODES[op] + struct.pack("<I", len(key)) + key)
+        else:
+            f.write(
+                _OP_CODES[op]
+                + struct.pack("<I", len(key))
+                + key
+                + struct.pack("<Q", len(data))
+            )
+            f.write(data)
+    f.write(_END)
+
+
+def read_delta(f: BinaryIO) -> Tuple[Dict[str, Any], Iterator[Record]]:
+    """Read the header of a delta file, and iterate over its records lazily"""
+    if f.read(len(DELTA_MAGIC)) != DELTA_MAGIC:
+        raise ValueError("not a cushy-storage delta file")
+    (size,) = struct.unpack("<I", f.read(4))
+    header = json.loads(f.read(size))
+
+    def records() -> Iterator[Record]:
+        while True:
+            code = f.read(1)
+            if code == _END:
+                return
+            if code not in _CODE_OPS:
+                raise ValueError("truncated or corrupted delta file")
+            op = _CODE_OPS[code]
+            (size,) = struct.unpack("<I", f.read(4))
+            k = f.read(size).decode("utf8")
+            data = None
+            if op in ("set", "zdict"):
+                (size,) = struct.unpack("<Q", f.read(8))
+                data = f.read(size)
+            yield op, k, data
+
+    return header, records()
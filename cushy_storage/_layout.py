@@ -0,0 +1,78 @@
+# Copyright (c) 2023 Zeeland
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# Copyright Owner: Zeeland
+# GitHub Link: https://github.com/Undertone0809/
+# Project Link: https://github.com/Undertone0809/cushy-storage
+# Contact Email: zeeland@foxmail.com
+
+
+import hashlib
+from pathlib import Path
+
+
+class Layout:
+    """How keys are mapped to shard directories and file names under a cache path"""
+
+    name = ""
+
+    def shard(self, k: str) -> str:
+        raise NotImplementedError
+
+    def file_name(self, k: str) -> str:
+        raise NotImplementedError
+
+    def key(self, shard: str, file_name: str) -> str:
+        """Get the key of a file in a shard directory"""
+        raise NotImplementedError
+
+    def file(self, root: Path, k: str) -> Path:
+        return root / self.shard(k) / self.file_name(k)
+
+
+class PrefixLayout(Layout):
+    """
+    The first two characters of a key are its shard, the default layout. Keys with
+    a common prefix are in the same shard, so `delete_prefix()` only scans one
+    shard, but shards are unbalanced if most keys share a prefix.
+    """
+
+    name = "prefix"
+
+    def shard(self, k: str) -> str:
+        return k[:2]
+
+    def file_name(self, k: str) -> str:
+        return k[2:] + "_"
+
+    def key(self, shard: str, file_name: str) -> str:
+        return shard + file_name[:-1]
+
+
+class HashLayout(Layout):
+    """Keys are spread evenly over 256 shards by the md5 of the key"""
+
+    name = "hash"
+
+    def shard(self, k: str) -> str:
+        return hashlib.md5(k.encode("utf8")).hexdigest()[:2]
+
+    def file_name(self, k: str) -> str:
+        return k + "_"
+
+    def key(self, shard: str, file_name: str) -> str:
+        return file_name[:-1]
+
+
+LAYOUTS = {layout.name: layout for layout in (PrefixLayout(), HashLayout())}
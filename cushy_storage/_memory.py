@@ -0,0 +1,69 @@
+# Copyright (c) 2023 Zeeland
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# Copyright Owner: Zeeland
+# GitHub Link: https://github.com/Undertone0809/
+# Project Link: https://github.com/Undertone0809/cushy-storage
+# Contact Email: zeeland@foxmail.com
+
+
+import threading
+from collections import OrderedDict
+from typing import List, Optional
+
+
+class MemoryTier:
+    """
+    In-memory LRU tier of decoded values in front of the files of a cache.
+
+    Args:
+        max_items: max number of values kept in memory
+    """
+
+    def __init__(self, max_items: int):
+        self.max_items = max_items
+        self._items: "OrderedDict[str, bytes]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    def __contains__(self, k: str) -> bool:
+        return k in self._items
+
+    def keys(self) -> List[str]:
+        with self._lock:
+            return list(self._items)
+
+    def get(self, k: str) -> Optional[bytes]:
+        with self._lock:
+            v = self._items.get(k)
+            if v is not None:
+                self._items.move_to_end(k)
+        return v
+
+    def put(self, k: str, v: bytes):
+        with self._lock:
+            self._items[k] = v
+            self._items.move_to_end(k)
+            while len(self._items) > self.max_items:
+                self._items.popitem(last=False)
+
+    def discard(self, k: str):
+        with self._lock:
+            self._items.pop(k, None)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
@@ -0,0 +1,152 @@
+# Copyright (c) 2023 Zeeland
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# Copyright Owner: Zeeland
+# GitHub Link: https://github.com/Undertone0809/
+# Project Link: https://github.com/Undertone0809/cushy-storage
+# Contact Email: zeeland@foxmail.com
+
+
+import os
+import shutil
+from pathlib import Path
+from typing import TYPE_CHECKING, Any, Iterator, List, Mapping, Optional, Tuple
+
+from cushy_storage._layout import Layout
+from cushy_storage.utils.executor import read_ahead
+
+if TYPE_CHECKING:
+    from cushy_storage._core import BaseDict
+
+# Number of values in a batch read ahead by items(), and number of batches
+_BATCH = 256
+_READ_AHEAD_BATCHES = 4
+
+
+class Snapshot(Mapping[str, Any]):
+    """
+    A read-only, point-in-time view of a cache created by `BaseDict.snapshot()`.
+    The files of values are hard links to the files of the cache at that time,
+    values are replaced by renaming new files, so later writes never change the
+    snapshot. A snapshot costs no space until values are overwritten or deleted.
+
+    Args:
+        cache: the cache the snapshot is taken from, which decodes values
+        dirs: the snapshot directory of each tier of the cache, from fast to slow
+        layout: the layout of key files in the snapshot
+    """
+
+    def __init__(self, cache: "BaseDict", dirs: List[Path], layout: Layout):
+        self._cache = cache
+        self._dirs = dirs
+        self._layout = layout
+        self.name = dirs[0].name
+
+    def _shards(self, d: Path) -> List[str]:
+        try:
+            return os.listdir(d)
+        except FileNotFoundError:
+            raise ValueError(f"snapshot {self.name} is deleted") from None
+
+    def _read(self, k: str) -> Optional[bytes]:
+        for d in self._dirs:
+            try:
+                with open(self._layout.file(d, k), "rb") as f:
+                    return f.read()
+            except FileNotFoundError:
+                pass
+        return None
+
+    def __getitem__(self, k: str):
+        t = self._read(k)
+        if t is None:
+            raise KeyError(k)
+        return self._cache._from_stored(t)
+
+    def __contains__(self, k: object) -> bool:
+        if not isinstance(k, str):
+            return False
+        return any(self._layout.file(d, k).is_file() for d in self._dirs)
+
+    def _files(self) -> Iterator[Tuple[str, str]]:
+        """Get keys and file paths of all values by scanning shard directories"""
+        seen = set() if len(self._dirs) > 1 else None
+        for i, d in enumerate(self._dirs):
+            for a in self._shards(d):
+                for entry in os.scandir(d / a):
+                    k = self._layout.key(a, entry.name)
+                    if seen is not None:
+                        # a key in a faster tier shadows the same key in slower ones
+                        if k in seen:
+                            continue
+                        if i < len(self._dirs) - 1:
+                            seen.add(k)
+                    yield k, entry.path
+
+    def __iter__(self) -> Iterator[str]:
+        for k, _ in self._files():
+            yield k
+
+    def __len__(self) -> int:
+        if len(self._dirs) == 1:
+            d = self._dirs[0]
+            return sum(len(os.listdir(d / a)) for a in self._shards(d))
+        return sum(1 for _ in self._files())
+
+    def _load_batch(self, batch: List[Tuple[str, str]]) -> List[Tuple[str, Any]]:
+        items = []
+        for k, file in batch:
+            with open(file, "rb") as f:
+                items.append((k, self._cache._from_stored(f.read())))
+        return items
+
+    def items(self, parallel: bool = True) -> Iterator[Tuple[str, Any]]:
+        """
+        Iterate over all keys and values. Shard directories are scanned with
+        os.scandir, and batches of values are read and decoded ahead on the shared
+        thread pool if parallel.
+        """
+        batches = _batched(self._files(), _BATCH)
+        if parallel:
+            loaded = read_ahead(self._load_batch, batches, _READ_AHEAD_BATCHES)
+        else:
+            loaded = map(self._load_batch, batches)
+        for items in loaded:
+            yield from items
+
+    def values(self, parallel: bool = True) -> Iterator[Any]:
+        for _, v in self.items(parallel):
+            yield v
+
+    def delete(self):
+        """Remove the snapshot, values only kept by it are freed"""
+        for d in self._dirs:
+            shutil.rmtree(d, ignore_errors=True)
+
+    def __enter__(self) -> "Snapshot":
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.delete()
+
+
+def _batched(items: Iterator, size: int) -> Iterator[List]:
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
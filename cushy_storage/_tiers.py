@@ -0,0 +1,117 @@
+# Copyright (c) 2023 Zeeland
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# Copyright Owner: Zeeland
+# GitHub Link: https://github.com/Undertone0809/
+# Project Link: https://github.com/Undertone0809/cushy-storage
+# Contact Email: zeeland@foxmail.com
+
+
+import errno
+import os
+import shutil
+import uuid
+from pathlib import Path
+from typing import Iterator, List, NamedTuple, Optional
+
+from cushy_storage._layout import Layout
+
+# Directory of a tier to store cache metadata, it is not a key shard
+_META_DIR = ".cushy"
+
+# A tier over its capacity demotes values until it is below this ratio of it
+LOW_WATERMARK = 0.9
+
+
+class TierEntry(NamedTuple):
+    key: str
+    size: int
+    mtime: float
+    shard: str
+
+
+class DiskTier:
+    """
+    A directory storing values with the same layout as the cache path, values are
+    moved between tiers as stored, without decoding them.
+
+    Args:
+        path: the directory of the tier
+        capacity: max bytes of values in the tier, None means unlimited
+        layout: the layout of key files in the tier
+    """
+
+    def __init__(self, path: Path, capacity: Optional[int], layout: Layout):
+        self.path = path
+        self.capacity = capacity
+        self.layout = layout
+
+    def file(self, k: str) -> Path:
+        return self.layout.file(self.path, k)
+
+    def shards(self) -> List[str]:
+        try:
+            return [a for a in os.listdir(self.path) if a != _META_DIR]
+        except FileNotFoundError:
+            return []
+
+    def keys(self) -> Iterator[str]:
+        key = self.layout.key
+        for a in self.shards():
+            for b in os.listdir(self.path / a):
+                yield key(a, b)
+
+    def iter_entries(self) -> Iterator[TierEntry]:
+        """Iterate over the size and modified time of all values in the tier"""
+        key = self.layout.key
+        for a in self.shards():
+            try:
+                entries = os.scandir(self.path / a)
+            except FileNotFoundError:
+                continue
+            with entries:
+                for entry in entries:
+                    try:
+                        st = entry.stat()
+                    except FileNotFoundError:
+                        continue
+                    k = key(a, entry.name)
+                    yield TierEntry(k, st.st_size, st.st_mtime, a)
+
+    def scan(self) -> List[TierEntry]:
+        """Get the size and modified time of all values in the tier"""
+        return list(self.iter_entries())
+
+    def move_in(self, k: str, src: Path):
+        """Move the file of a value from another tier into this tier"""
+        dst = self.file(k)
+        dst.parent.mkdir(parents=True, exist_ok=True)
+        try:
+            os.replace(src, dst)
+            return
+        except OSError as e:
+            if e.errno != errno.EXDEV:
+                raise
+
+        # tiers on different file systems, copy and replace atomically
+        tmp_dir = self.path / _META_DIR / "tmp"
+        tmp_dir.mkdir(parents=True, exist_ok=True)
+        tmp = tmp_dir / uuid.uuid4().hex
+        try:
+            shutil.copyfile(src, tmp)
+            os.replace(tmp, dst)
+        except BaseException:
+            tmp.unlink(missing_ok=True)
+            raise
+        os.unlink(src)
@@ -18,17 +18,36 @@
 # Contact Email: zeeland@foxmail.com
 
 import hashlib
+import itertools
 import json
+import re
 import uuid
 from abc import ABC
-from typing import Callable, List, Optional, Tuple, Union
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    Iterator,
+    List,
+    Optional,
+    Sequence,
+    Set,
+    Tuple,
+    Union,
+)
 
 from cushy_storage import CushyDict
+from cushy_storage._columnar import ColumnBlock
 from cushy_storage.utils import get_default_cache_path
 from cushy_storage.utils.logger import logger
 
 
 class BaseORMModel(ABC):
+    # set to True in a subclass to store its objects column by column, which is
+    # much smaller and faster to filter for models with the same fields in every
+    # object
+    __columnar__: bool = False
+
     def __init__(self):
         self.__name__ = type(self).__name__
         self.__unique_id__: str = str(uuid.uuid4())
@@ -43,18 +62,319 @@ class BaseORMModel(ABC):
         return hash256.hexdigest()
 
 
+# Default number of objects stored in a page of a model
+_DEFAULT_PAGE_SIZE = 1000
+
+# Number of hex digits of a page id
+_PAGE_ID_SIZE = 16
+
+# Key of a page, the model name and the page id
+_PAGE_KEY = re.compile(rf"^([^\W\d]\w*)@([0-9a-f]{{{_PAGE_ID_SIZE}}})$")
+
+# A page of a model, objects are stored as their __dict__ with their class, or as
+# columns if the class is columnar
+Page = Tuple[type, Union[List[dict], ColumnBlock]]
+
+
+def _build(cls: type, row: dict) -> BaseORMModel:
+    """Build an object from its stored __dict__ without calling __init__"""
+    obj = cls.__new__(cls)
+    obj.__dict__.update(row)
+    return obj
+
+
+def _match(row: dict, filters: dict) -> bool:
+    for key, value in filters.items():
+        if row[key] != value:
+            return False
+    return True
+
+
+class _ModelPages:
+    """
+    Objects of a model stored in pages. The key of the model stores a manifest with
+    the id and size of each page, and each page is stored in `<model>@<page id>`.
+    Pages are copy-on-write, changed pages are written with new ids and the
+    manifest is replaced at last, so a failed write leaves the model unchanged.
+    Replaced pages are removed after the manifest, a reader still holding the old
+    manifest reads the latest one when a page is missing.
+    Models stored as a single list by older versions are read as they are, and
+    converted to pages on the next write.
+    """
+
+    def __init__(self, cache: "ORMMixin", name: str, page_size: int, load: bool = True):
+        self.cache = cache
+        self.name = name
+        self.page_size = page_size
+        self._legacy: Optional[List[BaseORMModel]] = None
+        self.pages: List[List] = []
+        # the manifest as it was loaded, None if the model is not stored
+        self._manifest: Any = None
+        if load:
+            self.reload()
+
+    def reload(self):
+        """Read the latest manifest of the model"""
+        self._legacy, self.pages, self._manifest = None, [], None
+        try:
+            value = self.cache[self.name]
+        except KeyError:
+            return
+        self._manifest = value
+        if isinstance(value, list):
+            self._legacy = value
+        else:
+            self.pages = value["pages"]
+
+    def _key(self, page_id: str) -> str:
+        return f"{self.name}@{page_id}"
+
+    def count(self) -> int:
+        if self._legacy is not None:
+            return len(self._legacy)
+        return sum(count for _, count in self.pages)
+
+    def _load_page(self, page_id: str) -> Page:
+        page = self.cache[self._key(page_id)]
+        if "columns" in page:
+            return page["cls"], page["columns"]
+        return page["cls"], page["rows"]
+
+    def load(self, page_id: str) -> Tuple[type, List[dict]]:
+        cls, data = self._load_page(page_id)
+        if isinstance(data, ColumnBlock):
+            return cls, data.rows()
+        return cls, data
+
+    def _stored(self) -> Iterator[Tuple[Optional[str], type, List[dict]]]:
+        if self._legacy is not None:
+            for cls, objs in itertools.groupby(self._legacy, key=type):
+                yield None, cls, [obj.__dict__ for obj in objs]
+            return
+        for page_id, _ in self.pages:
+            yield (page_id, *self.load(page_id))
+
+    def _load_at(self, offset: int) -> Optional[Tuple[type, Any, int]]:
+        """
+        Load the page containing the object at offset, with the index of the object
+        in the page, None if offset is out of range. A page replaced by a concurrent
+        write is not an error, the latest manifest is read and the object at offset
+        is loaded from it.
+        """
+        while True:
+            index = offset
+            for page_id, count in self.pages:
+                if index < count:
+                    break
+                index -= count
+            else:
+                return None
+            try:
+                cls, data = self._load_page(page_id)
+            except KeyError:
+                manifest = self._manifest
+                self.reload()
+                if self._legacy is not None or self._manifest == manifest:
+                    raise
+                continue
+            return cls, data, index
+
+    def iter_pages(self) -> Iterator[Page]:
+        if self._legacy is not None:
+            for _, cls, rows in self._stored():
+                yield cls, rows
+            return
+        offset = 0
+        while True:
+            loaded = self._load_at(offset)
+            if loaded is None:
+                return
+            cls, data, index = loaded
+            if index:
+                # the manifest was replaced, skip objects already iterated
+                rows = data.rows() if isinstance(data, ColumnBlock) else data
+                data = rows[index:]
+            yield cls, data
+            offset += len(data)
+
+    def get(self, index: int) -> BaseORMModel:
+        """Get the object at index by loading only the page containing it"""
+        if index < 0:
+            index += self.count()
+        if self._legacy is not None:
+            return self._legacy[index]
+        loaded = self._load_at(index) if index >= 0 else None
+        if loaded is None:
+            raise IndexError("queryset index out of range")
+        cls, data, index = loaded
+        if isinstance(data, ColumnBlock):
+            return _build(cls, data.row(index))
+        return _build(cls, data[index])
+
+    def _write(self, cls: type, rows: List[dict], created: List[str]) -> List[List]:
+        pages = []
+        columnar = getattr(cls, "__columnar__", False)
+        for i in range(0, len(rows), self.page_size):
+            page_id = uuid.uuid4().hex[:_PAGE_ID_SIZE]
+            chunk = rows[i : i + self.page_size]
+            block = ColumnBlock.from_rows(chunk) if columnar else None
+            if block is not None:
+                self.cache[self._key(page_id)] = {"cls": cls, "columns": block}
+            else:
+                self.cache[self._key(page_id)] = {"cls": cls, "rows": chunk}
+            created.append(page_id)
+            pages.append([page_id, len(chunk)])
+        return pages
+
+    def _remove(self, page_id: str):
+        # not pop(), which reads the page before removing it
+        try:
+            del self.cache[self._key(page_id)]
+        except KeyError:
+            pass
+
+    def remove_pages(self, page_ids: List[str]):
+        for page_id in page_ids:
+            self._remove(page_id)
+
+    def update(
+        self,
+        transform: Optional[Callable[[List[dict]], List[dict]]] = None,
+        append: List[BaseORMModel] = (),
+        validate: Optional[Callable[[], None]] = None,
+        replace: bool = False,
+    ):
+        """
+        Write changes of the model.
+
+        Args:
+            transform: change the rows of a page, it returns the same list if the
+                page is unchanged
+            append: objects appended to the model
+            validate: called before the manifest is replaced, the model is
+                unchanged if it raises
+            replace: remove all stored objects before appending
+        """
+        pages, created, removed = self.prepare(transform, append, validate, replace)
+        try:
+            self.swap(pages)
+        except BaseException:
+            self.remove_pages(created)
+            raise
+        self.remove_pages(removed)
+
+    def swap(self, pages: List[List]):
+        """Replace the manifest with new pages"""
+        self.cache[self.name] = {"pages": pages}
+        self.pages = pages
+        self._legacy = None
+
+    def restore(self):
+        """Write back the manifest replaced by `swap()`"""
+        if self._manifest is None:
+            try:
+                del self.cache[self.name]
+            except KeyError:
+                pass
+        else:
+            self.cache[self.name] = self._manifest
+
+    def prepare(
+        self,
+        transform: Optional[Callable[[List[dict]], List[dict]]] = None,
+        append: List[BaseORMModel] = (),
+        validate: Optional[Callable[[], None]] = None,
+        replace: bool = False,
+    ) -> Tuple[List[List], List[str], List[str]]:
+        """
+        Write the new pages of changes without replacing the manifest, see
+        `update()` for arguments. Created pages are removed if it raises.
+
+        Returns: pages of the new manifest, ids of created pages and ids of pages
+            to remove once the manifest is replaced
+        """
+        created: List[str] = []
+        removed: List[str] = []
+        pages: List[List] = []
+        tail: Optional[Tuple[Optional[str], type, List[dict]]] = None
+        try:
+            if replace:
+                removed = [page_id for page_id, _ in self.pages]
+            elif transform is None and self._legacy is None:
+                # stored pages are unchanged by appending, so they are not read
+                pages = [list(page) for page in self.pages]
+            else:
+                for page_id, cls, rows in self._stored():
+                    new_rows = transform(rows) if transform else rows
+                    if page_id is not None and new_rows is rows:
+                        pages.append([page_id, len(rows)])
+                    else:
+                        if page_id is not None:
+                            removed.append(page_id)
+                        pages += self._write(cls, new_rows, created)
+                    tail = (page_id, cls, rows)
+
+            # fill the last page before creating new pages
+            if append and pages and pages[-1][1] < self.page_size:
+                page_id = pages[-1][0]
+                if tail is not None and tail[0] == page_id:
+                    cls, rows = tail[1], tail[2]
+                else:
+                    cls, rows = self.load(page_id)
+                if type(append[0]) is cls:
+                    pages.pop()
+                    removed.append(page_id)
+                    append = [_build(cls, row) for row in rows] + list(append)
+
+            for cls, objs in itertools.groupby(append, key=type):
+                pages += self._write(cls, [obj.__dict__ for obj in objs], created)
+
+            if validate is not None:
+                validate()
+        except BaseException:
+            self.remove_pages(created)
+            raise
+        return pages, created, removed
+
+
 class QuerySet:
+    """
+    A set of objects of a model. A queryset from `ORMMixin.query` loads the model
+    page by page when it is iterated, so `first()`, `limit()` and `count()` only
+    touch the pages they need, and always see the latest data of the model.
+    `all()` loads all matched objects into memory.
+    """
+
     def __init__(
         self, obj: Union[List[BaseORMModel], BaseORMModel], name: Optional[str] = None
     ):
-        self._data: List[BaseORMModel] = obj
+        self._data: Optional[List[BaseORMModel]] = obj
         if isinstance(obj, BaseORMModel):
             self._data = [obj]
+        self._pages: Optional[_ModelPages] = None
+        self._filters: Dict[str, Any] = {}
+        self._limit: Optional[int] = None
         if len(self._data) == 0 and name:
             self.__name__ = name
         else:
             self.__name__ = name if name else self._data[0].__name__
 
+    @classmethod
+    def _from_pages(
+        cls,
+        pages: _ModelPages,
+        name: str,
+        filters: Optional[Dict[str, Any]] = None,
+        limit: Optional[int] = None,
+    ) -> "QuerySet":
+        """generate a lazy queryset loading objects page by page"""
+        queryset = cls([], name)
+        queryset._data = None
+        queryset._pages = pages
+        queryset._filters = filters or {}
+        queryset._limit = limit
+        return queryset
+
     @classmethod
     def _from_filter(
         cls, obj: Union[List[BaseORMModel], BaseORMModel], name: Optional[str] = None
@@ -62,6 +382,31 @@ class QuerySet:
         """generate a new queryset from filter"""
         return cls(obj, name)
 
+    def _iter_rows(self) -> Iterator[Tuple[type, dict]]:
+        """Iterate over the class and __dict__ of matched objects"""
+        if self._data is not None:
+            for item in self._data:
+                yield type(item), item.__dict__
+            return
+
+        n = 0
+        self._pages.reload()
+        for cls, data in self._pages.iter_pages():
+            if isinstance(data, ColumnBlock):
+                rows = map(data.row, data.select(self._filters))
+            else:
+                rows = (row for row in data if _match(row, self._filters))
+            for row in rows:
+                if self._limit is not None and n >= self._limit:
+                    return
+                n += 1
+                yield cls, row
+
+    def __iter__(self) -> Iterator[BaseORMModel]:
+        if self._data is not None:
+            return iter(self._data)
+        return (_build(cls, row) for cls, row in self._iter_rows())
+
     def filter(self, **kwargs) -> "QuerySet":
         """
         filter by specified parameter
@@ -84,28 +429,181 @@ class QuerySet:
             # filter by multiple parameters
             orm_cache.query("User").filter(name="jack", age=18).first()
         """
-        result: List[BaseORMModel] = []
-        for item in self._data:
-            is_target = True
-            for query_key in kwargs.keys():
-                if item.__dict__[query_key] != kwargs[query_key]:
-                    is_target = False
-                    continue
-            if is_target:
-                result.append(item)
-
+        if self._data is None and self._limit is None:
+            return self._from_pages(
+                self._pages, self.__name__, {**self._filters, **kwargs}
+            )
+
+        result: List[BaseORMModel] = [
+            item for item in self if _match(item.__dict__, kwargs)
+        ]
         return self._from_filter(result, self.__name__)
 
+    def limit(self, n: int) -> "QuerySet":
+        """get a new queryset with at most n objects"""
+        if self._data is not None:
+            return self._from_filter(self._data[:n], self.__name__)
+        if self._limit is not None:
+            n = min(n, self._limit)
+        return self._from_pages(self._pages, self.__name__, self._filters, n)
+
+    def count(self) -> int:
+        """count objects without loading them into model objects"""
+        if self._data is not None:
+            return len(self._data)
+        if not self._filters:
+            self._pages.reload()
+            count = self._pages.count()
+            return count if self._limit is None else min(count, self._limit)
+        return sum(n for n, _ in self._iter_columns([]))
+
+    def _iter_columns(self, fields: List[str]) -> Iterator[Tuple[int, List[Sequence]]]:
+        """
+        Iterate over the number of matched objects and the values of fields in each
+        page, columnar pages are read without building rows.
+        """
+        if self._data is not None:
+            rows = [item.__dict__ for item in self._data]
+            yield len(rows), [[row[f] for row in rows] for f in fields]
+            return
+
+        remaining = self._limit
+        self._pages.reload()
+        for _, data in self._pages.iter_pages():
+            if remaining is not None and remaining <= 0:
+                return
+            if isinstance(data, ColumnBlock):
+                indexes = None
+                if self._filters or (remaining is not None and remaining < len(data)):
+                    indexes = data.select(self._filters)[:remaining]
+                n = len(data) if indexes is None else len(indexes)
+                columns = [data.column(f, indexes) for f in fields]
+            else:
+                rows = [row for row in data if _match(row, self._filters)]
+                rows = rows[:remaining]
+                n = len(rows)
+                columns = [[row[f] for row in rows] for f in fields]
+            if remaining is not None:
+                remaining -= n
+            yield n, columns
+
+    def sum(self, field: str):
+        """sum of a field of matched objects"""
+        return sum(sum(columns[0]) for _, columns in self._iter_columns([field]))
+
+    def min(self, field: str):
+        """min value of a field of matched objects, None if nothing is matched"""
+        values = [min(c[0]) for n, c in self._iter_columns([field]) if n]
+        return min(values) if values else None
+
+    def max(self, field: str):
+        """max value of a field of matched objects, None if nothing is matched"""
+        values = [max(c[0]) for n, c in self._iter_columns([field]) if n]
+        return max(values) if values else None
+
+    def avg(self, field: str) -> Optional[float]:
+        """average value of a field of matched objects, None if nothing is matched"""
+        total, count = 0, 0
+        for n, columns in self._iter_columns([field]):
+            total += sum(columns[0])
+            count += n
+        return total / count if count else None
+
+    def values(self, *fields: str) -> List[dict]:
+        """
+        Get the fields of matched objects as dicts, without building model objects.
+        All fields are returned if no field is specified.
+
+        Examples:
+            orm_cache.query("User").filter(age=18).values("name")
+            # [{"name": "jack"}, {"name": "jasmine"}]
+        """
+        if not fields:
+            return [dict(row) for _, row in self._iter_rows()]
+        return [dict(zip(fields, row)) for row in self.values_list(*fields)]
+
+    def values_list(self, *fields: str, flat: bool = False) -> List:
+        """
+        Get the fields of matched objects as tuples, or as single values if flat is
+        True and only one field is specified.
+
+        Examples:
+            orm_cache.query("User").values_list("name", "age")
+            # [("jack", 18), ("jasmine", 18)]
+            orm_cache.query("User").values_list("name", flat=True)
+            # ["jack", "jasmine"]
+        """
+        if flat and len(fields) != 1:
+            raise ValueError("flat is only supported with a single field")
+        result = []
+        for _, columns in self._iter_columns(list(fields)):
+            result.extend(columns[0] if flat else zip(*columns))
+        return result
+
+    def group_by(
+        self, field: str, func: str = "count", target: Optional[str] = None
+    ) -> Dict[Any, Any]:
+        """
+        Group matched objects by the value of a field and aggregate each group.
+
+        Args:
+            field: the field to group by
+            func: "count", "sum", "min", "max" or "avg"
+            target: the field aggregated by func, not needed for "count"
+
+        Returns: a dict from each value of field to the aggregate of its group
+
+        Examples:
+            orm_cache.query("User").group_by("age")
+            # {18: 2, 20: 1}
+            orm_cache.query("Order").group_by("user", "sum", "price")
+        """
+        if func not in ("count", "sum", "min", "max", "avg"):
+            raise ValueError(f"unknown aggregate function: {func}")
+        if func != "count" and target is None:
+            raise ValueError(f"target field is required by {func}")
+
+        fields = [field] if func == "count" else [field, target]
+        groups: Dict[Any, List] = {}
+        for _, columns in self._iter_columns(fields):
+            if func == "count":
+                for key in columns[0]:
+                    groups[key] = groups.get(key, 0) + 1
+                continue
+            for key, value in zip(*columns):
+                group = groups.get(key)
+                if group is None:
+                    groups[key] = [value, 1]
+                elif func == "min":
+                    group[0] = min(group[0], value)
+                elif func == "max":
+                    group[0] = max(group[0], value)
+                else:
+                    group[0] += value
+                    group[1] += 1
+
+        if func == "count":
+            return groups
+        if func == "avg":
+            return {key: total / n for key, (total, n) in groups.items()}
+        return {key: group[0] for key, group in groups.items()}
+
     def all(self) -> Optional[List]:
+        if self._data is None:
+            self._data = list(self)
         return self._data
 
     def first(self):
-        if len(self._data) == 0:
-            return None
-        return self._data[0]
+        return next(iter(self), None)
+
+    def __getitem__(self, index: int) -> BaseORMModel:
+        if self._data is None and not self._filters and self._limit is None:
+            self._pages.reload()
+            return self._pages.get(index)
+        return self.all()[index]
 
     def print_all(self):
-        for item in self._data:
+        for item in self:
             print(f"[cushy-storage orm] {item.__dict__}")
 
     @classmethod
@@ -115,15 +613,15 @@ class QuerySet:
         return cls(obj, name)
 
     def remove_duplicates(self) -> Optional["QuerySet"]:
-        if len(self._data) == 0:
-            return None
-
-        result_element_hash = []
+        result_element_hash = set()
         result: List[BaseORMModel] = []
-        for obj in self._data:
-            if obj.__get_element_hash__() not in result_element_hash:
-                result_element_hash.append(obj.__get_element_hash__())
+        for obj in self:
+            element_hash = obj.__get_element_hash__()
+            if element_hash not in result_element_hash:
+                result_element_hash.add(element_hash)
                 result.append(obj)
+        if len(result) == 0:
+            return None
         return self._from_remove_duplicates(result, name=self.__name__)
 
 
@@ -141,94 +639,248 @@ def _get_obj_name(obj: Union[BaseORMModel, QuerySet, List[BaseORMModel]]) -> str
         return obj[0].__name__
 
 
+def _to_list(obj: Union[BaseORMModel, QuerySet, List[BaseORMModel]]) -> List:
+    if isinstance(obj, BaseORMModel):
+        return [obj]
+    elif isinstance(obj, QuerySet):
+        return obj.all()
+    return obj
+
+
+def _apply_ops(
+    items: List,
+    ops: List[Tuple[str, List[BaseORMModel]]],
+    unique_id: Callable[[Any], str],
+    replace: Callable[[BaseORMModel], Any],
+    found: Set[str],
+) -> List:
+    """
+    Apply delete and update operations to items, which are objects or their
+    __dict__. The same list is returned if nothing is changed, and ids of updated
+    objects are added to found.
+    """
+    result = items
+    for op, objs in ops:
+        if op == "delete":
+            unique_ids = {obj.__unique_id__ for obj in objs}
+            kept = [item for item in result if unique_id(item) not in unique_ids]
+            if len(kept) != len(result):
+                result = kept
+        elif op == "update":
+            updated = {obj.__unique_id__: obj for obj in objs}
+            if any(unique_id(item) in updated for item in result):
+                new_result = []
+                for item in result:
+                    obj = updated.get(unique_id(item))
+                    if obj is None:
+                        new_result.append(item)
+                    else:
+                        found.add(obj.__unique_id__)
+                        new_result.append(replace(obj))
+                result = new_result
+    return result
+
+
+def _row_id(row: dict) -> str:
+    return row["__unique_id__"]
+
+
+def _obj_id(obj: BaseORMModel) -> str:
+    return obj.__unique_id__
+
+
+class Session:
+    """
+    Unit of work for ORM writes. Adds, updates and deletes are collected in memory,
+    and each touched model is written only once when the session commits. Pages
+    not touched by the changes are kept as they are. Nothing is written if the
+    session rolls back.
+
+    Examples:
+        from cushy_storage import CushyOrmCache
+
+        orm_cache = CushyOrmCache()
+        with orm_cache.session() as s:
+            for i in range(10000):
+                s.add(User(f"user{i}", 18))
+            s.delete(orm_cache.query(User).filter(name="jack").all())
+        # committed here, or rolled back if an exception is raised
+    """
+
+    def __init__(self, cache: "ORMMixin"):
+        self._cache = cache
+        # pending operations of each model: (operation, objects)
+        self._ops: Dict[str, List[Tuple[str, List[BaseORMModel]]]] = {}
+
+    def _append(self, op: str, obj: Union[BaseORMModel, QuerySet, List]):
+        objs = _to_list(obj)
+        if len(objs) == 0:
+            return
+        ops = self._ops.setdefault(_get_obj_name(obj), [])
+        # merge with the previous operation of the same type
+        if ops and ops[-1][0] == op:
+            ops[-1][1].extend(objs)
+        else:
+            ops.append((op, list(objs)))
+
+    def add(self, obj: Union[BaseORMModel, QuerySet, List[BaseORMModel]]):
+        self._append("add", obj)
+
+    def delete(self, obj: Union[BaseORMModel, QuerySet, List[BaseORMModel]]):
+        """delete obj by obj.__unique_id__"""
+        self._append("delete", obj)
+
+    def update_obj(self, obj: Union[BaseORMModel, QuerySet, List[BaseORMModel]]):
+        self._append("update", obj)
+
+    def _added(self, class_name: str, found: Set[str]) -> List[BaseORMModel]:
+        """Get objects added in the session, with later operations applied"""
+        ops = self._ops.get(class_name, [])
+        added = []
+        for i, (op, objs) in enumerate(ops):
+            if op == "add":
+                added += _apply_ops(objs, ops[i + 1 :], _obj_id, lambda o: o, found)
+        return added
+
+    def query(self, class_name_or_obj: Union[str, type(BaseORMModel)]) -> QuerySet:
+        """query all objects by class name, including pending changes"""
+        class_name = _get_class_name(class_name_or_obj)
+        ops = self._ops.get(class_name, [])
+        found = set()
+        stored = self._cache.query(class_name).all()
+        data = _apply_ops(stored, ops, _obj_id, lambda o: o, found)
+        return QuerySet(data + self._added(class_name, found), name=class_name)
+
+    def _prepare(
+        self, class_name: str
+    ) -> Tuple[_ModelPages, List[List], List[str], List[str]]:
+        """Write the new pages of a model, see `_ModelPages.prepare()`"""
+        ops = self._ops[class_name]
+        found = set()
+        updated = {
+            obj.__unique_id__ for op, objs in ops if op == "update" for obj in objs
+        }
+
+        def transform(rows: List[dict]) -> List[dict]:
+            return _apply_ops(rows, ops, _row_id, lambda o: o.__dict__, found)
+
+        def validate():
+            missing = updated - found
+            if missing:
+                raise ValueError(f"can not found object: {missing.pop()}")
+
+        pages = self._cache._get_model_pages(class_name)
+        added = self._added(class_name, found)
+        has_changes = any(op != "add" for op, _ in ops)
+        return (
+            pages,
+            *pages.prepare(transform if has_changes else None, added, validate),
+        )
+
+    def commit(self):
+        """
+        Write all pending changes, each touched model is written once. New pages of
+        all models are written and checked before any manifest is replaced, so
+        nothing is changed if it raises.
+        """
+        try:
+            prepared = []
+            try:
+                for class_name in self._ops:
+                    prepared.append(self._prepare(class_name))
+            except BaseException:
+                for pages, _, created, _ in prepared:
+                    pages.remove_pages(created)
+                raise
+
+            swapped: List[_ModelPages] = []
+            try:
+                for pages, new_pages, _, _ in prepared:
+                    pages.swap(new_pages)
+                    swapped.append(pages)
+            except BaseException:
+                for pages in swapped:
+                    pages.restore()
+                for pages, _, created, _ in prepared:
+                    pages.remove_pages(created)
+                raise
+
+            for pages, _, _, removed in prepared:
+                pages.remove_pages(removed)
+        finally:
+            self._ops.clear()
+
+    def rollback(self):
+        """Discard all pending changes"""
+        self._ops.clear()
+
+    def __enter__(self) -> "Session":
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.commit()
+        else:
+            self.rollback()
+
+
 class ORMMixin(ABC):
+    page_size: int = _DEFAULT_PAGE_SIZE
+
+    def _get_model_pages(
+        self, class_name_or_obj: Union[str, type(BaseORMModel)], load: bool = True
+    ) -> _ModelPages:
+        class_name = _get_class_name(class_name_or_obj)
+        return _ModelPages(self, class_name, self.page_size, load)
+
     def _get_original_data_from_cache(
         self, class_name_or_obj: Union[str, type(BaseORMModel)]
     ) -> List[BaseORMModel]:
-        class_name = _get_class_name(class_name_or_obj)
-        if class_name not in self:
-            self.__setitem__(class_name, [])
-        return self.__getitem__(class_name)
+        return self.query(class_name_or_obj).all()
 
     def query(self, class_name_or_obj: Union[str, type(BaseORMModel)]) -> QuerySet:
-        """query all objects by class name"""
-        logger.info(f"[orm] query all objects, class name {class_name_or_obj}")
-        original_result = self._get_original_data_from_cache(class_name_or_obj)
-        if len(original_result) == 0:
-            return QuerySet(original_result, name=_get_class_name(class_name_or_obj))
-        return QuerySet(original_result)
+        """query all objects by class name, objects are loaded page by page"""
+        logger.debug("[orm] query all objects, class name %s", class_name_or_obj)
+        class_name = _get_class_name(class_name_or_obj)
+        pages = self._get_model_pages(class_name, load=False)
+        return QuerySet._from_pages(pages, class_name)
 
     def remove_duplicates(self, class_name_or_obj: Union[type(BaseORMModel), str]):
-        logger.info(f"[orm] remove duplicates, class name {class_name_or_obj}")
-        original_result = self._get_original_data_from_cache(class_name_or_obj)
-        if len(original_result) != 0:
-            queryset = QuerySet(original_result)
-            queryset = queryset.remove_duplicates()
+        logger.debug("[orm] remove duplicates, class name %s", class_name_or_obj)
+        queryset = self.query(class_name_or_obj).remove_duplicates()
+        if queryset is not None:
             self.set(queryset)
 
     def add(self, obj: Union[BaseORMModel, QuerySet, List[BaseORMModel]]) -> QuerySet:
-        logger.info(f"[orm] add object, object {obj}")
+        logger.debug("[orm] add object, object %s", obj)
         obj_name = _get_obj_name(obj)
-        original_result: List[BaseORMModel] = self._get_original_data_from_cache(
-            obj_name
-        )
-
-        if isinstance(obj, BaseORMModel):
-            original_result.append(obj)
-        elif isinstance(obj, QuerySet):
-            original_result += obj.all()
-        else:
-            original_result += obj
-
-        self[obj_name] = original_result
-        return QuerySet(self[obj_name])
+        self._get_model_pages(obj_name).update(append=_to_list(obj))
+        return self.query(obj_name)
 
     def delete(self, obj: Union[List[BaseORMModel], QuerySet, BaseORMModel]):
         """delete obj by obj.__unique_id__"""
-        logger.info(f"[orm] delete object, object {obj}")
-        obj_name = _get_obj_name(obj)
-        original_result: List[BaseORMModel] = self._get_original_data_from_cache(
-            obj_name
-        )
-        copy_result: List[BaseORMModel] = original_result.copy()
-
-        if isinstance(obj, BaseORMModel):
-            obj = [obj]
-        elif isinstance(obj, QuerySet):
-            obj = obj.all()
-        if len(obj) == 0:
-            return
-
-        for cache_obj_item in original_result:
-            for input_obj_item in obj:
-                if cache_obj_item.__unique_id__ == input_obj_item.__unique_id__:
-                    copy_result.remove(cache_obj_item)
-        return self.__setitem__(obj_name, copy_result)
+        logger.debug("[orm] delete object, object %s", obj)
+        with self.session() as s:
+            s.delete(obj)
 
     def set(self, obj: Union[BaseORMModel, QuerySet, List[BaseORMModel]]):
-        logger.info(f"[orm] set object, object {obj}")
+        logger.debug("[orm] set object, object %s", obj)
         obj_name = _get_obj_name(obj)
-        if isinstance(obj, BaseORMModel):
-            obj = [obj]
-        elif isinstance(obj, QuerySet):
-            obj = obj.all()
+        obj = _to_list(obj)
         if len(obj) == 0:
             return
-        return self.__setitem__(obj_name, obj)
+        self._get_model_pages(obj_name).update(append=obj, replace=True)
 
     def update_obj(self, obj: BaseORMModel):
-        logger.info(f"[orm] update object, object {obj}")
-        original_result: List[BaseORMModel] = self._get_original_data_from_cache(
-            obj.__name__
-        )
-        copy_result: List[BaseORMModel] = original_result.copy()
+        logger.debug("[orm] update object, object %s", obj)
+        with self.session() as s:
+            s.update_obj(obj)
 
-        for i in range(len(copy_result)):
-            if copy_result[i].__unique_id__ == obj.__unique_id__:
-                copy_result[i] = obj
-                return self.__setitem__(obj.__name__, copy_result)
-
-        raise ValueError(f"can not found object: {obj}")
+    def session(self) -> Session:
+        """
+        Start a unit of work, writes in the session are flushed together on commit.
+        """
+        return Session(self)
 
     def __getitem__(self, item) -> List[BaseORMModel]:
         """implemented by CushyDict"""
@@ -238,9 +890,78 @@ class ORMMixin(ABC):
 
 
 class CushyOrmCache(CushyDict, ORMMixin):
+    """
+    ORM cache based on CushyDict, objects of each model are stored in pages.
+
+    Args:
+        path (Optional[str]): The path where the cache files will be stored.
+            Defaults to the default cache path.
+        compress (Union[str, Tuple[Callable, Callable], None]): The compression
+            method to use. Defaults to None.
+        stats (bool): Collect counters and latency histograms in `self.stats`.
+            Defaults to False.
+        page_size (int): The number of objects stored in a page. Defaults to 1000.
+    """
+
     def __init__(
         self,
-        path: str = get_default_cache_path(),
+        path: Optional[str] = None,
         compress: Union[str, Tuple[Callable, Callable], None] = None,
+        stats: bool = False,
+        page_size: int = _DEFAULT_PAGE_SIZE,
     ):
-        super().__init__(path, compress, "pickle")
+        if path is None:
+            path = get_default_cache_path()
+        super().__init__(path, compress, "pickle", stats=stats)
+        # the command line rebuilds page manifests of caches of this kind
+        self._update_config(None, False, kind="orm")
+        self.page_size = page_size
+        self._init_options = dict(compress=compress, stats=stats, page_size=page_size)
+
+    def _rebuild_index(self) -> List[str]:
+        """
+        Rebuild page manifests of models. Pages lost by repair are removed from
+        manifests, pages left by interrupted writes are removed, and a lost manifest
+        is rebuilt from the remaining pages of the model.
+        """
+        pages: Dict[str, Set[str]] = {}
+        manifests: Dict[str, Optional[dict]] = {}
+        for k in self:
+            match = _PAGE_KEY.match(k)
+            if match is not None:
+                pages.setdefault(match[1], set()).add(match[2])
+                continue
+            value = self[k]
+            if isinstance(value, dict) and isinstance(value.get("pages"), list):
+                manifests[k] = value
+
+        rebuilt = []
+        for name in sorted(set(pages) | set(manifests)):
+            page_ids = pages.get(name, set())
+            manifest = manifests.get(name)
+            if manifest is None:
+                if name in self:
+                    # not a manifest, such as a model stored as a list
+                    continue
+                kept = []
+                for page_id in sorted(page_ids):
+                    page = self[f"{name}@{page_id}"]
+                    # a key of the user which looks like a page
+                    if not isinstance(page, dict) or "cls" not in page:
+                        continue
+                    data = page["columns"] if "columns" in page else page.get("rows")
+                    if data is None:
+                        continue
+                    kept.append([page_id, len(data)])
+                if not kept:
+                    continue
+            else:
+                listed = {page_id for page_id, _ in manifest["pages"]}
+                for page_id in page_ids - listed:
+                    del self[f"{name}@{page_id}"]
+                kept = [p for p in manifest["pages"] if p[0] in page_ids]
+                if len(kept) == len(manifest["pages"]):
+                    continue
+            self[name] = {"pages": kept}
+            rebuilt.append(name)
+        return rebuilt
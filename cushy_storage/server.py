@@ -0,0 +1,407 @@
+# Copyright (c) 2023 Zeeland
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# Copyright Owner: Zeeland
+# GitHub Link: https://github.com/Undertone0809/
+# Project Link: https://github.com/Undertone0809/cushy-storage
+# Contact Email: zeeland@foxmail.com
+
+
+"""
+Serve one cache to co-located processes, so they share its memory tier and hot
+values instead of each keeping its own.
+
+    from cushy_storage import CushyDict
+    from cushy_storage.server import CacheClient, CacheServer
+
+    server = CacheServer(CushyDict("./cache", memory_items=100000), "/tmp/cushy.sock")
+    server.start()
+
+    client = CacheClient("/tmp/cushy.sock")
+    client["a"] = 1
+"""
+
+import errno
+import os
+import pickle
+import queue
+import socket
+import stat
+import threading
+from contextlib import contextmanager
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Client, Connection, Listener
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    MutableMapping,
+    Optional,
+    Tuple,
+    Union,
+)
+
+from cushy_storage.utils.logger import logger
+
+__all__ = ["CacheServer", "CacheClient", "Pipeline"]
+
+# A unix domain socket path, or a (host, port) tuple of a TCP address
+Address = Union[str, Tuple[str, int]]
+
+# Operations served to clients, each maps a cache and arguments to a result
+_OPERATIONS: Dict[str, Callable] = {
+    "get": lambda cache, k: cache[k],
+    "set": lambda cache, k, v: cache.__setitem__(k, v),
+    "delete": lambda cache, k: cache.__delitem__(k),
+    "contains": lambda cache, k: k in cache,
+    "len": lambda cache: len(cache),
+    "keys": lambda cache: list(cache),
+    "clear": lambda cache: cache.clear(),
+    "delete_prefix": lambda cache, prefix: cache.delete_prefix(prefix),
+    "flush": lambda cache: cache.flush(),
+    "incr": lambda cache, k, delta, default: cache.incr(k, delta, default),
+    "append_to": lambda cache, k, item: cache.append_to(k, item),
+    "get_version": lambda cache, k: cache.get_version(k),
+    "get_with_version": lambda cache, k: cache.get_with_version(k),
+    "compare_and_set": lambda cache, k, version, v: cache.compare_and_set(
+        k, version, v
+    ),
+    "stats": lambda cache: None if cache.stats is None else cache.stats.snapshot(),
+}
+
+
+def _check_address(address: Address, authkey: Optional[bytes]):
+    # anyone who can connect can send pickles, which run code when loaded
+    if not isinstance(address, str) and authkey is None:
+        raise ValueError("authkey is required for a cache server over TCP")
+
+
+def _remove_stale_socket(path: str):
+    """Remove the socket file left by a server which is not running. An error is
+    raised if the path is not a socket, or a server is still listening on it."""
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return
+    if not stat.S_ISSOCK(st.st_mode):
+        raise FileExistsError(errno.EEXIST, "the path exists and is not a socket", path)
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        try:
+            sock.connect(path)
+        except ConnectionRefusedError:
+            os.unlink(path)
+            return
+    raise OSError(errno.EADDRINUSE, "a server is already running", path)
+
+
+def _sendable(op: str, result: Tuple[bool, Any]) -> Tuple[bool, Any]:
+    """Replace a result which can not be pickled by an error"""
+    try:
+        pickle.dumps(result)
+    except Exception as e:
+        return False, TypeError(f"can not send the result of {op}: {e!r}")
+    return result
+
+
+class CacheServer:
+    """
+    Serve a cache over a unix domain socket or localhost TCP. Each client connection
+    is served by a thread, and a request is a batch of operations executed in order,
+    so a client pays one round trip for many operations.
+
+    Args:
+        cache: the cache to serve, usually a CushyDict with a memory tier
+        address: the path of a unix domain socket, or a (host, port) tuple of TCP.
+            Port 0 picks a free port, see `self.address`.
+        authkey: the secret clients must know, required for TCP
+    """
+
+    def __init__(self, cache, address: Address, authkey: Optional[bytes] = None):
+        _check_address(address, authkey)
+        self.cache = cache
+        if isinstance(address, str):
+            _remove_stale_socket(address)
+        self._listener = Listener(address, authkey=authkey)
+        self.address: Address = self._listener.address
+        self._closed = threading.Event()
+
+    def serve_forever(self):
+        """Accept and serve clients until `close()` is called"""
+        logger.info("[cushy-storage] Serving %s at %s", self.cache.path, self.address)
+        while not self._closed.is_set():
+            try:
+                conn = self._listener.accept()
+            except (EOFError, AuthenticationError) as e:
+                # clients which closed or failed the handshake, such as the check
+                # of another server on the same socket
+                logger.warning("[cushy-storage] Rejected a client: %r", e)
+                continue
+            except OSError:
+                if self._closed.is_set():
+                    return
+                logger.exception("[cushy-storage] Failed to accept a client")
+                continue
+            threading.Thread(
+                target=self._serve,
+                args=(conn,),
+                name="cushy-storage-client",
+                daemon=True,
+            ).start()
+
+    def start(self) -> "CacheServer":
+        """Serve clients in a background thread"""
+        threading.Thread(
+            target=self.serve_forever, name="cushy-storage-server", daemon=True
+        ).start()
+        return self
+
+    def close(self):
+        """Stop accepting clients and flush the cache"""
+        self._closed.set()
+        self._listener.close()
+        self.cache.flush()
+
+    def _serve(self, conn: Connection):
+        with conn:
+            while True:
+                try:
+                    batch = conn.recv()
+                    results = [self._execute(op, args) for op, args in batch]
+                    try:
+                        conn.send(results)
+                    except (pickle.PicklingError, TypeError, AttributeError):
+                        # results are pickled before anything is sent, so the
+                        # connection is still usable
+                        ops = [op for op, _ in batch]
+                        conn.send(list(map(_sendable, ops, results)))
+                except (EOFError, OSError):
+                    return
+
+    def _execute(self, op: str, args: tuple) -> Tuple[bool, Any]:
+        fn = _OPERATIONS.get(op)
+        if fn is None:
+            return False, ValueError(f"unknown operation: {op}")
+        try:
+            value = fn(self.cache, *args)
+        except Exception as e:
+            return False, e
+        # values of use_mmap caches are views of the mapped files
+        if isinstance(value, memoryview):
+            value = bytes(value)
+        return True, value
+
+
+class Pipeline:
+    """
+    Operations queued by a client and sent in one request, see
+    `CacheClient.pipeline()`. Methods queue an operation and return the pipeline.
+    """
+
+    def __init__(self, client: "CacheClient"):
+        self._client = client
+        self._batch: List[Tuple[str, tuple]] = []
+
+    def get(self, k: str) -> "Pipeline":
+        self._batch.append(("get", (k,)))
+        return self
+
+    def set(self, k: str, v) -> "Pipeline":
+        self._batch.append(("set", (k, v)))
+        return self
+
+    def delete(self, k: str) -> "Pipeline":
+        self._batch.append(("delete", (k,)))
+        return self
+
+    def contains(self, k: str) -> "Pipeline":
+        self._batch.append(("contains", (k,)))
+        return self
+
+    def incr(self, k: str, delta: int = 1, default: int = 0) -> "Pipeline":
+        self._batch.append(("incr", (k, delta, default)))
+        return self
+
+    def execute(self) -> List:
+        """
+        Send all queued operations in one request. The first exception is raised
+        after all operations are executed.
+
+        Returns: the results of the operations in order
+        """
+        batch, self._batch = self._batch, []
+        results = []
+        error = None
+        for ok, value in self._client._request(batch):
+            if not ok and error is None:
+                error = value
+            results.append(value)
+        if error is not None:
+            raise error
+        return results
+
+    def __enter__(self) -> "Pipeline":
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.execute()
+
+
+class CacheClient(MutableMapping[str, Any]):
+    """
+    A client of `CacheServer` with the interface of CushyDict. Connections are
+    pooled, so a client can be shared by threads, and it reconnects in a forked
+    process. Values are pickled on the way, they are stored with the serialization
+    of the served cache.
+
+    Args:
+        address: the address of the server
+        authkey: the secret of the server
+        pool_size: max number of idle connections kept
+    """
+
+    def __init__(
+        self, address: Address, authkey: Optional[bytes] = None, pool_size: int = 8
+    ):
+        _check_address(address, authkey)
+        self.address = address
+        self.authkey = authkey
+        self.stats = None
+        self._pool: "queue.LifoQueue[Connection]" = queue.LifoQueue(pool_size)
+        self._pid = os.getpid()
+
+    @contextmanager
+    def _connection(self) -> Iterator[Connection]:
+        if self._pid != os.getpid():
+            # connections of the parent process must not be shared
+            self._pool = queue.LifoQueue(self._pool.maxsize)
+            self._pid = os.getpid()
+        try:
+            conn = self._pool.get_nowait()
+        except queue.Empty:
+            conn = Client(self.address, authkey=self.authkey)
+        try:
+            yield conn
+        except BaseException:
+            conn.close()
+            raise
+        try:
+            self._pool.put_nowait(conn)
+        except queue.Full:
+            conn.close()
+
+    def _request(self, batch: List[Tuple[str, tuple]]) -> List[Tuple[bool, Any]]:
+        if not batch:
+            return []
+        with self._connection() as conn:
+            conn.send(batch)
+            return conn.recv()
+
+    def _call(self, op: str, *args):
+        ok, value = self._request([(op, args)])[0]
+        if not ok:
+            raise value
+        return value
+
+    def __getitem__(self, k: str):
+        return self._call("get", k)
+
+    def __setitem__(self, k: str, v):
+        self._call("set", k, v)
+
+    def __delitem__(self, k: str):
+        self._call("delete", k)
+
+    def __contains__(self, k: object) -> bool:
+        return self._call("contains", k)
+
+    def __len__(self) -> int:
+        return self._call("len")
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._call("keys"))
+
+    def clear(self):
+        self._call("clear")
+
+    def delete_prefix(self, prefix: str):
+        self._call("delete_prefix", prefix)
+
+    def flush(self):
+        self._call("flush")
+
+    def incr(self, k: str, delta: int = 1, default: int = 0):
+        return self._call("incr", k, delta, default)
+
+    def decr(self, k: str, delta: int = 1, default: int = 0):
+        return self._call("incr", k, -delta, default)
+
+    def append_to(self, k: str, item: Any) -> List:
+        return self._call("append_to", k, item)
+
+    def get_version(self, k: str) -> Optional[str]:
+        return self._call("get_version", k)
+
+    def get_with_version(self, k: str) -> Tuple[Any, str]:
+        return self._call("get_with_version", k)
+
+    def compare_and_set(self, k: str, expected_version: Optional[str], v) -> bool:
+        return self._call("compare_and_set", k, expected_version, v)
+
+    def server_stats(self) -> Optional[Dict[str, Any]]:
+        """Get the stats snapshot of the served cache, None if stats is off"""
+        return self._call("stats")
+
+    def get_many(self, keys: Iterable[str]) -> Dict[str, Any]:
+        """
+        Get the values of many keys in one request, missing keys are skipped and
+        other errors are raised
+        """
+        keys = list(keys)
+        values = {}
+        for k, (ok, value) in zip(keys, self._request([("get", (k,)) for k in keys])):
+            if ok:
+                values[k] = value
+            elif not isinstance(value, KeyError):
+                raise value
+        return values
+
+    def set_many(self, mapping: Dict[str, Any]):
+        """Set the values of many keys in one request"""
+        for ok, value in self._request([("set", kv) for kv in mapping.items()]):
+            if not ok:
+                raise value
+
+    def pipeline(self) -> Pipeline:
+        """
+        Queue operations and send them in one request.
+
+        Examples:
+            with client.pipeline() as p:
+                p.set("a", 1).incr("hits").get("b")
+
+            results = client.pipeline().get("a").get("b").execute()
+        """
+        return Pipeline(self)
+
+    def close(self):
+        """Close idle connections"""
+        while True:
+            try:
+                self._pool.get_nowait().close()
+            except queue.Empty:
+                return
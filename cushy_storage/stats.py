@@ -0,0 +1,200 @@
+# Copyright (c) 2023 Zeeland
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# Copyright Owner: Zeeland
+# GitHub Link: https://github.com/Undertone0809/
+# Project Link: https://github.com/Undertone0809/cushy-storage
+# Contact Email: zeeland@foxmail.com
+
+
+import threading
+from typing import Callable, Dict, List, Optional
+
+from cushy_storage.utils.logger import logger
+
+# Counters of a cache
+COUNTERS = (
+    "hits",
+    "misses",
+    "memory_hits",
+    "dedup_hits",
+    "promotions",
+    "demotions",
+    "evictions",
+    "sets",
+    "deletes",
+    "bytes_read",
+    "bytes_written",
+    "raw_bytes_read",
+    "raw_bytes_written",
+)
+
+# Stages of cache operations whose latency is recorded
+STAGES = (
+    "get",
+    "set",
+    "io_read",
+    "io_write",
+    "serialize",
+    "deserialize",
+    "compress",
+    "decompress",
+    "lock_wait",
+)
+
+# Histogram buckets are powers of 2 in microseconds, the last one is about 1 hour
+_BUCKETS = 32
+
+
+class Histogram:
+    """Latency histogram with power of 2 buckets in microseconds"""
+
+    def __init__(self):
+        self.buckets: List[int] = [0] * _BUCKETS
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, seconds: float):
+        us = int(seconds * 1_000_000)
+        self.buckets[min(us.bit_length(), _BUCKETS - 1)] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def percentile(self, p: float) -> float:
+        """Get the upper bound of the bucket containing the percentile in seconds"""
+        if self.count == 0:
+            return 0.0
+        rank = p / 100 * self.count
+        seen = 0
+        for i, n in enumerate(self.buckets):
+            seen += n
+            if seen >= rank:
+                return min((1 << i) / 1_000_000, self.max)
+        return self.max
+
+    def snapshot(self) -> dict:
+        return {
+            "count": self.count,
+            "total": self.total,
+            "mean": self.total / self.count if self.count else 0.0,
+            "p50": self.percentile(50),
+            "p90": self.percentile(90),
+            "p99": self.percentile(99),
+            "max": self.max,
+        }
+
+
+class CacheStats:
+    """
+    Counters and latency histograms of a cache. Stats are disabled by default, pass
+    `stats=True` to a cache to enable them.
+
+    Examples:
+        from cushy_storage import CushyDict
+
+        cache = CushyDict("./cache", compress="zlib", stats=True)
+        cache["a"] = 1
+        print(cache["a"])
+        snapshot = cache.stats.snapshot()
+        print(snapshot["hit_ratio"], snapshot["latency"]["get"]["p99"])
+
+        # export a snapshot to your metrics system every 10 seconds
+        cache.stats.add_exporter(lambda s: print(s["counters"]), interval=10)
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._exporters: List[Callable[[dict], None]] = []
+        self._threads: List[threading.Thread] = []
+        self._stopped = threading.Event()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.counters: Dict[str, int] = {name: 0 for name in COUNTERS}
+            self.latency: Dict[str, Histogram] = {s: Histogram() for s in STAGES}
+            self.shard_lock_wait: Dict[str, float] = {}
+
+    def incr(self, name: str, n: int = 1):
+        with self._lock:
+            self.counters[name] += n
+
+    def record(self, stage: str, seconds: float):
+        with self._lock:
+            self.latency[stage].record(seconds)
+
+    def record_lock_wait(self, shard: str, seconds: float):
+        with self._lock:
+            self.latency["lock_wait"].record(seconds)
+            self.shard_lock_wait[shard] = self.shard_lock_wait.get(shard, 0) + seconds
+
+    def snapshot(self) -> dict:
+        """Get a copy of all stats"""
+        with self._lock:
+            counters = dict(self.counters)
+            latency = {stage: h.snapshot() for stage, h in self.latency.items()}
+            shard_lock_wait = dict(self.shard_lock_wait)
+
+        lookups = counters["hits"] + counters["misses"]
+        written = counters["bytes_written"]
+        return {
+            "counters": counters,
+            "hit_ratio": counters["hits"] / lookups if lookups else 0.0,
+            "compression_ratio": (
+                counters["raw_bytes_written"] / written if written else 0.0
+            ),
+            "latency": latency,
+            "shard_lock_wait": shard_lock_wait,
+        }
+
+    def add_exporter(
+        self, exporter: Callable[[dict], None], interval: Optional[float] = None
+    ):
+        """
+        Add a function to receive snapshots. If interval is specified, the
+        exporter is called in a background thread every interval seconds, otherwise
+        it is called by `export()`.
+        """
+        if interval is None:
+            self._exporters.append(exporter)
+            return
+
+        def run():
+            while not self._stopped.wait(interval):
+                try:
+                    exporter(self.snapshot())
+                except Exception:
+                    logger.exception("[cushy-storage] Failed to export stats")
+
+        thread = threading.Thread(target=run, name="cushy-storage-stats", daemon=True)
+        thread.start()
+        self._threads.append(thread)
+
+    def export(self):
+        """Send a snapshot to all exporters added without interval"""
+        snapshot = self.snapshot()
+        for exporter in self._exporters:
+            exporter(snapshot)
+
+    def close(self):
+        """Stop background exporters and wait for them to finish"""
+        self._stopped.set()
+        current = threading.current_thread()
+        for thread in self._threads:
+            if thread is not current:
+                thread.join()
+        self._threads = []
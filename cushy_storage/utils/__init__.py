@@ -18,7 +18,6 @@
 # Contact Email: zeeland@foxmail.com
 
 import os
-import tempfile
 
 
 def get_project_root_path() -> str:
@@ -52,6 +51,8 @@ def get_default_storage_path(module_name: str = "") -> str:
     try:
         os.makedirs(storage_path, exist_ok=True)
     except PermissionError:
+        import tempfile
+
         storage_path = os.path.join(tempfile.gettempdir(), "cushy-storage", module_name)
         os.makedirs(storage_path, exist_ok=True)
 
@@ -0,0 +1,95 @@
+# Copyright (c) 2023 Zeeland
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# Copyright Owner: Zeeland
+# GitHub Link: https://github.com/Undertone0809/
+# Project Link: https://github.com/Undertone0809/cushy-storage
+# Contact Email: zeeland@foxmail.com
+
+import collections
+import os
+import threading
+from typing import TYPE_CHECKING, Callable, Iterable, Iterator, List, Optional
+
+if TYPE_CHECKING:
+    from concurrent.futures import Future, ThreadPoolExecutor
+
+_PREFIX = "cushy-storage"
+
+_executor: Optional["ThreadPoolExecutor"] = None
+_lock = threading.Lock()
+
+
+def get_executor() -> "ThreadPoolExecutor":
+    """Get the thread pool shared by all caches, it is created on first use."""
+    global _executor
+    if _executor is None:
+        from concurrent.futures import ThreadPoolExecutor
+
+        with _lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(
+                    max_workers=min(32, (os.cpu_count() or 1) + 4),
+                    thread_name_prefix=_PREFIX,
+                )
+    return _executor
+
+
+def _in_worker() -> bool:
+    return threading.current_thread().name.startswith(_PREFIX)
+
+
+def submit(fn: Callable, *args) -> "Future":
+    """
+    Submit a task to the shared thread pool. The task runs in the current thread if
+    it is already a worker of the pool, waiting for other workers from a worker may
+    dead lock when the pool is exhausted.
+    """
+    if not _in_worker():
+        return get_executor().submit(fn, *args)
+
+    from concurrent.futures import Future
+
+    future = Future()
+    try:
+        future.set_result(fn(*args))
+    except BaseException as e:
+        future.set_exception(e)
+    return future
+
+
+def parallel_map(fn: Callable, items: Iterable) -> List:
+    """
+    Map items on the shared thread pool, items are mapped in the current thread if
+    it is already a worker of the pool.
+    """
+    items = list(items)
+    if len(items) <= 1 or _in_worker():
+        return [fn(item) for item in items]
+    return list(get_executor().map(fn, items))
+
+
+def read_ahead(fn: Callable, items: Iterable, window: int) -> Iterator:
+    """
+    Map items in order on the shared thread pool, with up to window items mapped
+    ahead of the consumer. Items are mapped in the current thread if it is already
+    a worker of the pool.
+    """
+    futures = collections.deque()
+    for item in items:
+        futures.append(submit(fn, item))
+        if len(futures) >= window:
+            yield futures.popleft().result()
+    while futures:
+        yield futures.popleft().result()
@@ -17,15 +17,21 @@
 # Project Link: https://github.com/Undertone0809/cushy-storage
 # Contact Email: zeeland@foxmail.com
 
+import atexit
 import datetime
+import itertools
 import logging
+import os
+import queue
 import sys
 import traceback
-from logging.handlers import TimedRotatingFileHandler
+from typing import Optional, Union
 
 from cushy_storage.utils import get_default_storage_path
 from cushy_storage.utils.singleton import Singleton
 
+_LOG_LEVEL_ENV = "CUSHY_STORAGE_LOG_LEVEL"
+
 
 def get_log_path() -> str:
     log_directory = get_default_storage_path("logs")
@@ -33,10 +39,37 @@ def get_log_path() -> str:
     return f"{log_directory}/{current_time}.log"
 
 
-class LogManager(metaclass=Singleton):
-    def __init__(self) -> None:
-        self.logger = logging.getLogger("cushy_storage")
-        self.logger.setLevel(logging.DEBUG)
+class _SamplingFilter(logging.Filter):
+    """Keep one of every `1 / sample_rate` records below WARNING"""
+
+    def __init__(self, sample_rate: float):
+        super().__init__()
+        self.interval = max(1, round(1 / sample_rate))
+        self.count = itertools.count()
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= logging.WARNING:
+            return True
+        return next(self.count) % self.interval == 0
+
+
+class _LazyFileHandler(logging.Handler):
+    """
+    Hand log records to a background thread which writes them to the log file. The
+    log file and the thread are created when the first record is emitted, so an
+    idle logger costs nothing.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self._queue_handler: Optional[logging.Handler] = None
+
+    def _start(self):
+        from logging.handlers import (
+            QueueHandler,
+            QueueListener,
+            TimedRotatingFileHandler,
+        )
 
         file_handler = TimedRotatingFileHandler(
             filename=get_log_path(),
@@ -53,7 +86,81 @@ class LogManager(metaclass=Singleton):
 
         file_handler.setFormatter(formatter)
 
-        self.logger.addHandler(file_handler)
+        log_queue = queue.SimpleQueue()
+        listener = QueueListener(log_queue, file_handler)
+        listener.start()
+        atexit.register(listener.stop)
+        self._queue_handler = QueueHandler(log_queue)
+
+    def emit(self, record: logging.LogRecord):
+        # handle() holds self.lock, the handler is started only once
+        if self._queue_handler is None:
+            self._start()
+        self._queue_handler.emit(record)
+
+
+class LogManager(metaclass=Singleton):
+    """
+    Manage the logger of cushy-storage. Only warnings and errors are logged by
+    default, cache operations are logged at DEBUG level and are skipped without
+    formatting the message. Log records are written to the log file by a background
+    thread, so logging never blocks cache operations on file writes. The log file is
+    created when the first record is logged.
+
+    The default level can be changed by the `CUSHY_STORAGE_LOG_LEVEL` environment
+    variable.
+    """
+
+    def __init__(self) -> None:
+        self.logger = logging.getLogger("cushy_storage")
+        self.logger.setLevel(os.environ.get(_LOG_LEVEL_ENV, "WARNING").upper())
+        self.sampling_filter: Optional[_SamplingFilter] = None
+        self.handler = _LazyFileHandler()
+        self.logger.addHandler(self.handler)
+        self._exception_hook_installed = False
+
+    def set_level(self, level: Union[int, str], sample_rate: float = 1.0):
+        """
+        Set the log level.
+
+        Args:
+            level: log level, such as logging.DEBUG or "DEBUG"
+            sample_rate: the fraction of records below WARNING to keep, use it to
+                trace cache operations under heavy load
+        """
+        self.logger.setLevel(level.upper() if isinstance(level, str) else level)
+        if self.sampling_filter is not None:
+            self.handler.removeFilter(self.sampling_filter)
+            self.sampling_filter = None
+        if sample_rate < 1:
+            self.sampling_filter = _SamplingFilter(sample_rate)
+            self.handler.addFilter(self.sampling_filter)
+
+    def install_exception_hook(self):
+        """Log uncaught exceptions, it is installed when the first cache is used."""
+        if not self._exception_hook_installed:
+            self._exception_hook_installed = True
+            sys.excepthook = exception_handler
+
+
+def enable_debug_logging(sample_rate: float = 1.0):
+    """
+    Log every cache operation, or a sample of them, to the log file.
+
+    Args:
+        sample_rate: the fraction of cache operations to log
+
+    Examples:
+        from cushy_storage.utils.logger import enable_debug_logging
+
+        enable_debug_logging(sample_rate=0.01)
+    """
+    log_manager.set_level(logging.DEBUG, sample_rate)
+
+
+def disable_debug_logging():
+    """Only log warnings and errors, which is the default."""
+    log_manager.set_level(logging.WARNING)
 
 
 def exception_handler(exc_type, exc_value, exc_traceback):
@@ -78,9 +185,8 @@ def exception_handler(exc_type, exc_value, exc_traceback):
         return
 
     tb_info = "".join(traceback.format_exception(exc_type, exc_value, exc_traceback))
-    logger.error(f"Uncaught exception: {tb_info}")
+    logger.error("Uncaught exception: %s", tb_info)
 
 
 log_manager = LogManager()
 logger = log_manager.logger
-sys.excepthook = exception_handler
@@ -17,9 +17,14 @@
 # Project Link: https://github.com/Undertone0809/cushy-storage
 # Contact Email: zeeland@foxmail.com
 
+import contextlib
+import io
+import json
+import os
 import unittest
 
-from cushy_storage import BaseDict
+from cushy_storage import BaseDict, ChecksumError, CushyDict
+from cushy_storage.__main__ import main
 
 
 class TestBaseDict(unittest.TestCase):
@@ -45,3 +50,227 @@ class TestBaseDict(unittest.TestCase):
         data = "a" * (1024 * 1024)
         cache["big_data"] = data.encode()
         self.assertEqual(cache["big_data"].decode(), data)
+
+    def test_chunked_compression(self):
+        cache = BaseDict(
+            "./cache/test-base-dict-chunk", compress="zlib", chunk_size=1024
+        )
+
+        # Test storing a value larger than chunk size and reading part of it
+        data = bytes(range(256)) * 100
+        cache["big_data"] = data
+        self.assertEqual(cache["big_data"], data)
+        self.assertEqual(cache.read_range("big_data", 1000, 100), data[1000:1100])
+        self.assertEqual(cache.read_range("big_data", 25590, 100), data[25590:])
+
+        # Test the value can be read by a cache without chunking
+        cache = BaseDict("./cache/test-base-dict-chunk", compress="zlib")
+        self.assertEqual(cache["big_data"], data)
+
+    def test_streaming(self):
+        cache = BaseDict(
+            "./cache/test-base-dict-stream", compress="lzma", chunk_size=1024
+        )
+        data = bytes(range(256)) * 100
+
+        # Test writing a value in parts and reading it in parts
+        with cache.open_writer("stream") as writer:
+            for i in range(0, len(data), 1000):
+                writer.write(data[i : i + 1000])
+        with cache.open_reader("stream") as reader:
+            self.assertEqual(reader.read(10), data[:10])
+            self.assertEqual(reader.read(), data[10:])
+        self.assertEqual(cache["stream"], data)
+
+        # Test the value is discarded if writing fails
+        with self.assertRaises(RuntimeError):
+            with cache.open_writer("stream") as writer:
+                writer.write(b"partial")
+                raise RuntimeError()
+        self.assertEqual(cache["stream"], data)
+
+        cache = BaseDict("./cache/test-base-dict-stream")
+        cache.set_from_iter("raw", (bytes([i]) * 10 for i in range(10)))
+        with cache.open_reader("raw") as reader:
+            self.assertEqual(len(reader.read()), 100)
+        with self.assertRaises(KeyError):
+            cache.open_reader("not_exist")
+
+    def test_mmap_view(self):
+        cache = BaseDict("./cache/test-base-dict-mmap", use_mmap=True)
+        cache["blob"] = b"0123456789"
+        cache["empty"] = b""
+
+        # Test values are returned as read-only memoryview
+        value = cache["blob"]
+        self.assertIsInstance(value, memoryview)
+        self.assertTrue(value.readonly)
+        self.assertEqual(value[2:5].tobytes(), b"234")
+        self.assertEqual(cache["empty"].tobytes(), b"")
+
+        # Test the view keeps the old value after the key is overwritten
+        cache["blob"] = b"new value"
+        self.assertEqual(value.tobytes(), b"0123456789")
+        self.assertEqual(cache.view("blob").tobytes(), b"new value")
+
+        with self.assertRaises(ValueError):
+            BaseDict("./cache/test-base-dict-mmap", compress="zlib").view("blob")
+
+    def test_snapshot(self):
+        cache = BaseDict("./cache/test-base-dict-snapshot", compress="zlib")
+        for i in range(600):
+            cache[f"k{i}"] = str(i).encode()
+        snapshot = cache.snapshot()
+
+        # later writes do not change the snapshot
+        cache["k1"] = b"new"
+        del cache["k2"]
+        cache["new"] = b"1"
+        self.assertEqual(snapshot["k1"], b"1")
+        self.assertIn("k2", snapshot)
+        self.assertNotIn("new", snapshot)
+        self.assertEqual(len(snapshot), 600)
+        expected = {f"k{i}": str(i).encode() for i in range(600)}
+        self.assertEqual(dict(snapshot.items()), expected)
+        self.assertEqual(len(list(snapshot.values(parallel=False))), 600)
+
+        self.assertEqual(cache.snapshots(), [snapshot.name])
+        with cache.open_snapshot(snapshot.name) as opened:
+            self.assertEqual(opened["k1"], b"1")
+        self.assertEqual(cache.snapshots(), [])
+        self.assertEqual(cache["k1"], b"new")
+
+    def test_dedup(self):
+        cache = BaseDict("./cache/test-base-dict-dedup", compress="zlib", dedup=True)
+        blob = os.urandom(1024)
+        for i in range(10):
+            cache[f"copy{i}"] = blob
+        cache["other"] = b"other"
+        self.assertEqual(cache["copy3"], blob)
+        self.assertTrue(os.path.samefile(cache._file("copy0"), cache._file("copy9")))
+        self.assertEqual(os.stat(cache._file("copy0")).st_nlink, 11)
+
+        cache["copy0"] = b"other"
+        self.assertEqual(cache["copy0"], b"other")
+        self.assertEqual(cache.gc(), 0)
+        for i in range(1, 10):
+            del cache[f"copy{i}"]
+        self.assertEqual(cache.gc(), 1)
+        self.assertEqual(cache["other"], b"other")
+        # removed values are stored again
+        cache["copy1"] = blob
+        self.assertEqual(cache["copy1"], blob)
+
+    def test_checksum_and_repair(self):
+        path = "./cache/test-base-dict-checksum"
+        cache = BaseDict(path, compress="zlib", chunk_size=1024, checksum=True)
+        data = os.urandom(4096)
+        cache["big"] = data
+        cache["small"] = b"small"
+        with cache.open_writer("stream") as writer:
+            writer.write(data)
+        self.assertEqual(cache["big"], data)
+        self.assertEqual(cache.read_range("big", 1000, 100), data[1000:1100])
+        self.assertEqual(cache.open_reader("stream").read(), data)
+        # checksum is recorded in the cache
+        self.assertTrue(BaseDict(path, compress="zlib").checksum)
+
+        with open(cache._file("small"), "r+b") as f:
+            f.seek(3)
+            f.write(b"\xff\xff")
+        with self.assertRaises(ChecksumError):
+            cache["small"]
+        report = cache.verify()
+        self.assertEqual(report["checked"], 3)
+        self.assertEqual([k for k, _ in report["corrupted"]], ["small"])
+
+        self.assertEqual(main(["verify", path, "--serialize", "none"]), 1)
+        self.assertEqual(main(["repair", path, "--serialize", "none"]), 0)
+        self.assertNotIn("small", cache)
+        self.assertEqual(cache.verify()["corrupted"], [])
+
+        # a truncated value has lost its checksum
+        cache["truncated"] = os.urandom(100)
+        os.truncate(cache._file("truncated"), 50)
+        with self.assertRaises(ChecksumError):
+            cache["truncated"]
+        with self.assertRaises(ChecksumError):
+            cache.open_reader("truncated")
+        report = cache.verify()
+        self.assertEqual([k for k, _ in report["corrupted"]], ["truncated"])
+        self.assertEqual(cache.repair()["quarantined"], 1)
+        self.assertNotIn("truncated", cache)
+
+        # values written before checksum is enabled are given checksum
+        path = "./cache/test-base-dict-checksum-later"
+        BaseDict(path)["old"] = b"old"
+        cache = BaseDict(path, checksum=True)
+        self.assertEqual(cache["old"], b"old")
+        self.assertEqual(cache.verify()["corrupted"], [])
+
+        # values without checksum are checked by deserializing them
+        cache = CushyDict("./cache/test-base-dict-checksum-json")
+        cache["a"] = {"a": 1}
+        with open(cache._file("a"), "wb") as f:
+            f.write(b'{"a":')
+        self.assertEqual(len(cache.repair()["corrupted"]), 1)
+        self.assertNotIn("a", cache)
+
+    def test_layout_and_maintenance(self):
+        path = "./cache/test-base-dict-layout"
+        cache = BaseDict(path, compress="zlib")
+        cache.clear()
+        for i in range(100):
+            cache[f"key{i}"] = str(i).encode() * 10
+        self.assertEqual(cache.migrate_layout("hash"), 100)
+        self.assertEqual(cache["key7"], b"7" * 10)
+        cache.delete_prefix("key1")
+        self.assertNotIn("key15", cache)
+        self.assertEqual(len(cache), 89)
+        with self.assertRaises(ValueError):
+            BaseDict(path, compress="zlib", layout="prefix")
+        # the layout is recorded in the cache
+        self.assertEqual(BaseDict(path, compress="zlib")["key7"], b"7" * 10)
+        self.assertEqual(cache.migrate_layout("prefix"), 89)
+        self.assertEqual(
+            sorted(cache),
+            sorted(f"key{i}" for i in range(100) if i != 1 and not 10 <= i < 20),
+        )
+
+        self.assertEqual(cache.compact()["removed_tmp"], 0)
+        self.assertEqual(cache.evict(max_bytes=0), 89)
+        self.assertEqual(len(cache), 0)
+
+    def test_cli(self):
+        path = "./cache/test-base-dict-cli"
+        cache = BaseDict(path, compress="zlib")
+        cache.clear()
+        for i in range(50):
+            cache[f"k{i}"] = b"x" * (i * 10)
+        cache["big"] = os.urandom(4096)
+
+        out = io.StringIO()
+        with contextlib.redirect_stdout(out):
+            self.assertEqual(main(["stats", path, "--json"]), 0)
+            self.assertEqual(main(["top", path, "-n", "2", "--serialize", "none"]), 0)
+            args = ["bench", path, "--serialize", "none", "--writes", "10"]
+            self.assertEqual(main(args), 0)
+            self.assertEqual(main(["evict", path, "--max-size", "0"]), 0)
+        lines = out.getvalue().splitlines()
+        stats = json.loads("\n".join(lines[: lines.index("}") + 1]))
+        self.assertEqual(stats["keys"], 51)
+        self.assertGreater(stats["compression_ratio"], 1)
+        self.assertEqual(sum(stats["sizes"].values()), 51)
+        self.assertTrue(lines[lines.index("}") + 1].endswith("big"))
+        self.assertEqual(len(cache.namespace("__bench__")), 0)
+        self.assertEqual(lines[-1], "evicted 51 values")
+
+        # a mistyped path is not created, and values which can not be read are
+        # reported
+        err = io.StringIO()
+        with contextlib.redirect_stderr(err), contextlib.redirect_stdout(out):
+            self.assertEqual(main(["stats", "./cache/test-base-dict-no-cli"]), 2)
+            cache["big"] = os.urandom(4096)
+            self.assertEqual(main(["bench", path, "--serialize", "json"]), 1)
+        self.assertFalse(os.path.exists("./cache/test-base-dict-no-cli"))
+        self.assertIn("1 values failed to read", err.getvalue())
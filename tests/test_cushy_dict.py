@@ -17,12 +17,30 @@
 # Project Link: https://github.com/Undertone0809/cushy-storage
 # Contact Email: zeeland@foxmail.com
 
+import gc
+import io
+import multiprocessing
+import os
+import threading
 import unittest
+from pathlib import Path
 
-from cushy_storage import CushyDict
+from cushy_storage import CushyDict, sync
+from cushy_storage._access import AccessLog
+from cushy_storage._buffer import WriteBuffer
 from cushy_storage.base import EnhancedList
 
 
+def _incr_in_process(path: str, n: int, write_behind: bool = False):
+    cache = CushyDict(path, process_lock=True, write_behind=write_behind)
+    for _ in range(n):
+        cache.incr("counter")
+        while True:
+            value, version = cache.get_with_version("cas")
+            if cache.compare_and_set("cas", version, value + 1):
+                break
+
+
 class TestCushyDict(unittest.TestCase):
     def test_read_and_write_data(self):
         cache = CushyDict("./cache/test-cushy-dict")
@@ -45,3 +63,365 @@ class TestCushyDict(unittest.TestCase):
         cache["e"] = ("hello", 1)
         self.assertEqual(cache["e"], ["hello", 1])
         self.assertEqual(type(cache["e"]), EnhancedList)
+
+    def test_compression_dict(self):
+        cache = CushyDict("./cache/test-cushy-dict-zdict", compress="zlib")
+        for i in range(100):
+            cache[f"user{i}"] = {"name": f"user{i}", "age": i, "role": "member"}
+        self.assertEqual(len(cache), 100)
+
+        cache.train_compression_dict(sample_size=50)
+        cache["new_user"] = {"name": "new_user", "age": 1, "role": "member"}
+        self.assertEqual(cache["new_user"]["name"], "new_user")
+        self.assertEqual(cache["user1"]["age"], 1)
+        self.assertEqual(len(cache), 101)
+
+        # dictionary is loaded from the cache path
+        cache = CushyDict("./cache/test-cushy-dict-zdict", compress="zlib")
+        self.assertEqual(cache["new_user"]["age"], 1)
+
+    def test_mmap(self):
+        cache = CushyDict("./cache/test-cushy-dict-mmap", use_mmap=True)
+        cache["a"] = {"key": "value"}
+        self.assertEqual(cache["a"], {"key": "value"})
+
+        cache = CushyDict(
+            "./cache/test-cushy-dict-mmap", serialize="pickle", use_mmap=True
+        )
+        cache["b"] = bytes(1024)
+        self.assertEqual(cache["b"], bytes(1024))
+
+    def test_atomic_operations(self):
+        cache = CushyDict("./cache/test-cushy-dict-atomic")
+        cache["counter"] = 0
+
+        def work():
+            for _ in range(50):
+                cache.incr("counter")
+                cache.append_to("items", 1)
+
+        threads = [threading.Thread(target=work) for _ in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(cache["counter"], 200)
+        self.assertEqual(len(cache["items"]), 200)
+        self.assertEqual(cache.decr("counter", 10), 190)
+        self.assertEqual(cache.update_value("new", lambda v: v + "!", "hi"), "hi!")
+        with self.assertRaises(KeyError):
+            cache.update_value("not exist", lambda v: v)
+
+        # compare and set
+        value, version = cache.get_with_version("counter")
+        self.assertTrue(cache.compare_and_set("counter", version, value + 1))
+        self.assertFalse(cache.compare_and_set("counter", version, 0))
+        self.assertEqual(cache["counter"], 191)
+        self.assertIsNone(cache.get_version("cas"))
+        self.assertTrue(cache.compare_and_set("cas", None, 1))
+        self.assertFalse(cache.compare_and_set("cas", None, 2))
+
+    def test_process_lock(self):
+        path = "./cache/test-cushy-dict-process-lock"
+        for write_behind in (False, True):
+            CushyDict(path).update({"counter": 0, "cas": 0})
+            processes = [
+                multiprocessing.Process(
+                    target=_incr_in_process, args=(path, 30, write_behind)
+                )
+                for _ in range(3)
+            ]
+            for p in processes:
+                p.start()
+            _incr_in_process(path, 30, write_behind)
+            for p in processes:
+                p.join()
+            self.assertEqual(CushyDict(path)["counter"], 120)
+            self.assertEqual(CushyDict(path)["cas"], 120)
+
+    def test_write_behind(self):
+        path = "./cache/test-cushy-dict-write-behind"
+        cache = CushyDict(path, write_behind=True, flush_interval=60)
+        for i in range(100):
+            cache["progress"] = i
+        cache["tmp"] = 1
+        del cache["tmp"]
+        self.assertEqual(cache["progress"], 99)
+        self.assertNotIn("tmp", cache)
+        with self.assertRaises(KeyError):
+            del cache["tmp"]
+        # nothing is written before flush
+        self.assertFalse(os.path.exists(cache._file("progress")))
+        self.assertEqual(cache.incr("progress"), 100)
+
+        cache.flush()
+        self.assertEqual(CushyDict(path)["progress"], 100)
+        self.assertNotIn("tmp", CushyDict(path))
+
+        # a full buffer is flushed by the background thread
+        with CushyDict(path, write_behind=True, max_pending=10) as cache:
+            for i in range(10):
+                cache[f"key{i}"] = i
+            for _ in range(100):
+                if not cache._write_buffer:
+                    break
+                threading.Event().wait(0.01)
+            self.assertEqual(CushyDict(path)["key9"], 9)
+            cache["last"] = 1
+        # pending writes are flushed on close
+        self.assertEqual(CushyDict(path)["last"], 1)
+
+        # a value which can not be serialized fails when it is set
+        with CushyDict(path, write_behind=True, flush_interval=60) as cache:
+            cache["a"] = 1
+            with self.assertRaises(TypeError):
+                cache["bad"] = {1, 2}
+            cache["z"] = 2
+        self.assertEqual(CushyDict(path)["z"], 2)
+        self.assertNotIn("bad", CushyDict(path))
+
+        # a value which fails to be written does not block the others
+        written = {}
+
+        def write(k, v):
+            if k == "fail":
+                raise OSError("no space left")
+            written[k] = v
+
+        buffer = WriteBuffer(write, written.pop, lambda k: threading.Lock(), 60, 100)
+        buffer.put("fail", 1)
+        buffer.put("ok", 2)
+        with self.assertRaises(OSError):
+            buffer.flush()
+        self.assertEqual(written, {"ok": 2})
+        self.assertEqual(buffer.get("fail"), 1)
+        buffer.clear()
+        self.assertEqual(len(buffer), 0)
+
+        # flusher threads of caches which are not closed stop once they are freed
+        def flushers():
+            threads = threading.enumerate()
+            return [t for t in threads if t.name == "cushy-storage-flusher"]
+
+        running = flushers()
+        caches = [CushyDict(path, write_behind=True, flush_interval=60)]
+        for i in range(20):
+            caches.append(caches[0].namespace(f"tenant{i}"))
+            caches[-1]["key"] = i
+        started = [t for t in flushers() if t not in running]
+        self.assertEqual(len(started), 20)
+        del caches
+        gc.collect()
+        for thread in started:
+            thread.join(5)
+        self.assertFalse(any(thread.is_alive() for thread in started))
+
+    def test_memory_tier_and_warm(self):
+        path = "./cache/test-cushy-dict-warm"
+        cache = CushyDict(path, memory_items=2, access_log=True, stats=True)
+        for i in range(5):
+            cache[f"page{i}"] = {"page": i}
+        for _ in range(3):
+            self.assertEqual(cache["page1"], {"page": 1})
+        self.assertEqual(cache.stats.snapshot()["counters"]["memory_hits"], 2)
+        # memory tier is updated by writes
+        cache["page1"] = {"page": -1}
+        self.assertEqual(cache["page1"], {"page": -1})
+        cache.close()
+
+        cache = CushyDict(path, memory_items=10, stats=True)
+        self.assertEqual(cache.warm(neighbors=2), 3)
+        self.assertIn("page3", cache._memory)
+        self.assertEqual(cache["page2"], {"page": 2})
+        self.assertEqual(cache.stats.snapshot()["counters"]["memory_hits"], 1)
+
+        # neighbors are prefetched in background after a read
+        cache = CushyDict(path, memory_items=10, prefetch_neighbors=2)
+        cache["page0"]
+        for _ in range(100):
+            if "page2" in cache._memory:
+                break
+            threading.Event().wait(0.01)
+        self.assertIn("page2", cache._memory)
+
+        # only the hottest keys are counted in memory, and counts are saved while
+        # recording
+        log = AccessLog(Path(path) / "access_log_test", max_keys=10)
+        for i in range(1000):
+            log.record("hot")
+            log.record(f"cold{i}")
+        self.assertLessEqual(len(log.counts), 20)
+        self.assertEqual(log.hot_keys(1), ["hot"])
+        log.save_interval = 0
+        log.record("hot")
+        self.assertEqual(log.counts, {})
+        self.assertEqual(log.load()["hot"], 1001)
+
+    def test_tiers(self):
+        cache = CushyDict(
+            "./cache/test-cushy-dict-tiers/fast",
+            capacity=1000,
+            tiers=[("./cache/test-cushy-dict-tiers/slow", 2000)],
+            stats=True,
+        )
+        for i in range(40):
+            cache[f"k{i}"] = "x" * 98
+        self.assertEqual(cache.rebalance(), {"demoted": 31, "evicted": 13})
+        self.assertEqual(len(cache), 27)
+        self.assertEqual(len(set(cache)), 27)
+        self.assertNotIn("k0", cache)
+
+        # a value read from the slow tier is promoted in background
+        self.assertEqual(cache["k20"], "x" * 98)
+        for _ in range(100):
+            if cache.stats.snapshot()["counters"]["promotions"]:
+                break
+            threading.Event().wait(0.01)
+        self.assertTrue(cache._file("k20").is_file())
+        self.assertFalse(cache._tiers[0].file("k20").is_file())
+
+        # a new value shadows the old one in the slow tier, and delete removes both
+        cache["k21"] = 1
+        self.assertEqual(cache["k21"], 1)
+        del cache["k21"]
+        self.assertNotIn("k21", cache)
+        cache.clear()
+        self.assertEqual(len(cache), 0)
+        cache.close()
+
+    def test_sync(self):
+        src_path = "./cache/test-cushy-dict-sync/src"
+        dst_path = "./cache/test-cushy-dict-sync/dst"
+        # the journal of the source is not enabled by sync
+        CushyDict(src_path, compress="zlib")["k0"] = 0
+        with self.assertRaises(ValueError):
+            sync(src_path, dst_path)
+        self.assertIsNone(CushyDict(src_path).journal_id)
+
+        src = CushyDict(src_path, compress="zlib", journal=True)
+        for i in range(20):
+            src[f"k{i}"] = i
+        self.assertEqual(sync(src_path, dst_path)["set"], 20)
+        dst = CushyDict(dst_path, compress="zlib")
+        self.assertEqual(dst["k3"], 3)
+
+        # only changed keys are copied
+        src["k3"] = -3
+        src["k4"] = 4
+        del src["k5"]
+        result = sync(src_path, dst_path)
+        self.assertEqual((result["set"], result["deleted"]), (2, 1))
+        self.assertEqual(dst["k3"], -3)
+        self.assertNotIn("k5", dst)
+        self.assertEqual(sync(src_path, dst_path)["set"], 0)
+
+        # deltas can be shipped as files
+        seq = src.export_delta("./cache/test-cushy-dict-sync/full.delta")
+        src.clear()
+        src["a"] = 1
+        src.export_delta("./cache/test-cushy-dict-sync/a.delta", since=seq)
+        replica = CushyDict("./cache/test-cushy-dict-sync/replica", compress="zlib")
+        replica.import_delta("./cache/test-cushy-dict-sync/full.delta")
+        self.assertEqual(len(replica), 19)
+        replica.import_delta("./cache/test-cushy-dict-sync/a.delta")
+        self.assertEqual(list(replica), ["a"])
+        self.assertEqual(replica.synced_seq(src.journal_id), src._journal.seq())
+
+        # the journal is compacted, a delta from a dropped position copies all keys
+        src._journal.max_size = 1000
+        seq = src._journal.seq()
+        for i in range(100):
+            src["a"] = i
+        self.assertLess(os.path.getsize(src._journal.file), 1000)
+        self.assertGreater(src._journal.start, seq)
+        src["b"] = 1
+        header, _ = src._delta(seq)
+        self.assertEqual(header["since"], 0)
+        recent = src._journal.seq()
+        src["c"] = 2
+        self.assertEqual(src._delta(recent)[0]["since"], recent)
+        self.assertEqual(sync(src_path, dst_path)["set"], 3)
+        self.assertEqual(sorted(dst), ["a", "b", "c"])
+
+    def test_export_and_import(self):
+        src = CushyDict("./cache/test-cushy-dict-export/src", compress="zlib")
+        for i in range(300):
+            src[f"k{i}"] = {"i": i}
+        buffer = io.BytesIO()
+        self.assertEqual(src.export(buffer), 300)
+
+        dst = CushyDict("./cache/test-cushy-dict-export/dst", compress="zlib")
+        dst["extra"] = 1
+        buffer.seek(0)
+        self.assertEqual(dst.import_(buffer, parallel=False), 300)
+        self.assertEqual(len(dst), 301)
+        self.assertEqual(dst["k299"], {"i": 299})
+
+        # values are copied as stored, so options must match
+        buffer.seek(0)
+        plain = CushyDict("./cache/test-cushy-dict-export/plain", compress="lzma")
+        with self.assertRaises(ValueError):
+            plain.import_(buffer)
+
+    def test_watch(self):
+        path = "./cache/test-cushy-dict-watch"
+        cache = CushyDict(path, memory_items=10, watch=True)
+        cache["a"] = 1
+        self.assertEqual(cache["a"], 1)
+        changes = []
+        cache.subscribe(lambda op, k: changes.append((op, k)))
+
+        # the journal is enabled for all writers of the cache
+        other = CushyDict(path)
+        other["a"] = 2
+        other.delete_prefix("x")
+        other.clear()
+        self.assertEqual(cache.refresh(), 3)
+        self.assertEqual(changes, [("set", "a"), ("prefix", "x"), ("clear", "")])
+        self.assertNotIn("a", cache)
+
+        # changes are also applied in background
+        other["b"] = 1
+        self.assertEqual(cache["b"], 1)
+        other["b"] = 2
+        for _ in range(100):
+            if changes.count(("set", "b")) == 2:
+                break
+            threading.Event().wait(0.01)
+        self.assertEqual(cache["b"], 2)
+        cache.close()
+
+    def test_namespace_and_clear(self):
+        cache = CushyDict("./cache/test-cushy-dict-namespace")
+        for i in range(20):
+            cache[f"user:{i}"] = i
+            cache[f"order:{i}"] = i
+        cache["u"] = 1
+
+        cache.delete_prefix("user:1")
+        self.assertEqual(len(cache), 30)
+        self.assertNotIn("user:15", cache)
+        self.assertIn("user:2", cache)
+        cache.delete_prefix("u")
+        self.assertEqual(sorted(cache), sorted(f"order:{i}" for i in range(20)))
+
+        tenant = cache.namespace("tenant42")
+        tenant["a"] = {"name": "jack"}
+        self.assertNotIn("a", cache)
+        self.assertEqual(cache.namespace("tenant42")["a"], {"name": "jack"})
+        self.assertEqual(cache.namespaces(), ["tenant42"])
+        with self.assertRaises(ValueError):
+            cache.namespace("../escape")
+
+        cache.drop_namespace("tenant42")
+        self.assertEqual(len(cache.namespace("tenant42")), 0)
+        with self.assertRaises(KeyError):
+            cache.drop_namespace("not exist")
+
+        # clear keeps namespaces
+        cache.namespace("tenant42")["b"] = 1
+        cache.clear()
+        self.assertEqual(len(cache), 0)
+        cache["c"] = 1
+        self.assertEqual(list(cache), ["c"])
+        self.assertEqual(cache.namespace("tenant42")["b"], 1)
@@ -0,0 +1,49 @@
+# Copyright (c) 2023 Zeeland
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# Copyright Owner: Zeeland
+# GitHub Link: https://github.com/Undertone0809/
+# Project Link: https://github.com/Undertone0809/cushy-storage
+# Contact Email: zeeland@foxmail.com
+
+
+import os
+import subprocess
+import sys
+import tempfile
+import unittest
+
+_CHECK_SIDE_EFFECTS = """
+import os
+import sys
+import cushy_storage
+assert sys.excepthook is sys.__excepthook__, "sys.excepthook is replaced"
+assert not os.path.exists(os.path.expanduser("~/.cushy-storage")), "path is created"
+assert "multiprocessing.connection" not in sys.modules, "server is imported"
+from cushy_storage import CacheClient, CacheServer
+"""
+
+
+class TestImport(unittest.TestCase):
+    def test_import_has_no_side_effects(self):
+        with tempfile.TemporaryDirectory() as home:
+            env = dict(os.environ, HOME=home, USERPROFILE=home)
+            env["PYTHONPATH"] = os.pathsep.join(sys.path)
+            result = subprocess.run(
+                [sys.executable, "-c", _CHECK_SIDE_EFFECTS],
+                env=env,
+                capture_output=True,
+                text=True,
+            )
+        self.assertEqual(result.returncode, 0, result.stderr)
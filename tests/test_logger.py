@@ -0,0 +1,53 @@
+# Copyright (c) 2023 Zeeland
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# Copyright Owner: Zeeland
+# GitHub Link: https://github.com/Undertone0809/
+# Project Link: https://github.com/Undertone0809/cushy-storage
+# Contact Email: zeeland@foxmail.com
+
+
+import logging
+import unittest
+
+from cushy_storage.utils.logger import (
+    disable_debug_logging,
+    enable_debug_logging,
+    log_manager,
+    logger,
+)
+
+
+class TestLogger(unittest.TestCase):
+    def tearDown(self):
+        disable_debug_logging()
+
+    def test_debug_logging_is_disabled_by_default(self):
+        self.assertFalse(logger.isEnabledFor(logging.DEBUG))
+        self.assertTrue(logger.isEnabledFor(logging.WARNING))
+
+    def test_enable_debug_logging(self):
+        enable_debug_logging()
+        self.assertTrue(logger.isEnabledFor(logging.DEBUG))
+        self.assertIsNone(log_manager.sampling_filter)
+
+        # Test only a sample of debug records are kept
+        enable_debug_logging(sample_rate=0.1)
+        record = logging.LogRecord("cushy_storage", logging.DEBUG, "", 0, "", (), None)
+        kept = [log_manager.sampling_filter.filter(record) for _ in range(100)]
+        self.assertEqual(sum(kept), 10)
+
+        # Test warnings are always kept
+        record.levelno = logging.WARNING
+        self.assertTrue(log_manager.sampling_filter.filter(record))
@@ -17,11 +17,16 @@
 # Project Link: https://github.com/Undertone0809/cushy-storage
 # Contact Email: zeeland@foxmail.com
 
+import contextlib
+import io
+import threading
 import unittest
 from typing import List
+from unittest import mock
 
 from cushy_storage import BaseORMModel, CushyOrmCache
-from cushy_storage.orm import QuerySet
+from cushy_storage.__main__ import main
+from cushy_storage.orm import QuerySet, _ModelPages
 from tests.utils import delete_cache
 
 cache_file = {
@@ -30,6 +35,12 @@ cache_file = {
     "test_orm_update": "./cache/test-cushy-orm-cache-orm-update",
     "test_orm_set": "./cache/test-cushy-orm-cache-orm-set",
     "test_orm_remove_duplicates": "./cache/test-cushy-orm-cache-orm-remove-duplicates",
+    "test_orm_session": "./cache/test-cushy-orm-cache-orm-session",
+    "test_orm_paging": "./cache/test-cushy-orm-cache-orm-paging",
+    "test_orm_columnar": "./cache/test-cushy-orm-cache-orm-columnar",
+    "test_orm_aggregation": "./cache/test-cushy-orm-cache-orm-aggregation",
+    "test_orm_repair": "./cache/test-cushy-orm-cache-orm-repair",
+    "test_orm_concurrent_query": "./cache/test-cushy-orm-cache-orm-concurrent-query",
 }
 
 
@@ -40,6 +51,17 @@ class User(BaseORMModel):
         self.age = age
 
 
+class Point(BaseORMModel):
+    __columnar__ = True
+
+    def __init__(self, label, x, y, visible=True):
+        super().__init__()
+        self.label = label
+        self.x = x
+        self.y = y
+        self.visible = visible
+
+
 class TestORM(unittest.TestCase):
     @classmethod
     def tearDownClass(cls):
@@ -159,3 +181,254 @@ class TestORM(unittest.TestCase):
         orm_cache.remove_duplicates(User)
         queryset = orm_cache.query(User).all()
         self.assertEqual(len(queryset), 2)
+
+    def test_orm_session(self):
+        orm_cache = CushyOrmCache(cache_file["test_orm_session"])
+        user = User("jack", 18)
+        orm_cache.add(user)
+
+        with orm_cache.session() as s:
+            s.add([User(f"user{i}", i) for i in range(100)])
+            s.delete(user)
+            s.add(User("jasmine", 18))
+            # pending changes are visible in the session but not written
+            self.assertEqual(len(s.query(User).all()), 101)
+            self.assertEqual(len(orm_cache.query(User).all()), 1)
+
+        queryset = orm_cache.query(User)
+        self.assertEqual(len(queryset.all()), 101)
+        self.assertIsNone(queryset.filter(name="jack").first())
+
+        # assert update in session
+        jasmine = queryset.filter(name="jasmine").first()
+        with orm_cache.session() as s:
+            jasmine.age = 20
+            s.update_obj(jasmine)
+        self.assertEqual(orm_cache.query(User).filter(name="jasmine").first().age, 20)
+
+        # assert rollback on error
+        with self.assertRaises(RuntimeError):
+            with orm_cache.session() as s:
+                s.add(User("rollback user", 1))
+                raise RuntimeError()
+        self.assertEqual(len(orm_cache.query(User).all()), 101)
+
+        with self.assertRaises(ValueError):
+            with orm_cache.session() as s:
+                s.add(User("new user", 1))
+                s.update_obj(User("not exist user", 1))
+        self.assertEqual(len(orm_cache.query(User).all()), 101)
+
+        # a failing model leaves all models of the session unchanged
+        keys = set(orm_cache)
+        with self.assertRaises(ValueError):
+            with orm_cache.session() as s:
+                s.add(Point("p", 1, 1))
+                s.update_obj(User("not exist user", 1))
+        self.assertEqual(orm_cache.query(Point).count(), 0)
+        self.assertEqual(set(orm_cache), keys)
+
+        # manifests already replaced are restored if a later one fails
+        swap = _ModelPages.swap
+
+        def failing_swap(pages, new_pages):
+            if pages.name == "User":
+                raise OSError("disk full")
+            swap(pages, new_pages)
+
+        with mock.patch.object(_ModelPages, "swap", failing_swap):
+            with self.assertRaises(OSError):
+                with orm_cache.session() as s:
+                    s.add(Point("p", 1, 1))
+                    s.add(User("new user", 1))
+        self.assertEqual(orm_cache.query(Point).count(), 0)
+        self.assertEqual(orm_cache.query(User).count(), 101)
+        self.assertEqual(set(orm_cache), keys)
+
+    def test_orm_paging(self):
+        orm_cache = CushyOrmCache(cache_file["test_orm_paging"], page_size=10)
+        orm_cache.add([User(f"user{i}", i % 5) for i in range(25)])
+        orm_cache.add(User("jack", 18))
+        self.assertEqual(len(orm_cache["User"]["pages"]), 3)
+
+        queryset = orm_cache.query(User)
+        self.assertEqual(queryset.count(), 26)
+        self.assertEqual(queryset[12].name, "user12")
+        self.assertEqual(queryset[-1].name, "jack")
+        self.assertEqual(queryset.filter(age=0).count(), 5)
+        self.assertEqual(
+            [u.name for u in queryset.limit(3)], ["user0", "user1", "user2"]
+        )
+        self.assertEqual(queryset.filter(age=18).first().name, "jack")
+
+        # appending reads only the manifest and the last page
+        with mock.patch.object(orm_cache, "_get", wraps=orm_cache._get) as get:
+            orm_cache.add(User("tom", 1))
+        self.assertEqual(get.call_count, 2)
+        self.assertEqual(orm_cache.query(User).count(), 27)
+        orm_cache.delete(queryset.filter(name="tom").first())
+
+        # unchanged pages are kept when an object is updated
+        pages = orm_cache["User"]["pages"]
+        jack = queryset.filter(name="jack").first()
+        jack.age = 20
+        orm_cache.update_obj(jack)
+        new_pages = orm_cache["User"]["pages"]
+        self.assertEqual(pages[:2], new_pages[:2])
+        self.assertNotEqual(pages[2], new_pages[2])
+        self.assertNotIn(f"User@{pages[2][0]}", orm_cache)
+        self.assertEqual(orm_cache.query(User).filter(name="jack").first().age, 20)
+
+        # models stored as a list by older versions are converted on write
+        orm_cache["User"] = [User("legacy", 1), User("legacy2", 2)]
+        self.assertEqual(orm_cache.query(User).count(), 2)
+        orm_cache.add(User("jasmine", 18))
+        self.assertIsInstance(orm_cache["User"], dict)
+        self.assertEqual(orm_cache.query(User).count(), 3)
+        self.assertEqual(orm_cache.query(User)[0].name, "legacy")
+
+    def test_orm_concurrent_query(self):
+        orm_cache = CushyOrmCache(cache_file["test_orm_concurrent_query"], page_size=10)
+        orm_cache.add([User(f"user{i}", i) for i in range(25)])
+
+        # the last page is replaced by an append while the query is iterated
+        users = iter(orm_cache.query(User))
+        names = [next(users).name for _ in range(15)]
+        orm_cache.add(User("jack", 18))
+        names += [user.name for user in users]
+        self.assertEqual(names, [f"user{i}" for i in range(25)] + ["jack"])
+        self.assertEqual(orm_cache.query(User)[25].name, "jack")
+
+        errors = []
+        stop = threading.Event()
+
+        def write():
+            try:
+                for i in range(200):
+                    orm_cache.add(User(f"new{i}", i))
+            except Exception as e:
+                errors.append(e)
+            finally:
+                stop.set()
+
+        thread = threading.Thread(target=write)
+        thread.start()
+        try:
+            while not stop.is_set():
+                names = [user.name for user in orm_cache.query(User)]
+                self.assertEqual(len(names), len(set(names)))
+                self.assertEqual(names[:26], [f"user{i}" for i in range(25)] + ["jack"])
+        finally:
+            thread.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(orm_cache.query(User).count(), 226)
+
+    def test_orm_columnar(self):
+        orm_cache = CushyOrmCache(cache_file["test_orm_columnar"], page_size=50)
+        points = [Point(f"p{i % 3}", i, i / 2, i % 2 == 0) for i in range(120)]
+        orm_cache.add(points)
+        page_id = orm_cache["Point"]["pages"][0][0]
+        self.assertIn("columns", orm_cache[f"Point@{page_id}"])
+
+        queryset = orm_cache.query(Point)
+        self.assertEqual(queryset.count(), 120)
+        self.assertEqual(queryset[60].__dict__, points[60].__dict__)
+        self.assertEqual(queryset.filter(label="p1").count(), 40)
+        self.assertEqual(queryset.filter(x=7.0).first().y, 3.5)
+        self.assertEqual(queryset.filter(y=3.5, visible=False).first().x, 7)
+        self.assertEqual(queryset.filter(label="p3").count(), 0)
+        uid = points[99].__unique_id__
+        self.assertEqual(queryset.filter(__unique_id__=uid).first().x, 99)
+
+        point = queryset.filter(x=5).first()
+        point.label = "moved"
+        orm_cache.update_obj(point)
+        orm_cache.delete(queryset.filter(label="p0").all())
+        self.assertEqual(orm_cache.query(Point).count(), 80)
+        self.assertEqual(orm_cache.query(Point).filter(label="moved").first().x, 5)
+
+        # objects with different fields are stored as rows
+        extra = Point("extra", 0, 0)
+        extra.z = 1
+        orm_cache.add(extra)
+        self.assertEqual(orm_cache.query(Point).filter(label="extra").first().z, 1)
+
+    def test_orm_aggregation(self):
+        orm_cache = CushyOrmCache(cache_file["test_orm_aggregation"], page_size=7)
+        orm_cache.add([User(f"user{i}", 10 + i % 3) for i in range(20)])
+        orm_cache.add([Point(f"p{i % 2}", i, i * 2) for i in range(10)])
+
+        for model in (User, Point):
+            queryset = orm_cache.query(model)
+            self.assertEqual(queryset.count(), len(queryset.all()))
+
+        users = orm_cache.query(User)
+        self.assertEqual(users.sum("age"), sum(10 + i % 3 for i in range(20)))
+        self.assertEqual(users.min("age"), 10)
+        self.assertEqual(users.max("age"), 12)
+        self.assertEqual(users.filter(age=11).count(), 7)
+        self.assertIsNone(users.filter(age=99).avg("age"))
+        self.assertEqual(users.group_by("age"), {10: 7, 11: 7, 12: 6})
+        self.assertEqual(
+            users.limit(2).values("name"), [{"name": "user0"}, {"name": "user1"}]
+        )
+        self.assertEqual(
+            users.filter(age=12).values_list("name", flat=True)[:2], ["user2", "user5"]
+        )
+        with self.assertRaises(ValueError):
+            users.values_list("name", "age", flat=True)
+
+        points = orm_cache.query(Point)
+        self.assertEqual(points.sum("y"), 90)
+        self.assertEqual(points.filter(label="p1").avg("x"), 5)
+        self.assertEqual(
+            points.limit(3).values_list("label", "x"), [("p0", 0), ("p1", 1), ("p0", 2)]
+        )
+        self.assertEqual(points.group_by("label", "sum", "x"), {"p0": 20, "p1": 25})
+        self.assertEqual(points.group_by("label", "max", "y"), {"p0": 16, "p1": 18})
+        self.assertEqual(points.values()[0], orm_cache.query(Point).first().__dict__)
+
+    def test_orm_repair(self):
+        orm_cache = CushyOrmCache(cache_file["test_orm_repair"], page_size=10)
+        orm_cache.add([User(f"user{i}", i) for i in range(30)])
+        pages = orm_cache["User"]["pages"]
+
+        # corrupt a page and the manifest of another model
+        with open(orm_cache._file(f"User@{pages[1][0]}"), "wb") as f:
+            f.write(b"broken")
+        orm_cache.add([Point("p", i, i) for i in range(15)])
+        with open(orm_cache._file("Point"), "wb") as f:
+            f.write(b"broken")
+
+        # keys of the user are not taken as pages
+        orm_cache["user@example.com"] = {"name": "jack"}
+        orm_cache["note@0123456789abcdef"] = "text"
+
+        report = orm_cache.repair()
+        self.assertEqual(report["quarantined"], 2)
+        self.assertEqual(report["rebuilt"], ["Point", "User"])
+        self.assertEqual(orm_cache["user@example.com"], {"name": "jack"})
+        self.assertEqual(orm_cache["note@0123456789abcdef"], "text")
+        self.assertEqual(orm_cache.query(User).count(), 20)
+        self.assertIsNone(orm_cache.query(User).filter(name="user15").first())
+        self.assertEqual(orm_cache.query(Point).count(), 15)
+        self.assertEqual(orm_cache.query(Point).sum("x"), sum(range(15)))
+
+        # the command line reads the pickle serialization recorded in the cache
+        out = io.StringIO()
+        with contextlib.redirect_stdout(out):
+            self.assertEqual(main(["repair", cache_file["test_orm_repair"]]), 0)
+        self.assertIn("quarantined 0 values", out.getvalue())
+        self.assertEqual(orm_cache.query(User).count(), 20)
+
+        # and rebuilds page manifests of the ORM cache
+        pages = orm_cache["User"]["pages"]
+        with open(orm_cache._file(f"User@{pages[0][0]}"), "wb") as f:
+            f.write(b"broken")
+        out = io.StringIO()
+        with contextlib.redirect_stdout(out):
+            self.assertEqual(main(["repair", cache_file["test_orm_repair"]]), 0)
+        self.assertIn("quarantined 1 values", out.getvalue())
+        self.assertIn("rebuilt 1 indexes", out.getvalue())
+        self.assertEqual(orm_cache.query(User).count(), 10)
+        self.assertEqual(orm_cache.query(User).first().name, "user20")
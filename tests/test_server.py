@@ -0,0 +1,139 @@
+# Copyright (c) 2023 Zeeland
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# Copyright Owner: Zeeland
+# GitHub Link: https://github.com/Undertone0809/
+# Project Link: https://github.com/Undertone0809/cushy-storage
+# Contact Email: zeeland@foxmail.com
+
+
+import os
+import socket
+import unittest
+from unittest import mock
+
+from cushy_storage import BaseDict, CacheClient, CacheServer, CushyDict, disk_cache
+from tests.utils import delete_cache
+
+
+class TestServer(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cache = CushyDict("./cache/test-server", memory_items=100, stats=True)
+        cls.server = CacheServer(cache, os.path.abspath("./cache/test-server.sock"))
+        cls.server.start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.close()
+        delete_cache()
+
+    def test_client(self):
+        client = CacheClient(self.server.address)
+        client["a"] = {"x": 1}
+        self.assertEqual(client["a"], {"x": 1})
+        self.assertIn("a", client)
+        with self.assertRaises(KeyError):
+            client["not_exist"]
+        self.assertEqual(client.incr("n", 2), 2)
+        self.assertEqual(client.append_to("l", 1), [1])
+
+        # operations of a pipeline are sent in one request
+        results = client.pipeline().set("b", 2).get("b").incr("n").execute()
+        self.assertEqual(results, [None, 2, 3])
+        client.set_many({"c": 3, "d": 4})
+        self.assertEqual(client.get_many(["c", "d", "e"]), {"c": 3, "d": 4})
+        with self.assertRaises(KeyError):
+            client.pipeline().get("e").set("e", 5).execute()
+        self.assertEqual(client["e"], 5)
+
+        # errors other than missing keys are raised by get_many
+        file = self.server.cache._file("broken")
+        file.parent.mkdir(parents=True, exist_ok=True)
+        file.write_bytes(b"not a value")
+        with self.assertRaises(ValueError):
+            client.get_many(["c", "broken"])
+        os.remove(file)
+
+        del client["a"]
+        self.assertNotIn("a", client)
+        self.assertEqual(client.server_stats()["counters"]["sets"], 8)
+        client.close()
+
+    def test_disk_cache(self):
+        calls = []
+
+        @disk_cache(cache=CacheClient(self.server.address))
+        def add_one(x):
+            calls.append(x)
+            return x + 1
+
+        self.assertEqual(add_one(1), 2)
+        self.assertEqual(add_one(1), 2)
+        self.assertEqual(calls, [1])
+
+    def test_tcp_needs_authkey(self):
+        with self.assertRaises(ValueError):
+            CacheClient(("127.0.0.1", 7379))
+
+    def test_existing_socket_path(self):
+        cache = CushyDict("./cache/test-server")
+        # a running server is not replaced
+        with self.assertRaises(OSError):
+            CacheServer(cache, self.server.address)
+        self.assertEqual(CacheClient(self.server.address).incr("alive"), 1)
+
+        # a path which is not a socket is not removed
+        path = os.path.abspath("./cache/test-server-file")
+        with open(path, "w") as f:
+            f.write("data")
+        with self.assertRaises(FileExistsError):
+            CacheServer(cache, path)
+        self.assertTrue(os.path.isfile(path))
+
+        # the socket file left by a stopped server is replaced
+        path = os.path.abspath("./cache/test-server-stale.sock")
+        sock = socket.socket(socket.AF_UNIX)
+        sock.bind(path)
+        sock.close()
+        server = CacheServer(cache, path).start()
+        try:
+            self.assertEqual(CacheClient(path).incr("stale"), 1)
+        finally:
+            server.close()
+
+    def test_result_not_picklable(self):
+        cache = BaseDict("./cache/test-server-mmap", use_mmap=True)
+        path = os.path.abspath("./cache/test-server-mmap.sock")
+        server = CacheServer(cache, path).start()
+        try:
+            client = CacheClient(path)
+            # memory-mapped values are sent as bytes
+            client["a"] = b"value"
+            self.assertEqual(client["a"], b"value")
+            self.assertEqual(client.get_many(["a", "b"]), {"a": b"value"})
+
+            # a result which can not be pickled fails alone
+            with mock.patch.dict(
+                "cushy_storage.server._OPERATIONS", {"get": lambda cache, k: lambda: k}
+            ):
+                with self.assertRaises(TypeError):
+                    client.pipeline().set("b", b"new").get("a").execute()
+            self.assertEqual(client.get_many(["a", "b"]), {"a": b"value", "b": b"new"})
+        finally:
+            server.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,101 @@
+# Copyright (c) 2023 Zeeland
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# Copyright Owner: Zeeland
+# GitHub Link: https://github.com/Undertone0809/
+# Project Link: https://github.com/Undertone0809/cushy-storage
+# Contact Email: zeeland@foxmail.com
+
+
+import threading
+import unittest
+
+from cushy_storage import CushyDict, disk_cache
+from cushy_storage.stats import CacheStats, Histogram
+from tests.utils import delete_cache
+
+
+class TestStats(unittest.TestCase):
+    @classmethod
+    def tearDownClass(cls):
+        delete_cache()
+
+    def test_histogram(self):
+        histogram = Histogram()
+        for _ in range(99):
+            histogram.record(0.000010)
+        histogram.record(0.5)
+
+        self.assertEqual(histogram.count, 100)
+        self.assertLessEqual(histogram.percentile(50), 0.000016)
+        self.assertEqual(histogram.percentile(100), 0.5)
+
+    def test_cushy_dict_stats(self):
+        cache = CushyDict("./cache/test-stats", compress="zlib", stats=True)
+        cache["a"] = {"key": "value" * 100}
+        self.assertEqual(cache["a"], {"key": "value" * 100})
+        with self.assertRaises(KeyError):
+            cache["not_exist"]
+        del cache["a"]
+
+        snapshot = cache.stats.snapshot()
+        self.assertEqual(snapshot["counters"]["sets"], 1)
+        self.assertEqual(snapshot["counters"]["hits"], 1)
+        self.assertEqual(snapshot["counters"]["misses"], 1)
+        self.assertEqual(snapshot["counters"]["deletes"], 1)
+        self.assertEqual(snapshot["hit_ratio"], 0.5)
+        self.assertGreater(snapshot["compression_ratio"], 1)
+        for stage in ("get", "set", "serialize", "deserialize", "lock_wait"):
+            self.assertGreater(snapshot["latency"][stage]["count"], 0)
+
+        # Test exporting snapshots
+        exported = []
+        cache.stats.add_exporter(exported.append)
+        cache.stats.export()
+        self.assertEqual(exported[0]["counters"]["sets"], 1)
+
+        # a failing interval exporter keeps running until the cache is closed
+        calls = []
+
+        def failing(snapshot):
+            calls.append(snapshot)
+            raise OSError("metrics system is down")
+
+        cache.stats.add_exporter(failing, interval=0.01)
+        threads = list(cache.stats._threads)
+        with self.assertLogs("cushy_storage", "ERROR"):
+            for _ in range(500):
+                if len(calls) >= 3:
+                    break
+                threading.Event().wait(0.01)
+        self.assertGreaterEqual(len(calls), 3)
+        cache.close()
+        self.assertFalse(any(thread.is_alive() for thread in threads))
+
+    def test_stats_are_disabled_by_default(self):
+        self.assertIsNone(CushyDict("./cache/test-stats").stats)
+        self.assertIsInstance(
+            CushyDict("./cache/test-stats", stats=True).stats, CacheStats
+        )
+
+    def test_disk_cache_stats(self):
+        @disk_cache("./cache/test-stats-disk-cache", stats=True)
+        def add_one(x):
+            return x + 1
+
+        add_one(1)
+        add_one(1)
+        counters = add_one.cache.stats.snapshot()["counters"]
+        self.assertEqual(counters["misses"], 1)
+        self.assertEqual(counters["hits"], 1)